@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from cache import LRUCache
+from similarity import normalized
+
+"""
+Word analogies (king - man + woman = queen) for /analogy.
+
+gensim's most_similar normalizes the query and scans every
+word vector on each call. AnalogyIndex instead holds the
+unit-normalized word vectors once per served model, can leave
+out rare words, whose vectors are noisy and rarely the answer
+anyone wants, and scores a batch of queries with one matrix
+product. Answers are cached per query.
+
+Scores are the same as most_similar's: cosine similarity to
+the normalized sum of the positive word vectors minus the
+negative ones, with the query words themselves left out.
+"""
+
+
+class AnalogyIndex(object):
+    """
+    Args:
+        model (Doc2Vec): model whose word vectors to search
+        top_n (int): only answer with the top_n most frequent
+            words, or None for the whole vocabulary. Query words
+            may still be any word in the vocabulary.
+        cache_size (int): answers to keep
+    """
+    def __init__(self, model, top_n=None, cache_size=10000):
+        if model.syn0norm is None:
+            model.init_sims()
+        # exported models memory-map syn0norm, see serving.py
+        self.all_vectors = model.syn0norm
+        self.vocab = model.vocab
+        counts = np.array([model.vocab[word].count for word in model.index2word])
+        order = np.argsort(-counts, kind='mergesort')[:top_n]
+        if np.array_equal(order, np.arange(len(order))):
+            # gensim sorts the vocabulary by frequency, so this is a view, not a copy
+            self.vectors = self.all_vectors[:len(order)]
+        else:
+            self.vectors = np.asarray(self.all_vectors[order])
+        self.words = [model.index2word[i] for i in order]
+        # row in self.vectors of each candidate word's full-vocabulary row
+        self.candidate_row = dict((int(i), row) for row, i in enumerate(order))
+        self.cache = LRUCache(maxsize=cache_size)
+
+    def query_vector(self, positive, negative):
+        """
+        Raises:
+            KeyError: if a word is not in the vocabulary
+        """
+        rows = [self.vocab[word].index for word in positive + negative]
+        signs = np.array([1.] * len(positive) + [-1.] * len(negative), dtype=np.float32)
+        query = np.dot(signs, self.all_vectors[rows])
+        return normalized(query[np.newaxis, :])[0], rows
+
+    def most_similar(self, positive=(), negative=(), topn=10):
+        """
+        Returns:
+            list: (word, similarity) tuples, best first
+
+        Raises:
+            KeyError: if a word is not in the vocabulary
+            ValueError: if no words are given
+        """
+        result = self.most_similar_batch([(positive, negative)], topn=topn)[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def most_similar_batch(self, queries, topn=10, block=256):
+        """
+        Answer many queries, scoring all the uncached ones
+        with one matrix product per block of queries.
+
+        Args:
+            queries (list): (positive words, negative words) pairs
+            topn (int): answers per query
+            block (int): queries scored at a time, which bounds
+                memory to block times the candidate vocabulary
+
+        Returns:
+            list: per query, a list of (word, similarity) tuples,
+                or the KeyError or ValueError explaining why it
+                could not be answered
+        """
+        keys = [(tuple(sorted(pos)), tuple(sorted(neg)), topn) for pos, neg in queries]
+        found = self.cache.get_many(set(keys))
+        results = [found.get(key) for key in keys]
+
+        todo = []
+        vectors = []
+        for i, (key, result) in enumerate(zip(keys, results)):
+            if result is not None:
+                continue
+            positive, negative = list(key[0]), list(key[1])
+            if not positive and not negative:
+                results[i] = ValueError("no words given")
+                continue
+            try:
+                query, rows = self.query_vector(positive, negative)
+            except KeyError as e:
+                results[i] = KeyError("word %s not in vocabulary" % e)
+                continue
+            todo.append((i, rows))
+            vectors.append(query)
+
+        for start in range(0, len(todo), block):
+            scores = np.dot(np.array(vectors[start:start + block]), self.vectors.T)
+            for (i, rows), row_scores in zip(todo[start:start + block], scores):
+                results[i] = self.best(row_scores, rows, topn)
+                self.cache.put(keys[i], results[i])
+        return results
+
+    def best(self, scores, exclude_rows, topn):
+        """Top topn candidates by score, leaving out the query words."""
+        for row in exclude_rows:
+            if row in self.candidate_row:
+                scores[self.candidate_row[row]] = -np.inf
+        topn = min(topn, len(scores))
+        if topn <= 0:
+            return []
+        best = np.argpartition(-scores, topn - 1)[:topn]
+        best = best[np.argsort(-scores[best], kind='mergesort')]
+        return [(self.words[i], float(scores[i])) for i in best if scores[i] > -np.inf]
@@ -1,16 +1,86 @@
 # -*- coding: utf-8 -*-
 from operator import itemgetter
-import psycopg2
-from psycopg2.extras import DictCursor
-from flask import Flask, render_template, request, url_for
-from gensim.models import Doc2Vec
+from psycopg2.extras import DictCursor, RealDictCursor
+import flask
+from flask import Flask, request, url_for, g, abort, jsonify, make_response, redirect
+from quantize import CODECS
+from registry import ModelRegistry
+from similarity import filtered_search
+from hybrid import lexical_candidates, vector_scores, fuse
+from timing import StageTimer, Metrics
+from profiler import SlowRequestProfiler
+from db import Pool, listen
+from cache import LRUCache, TTLCache
+import serving
+from datetime import datetime
+from contextlib import contextmanager
+import numpy as np
+import os
 import re
+import time
 import argparse
 
 appserver = Flask(__name__)
 
+# columns the article list templates (doc.html, search.html) need
+LIST_COLUMNS = ('index', 'title', 'subject', 'last_submitted')
+# title, subject and date of recently shown articles, by index;
+# cleared when ingestion updates articles
+article_cache = LRUCache(maxsize=50000)
+# articles per page when browsing a subject
+PAGE_SIZE = 50
+# subject list with article counts; cleared when ingestion adds articles
+subjects_cache = TTLCache(ttl=600)
+# full-text matches re-ranked by hybrid search
+HYBRID_CANDIDATES = 1000
+# share of the docvec ranking in hybrid search's fused score
+HYBRID_WEIGHT = 0.5
+# most queries accepted by one /analogy/batch request
+MAX_ANALOGY_BATCH = 1000
+# per-endpoint histograms of request and stage durations, for /metrics
+metrics = Metrics()
+# the /admin routes only answer these
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+# addresses /metrics answers, set by --metrics_allow
+metrics_allow = LOCAL_ADDRESSES
+# set by create_app()
+pool = None
+registry = None
+# set by create_app() when --profile_slow is given
+profiler = None
+
 """Helpers"""
 
+def render_template(template, **context):
+    """flask.render_template, timed as the request's 'render' stage."""
+    with g.timer.stage('render'):
+        return flask.render_template(template, **context)
+
+
+@contextmanager
+def db_cursor(**kwargs):
+    """
+    pool.cursor(), timed as the request's 'db' stage,
+    including any wait for a free connection.
+    """
+    with g.timer.stage('db'):
+        with pool.cursor(**kwargs) as cur:
+            yield cur
+
+
+@contextmanager
+def waiting_on(thread):
+    """
+    Lets the slow request profiler sample thread while the
+    request waits on it; does nothing when not profiling.
+    """
+    if profiler is None:
+        yield
+    else:
+        with profiler.waiting_on(thread):
+            yield
+
+
 def get_subjects():
     """
     OUTPUT: list of tuples containing:
@@ -19,44 +89,86 @@ def get_subjects():
             ordered alphabetically by subject name
 
     Called by browse_subjects()
+
+    Counts are kept in the subjects table by make_subjects_table.py
+    and xml_to_postgres.py, and cached here until they expire
+    or ingestion sends a subjects_changed notification.
     """
-    cur = conn.cursor()
-    cur.execute("SELECT subject, COUNT(*) FROM articles GROUP BY subject;")
-    subjects = sorted(cur.fetchall(), key=lambda tup:tup[0])
+    subjects = subjects_cache.get('all')
+    if subjects is None:
+        with db_cursor() as cur:
+            cur.execute("SELECT subject, article_count FROM subjects ORDER BY subject;")
+            subjects = cur.fetchall()
+        subjects_cache.put('all', subjects)
     return subjects
 
 
-def get_articles(indices):
+def hydrate(ranked):
     """
-    INPUT: list of integers corresponding to
-        'index' column values of desired articles in database
+    INPUT: list of (index, score) tuples, best first,
+        as returned by nearest() or similar_articles()
+
+    OUTPUT: list of dictionaries with the LIST_COLUMNS of
+        each article plus its 'score', in the same order
 
-    OUTPUT: list of dictionaries, each dictionary
-        corresponding to an article
+    Articles in article_cache skip the database; the rest
+    are fetched in one query.
     """
-    with conn.cursor(cursor_factory=DictCursor) as cur:
-        query = "SELECT * FROM articles \
-            WHERE index IN %s \
-            ORDER BY last_submitted DESC"
-        cur.execute(query, (tuple(indices),))
-        articles = cur.fetchall()
-        return articles
+    indices = [int(index) for index, score in ranked]
+    found = article_cache.get_many(indices)
+    missing = [index for index in indices if index not in found]
+    if missing:
+        with db_cursor(cursor_factory=RealDictCursor) as cur:
+            query = "SELECT %s FROM articles WHERE index = ANY(%%s)" % ', '.join(LIST_COLUMNS)
+            cur.execute(query, (missing,))
+            for row in cur.fetchall():
+                article_cache.put(row['index'], row)
+                found[row['index']] = row
+    # copy, so adding the score does not touch the cached row
+    return [dict(found[index], score=score)
+            for index, (_, score) in zip(indices, ranked) if index in found]
 
 
-def get_articles_by_subject(subject):
+def get_articles_by_subject(subject, before=None, limit=PAGE_SIZE):
     """
     INPUT:
         (str): subject name
+        (tuple): (last_submitted, index) of the last article on
+            the previous page, or None for the first page
+        (int): number of articles to return
+
+    OUTPUT: list of dictionaries with index, title and
+        last_submitted, newest first, then articles with no
+        date, highest index first
 
-    OUTPUT: list of dictionaries, each dictionary
-        corresponding to an article
+    Keyset pagination: each page picks up below the previous
+    page's last (last_submitted, index), so deep pages cost the
+    same as the first. A last_submitted of None in before means
+    the previous page ended among the undated articles. Both
+    parts are served by the articles_subject_listing index made
+    in populate_db/make_subjects_table.py.
     """
-    with conn.cursor(cursor_factory=DictCursor) as cur:
-        query = "SELECT * FROM articles \
-            WHERE subject=%s \
-            ORDER BY last_submitted DESC"
-        cur.execute(query, (subject,))
-        articles = cur.fetchall()
+    with db_cursor(cursor_factory=RealDictCursor) as cur:
+        query = "SELECT index, title, last_submitted FROM articles \
+            WHERE subject_id = (SELECT index FROM subjects WHERE subject=%s) \
+            {keyset} \
+            ORDER BY last_submitted DESC, index DESC \
+            LIMIT %s"
+        articles = []
+        if before is None:
+            cur.execute(query.format(keyset="AND last_submitted IS NOT NULL"), (subject, limit))
+            articles = cur.fetchall()
+        elif before[0] is not None:
+            # never true for a NULL last_submitted
+            keyset = "AND (last_submitted, index) < (%s, %s)"
+            cur.execute(query.format(keyset=keyset), (subject, before[0], before[1], limit))
+            articles = cur.fetchall()
+        if len(articles) < limit:
+            keyset, params = "AND last_submitted IS NULL", (subject,)
+            if before is not None and before[0] is None:
+                keyset, params = keyset + " AND index < %s", params + (before[1],)
+            cur.execute(query.format(keyset=keyset), params + (limit - len(articles),))
+            articles += cur.fetchall()
         return articles
 
 
@@ -69,16 +181,235 @@ def get_article(index):
         (dict): dictionary object representing
             article matching the given index
     """
-    with conn.cursor(cursor_factory=DictCursor) as cur:
+    with db_cursor(cursor_factory=DictCursor) as cur:
         query = "SELECT * FROM articles WHERE index=%s"
         cur.execute(query, (index, ))
         article = cur.fetchone()
         return article
 
+
+def get_article_authors(index):
+    """
+    INPUT:
+        (int): article index
+
+    OUTPUT: list of dictionaries with index and name of each
+        author of the article, in byline order
+    """
+    with db_cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("""SELECT au.index, au.name FROM article_authors aa
+            JOIN authors au ON au.index = aa.author_id
+            WHERE aa.article_id = %s ORDER BY aa.position""", (index,))
+        return cur.fetchall()
+
+
+def get_author(author_id):
+    """
+    INPUT:
+        (int): author index
+
+    OUTPUT: dictionary with index, name and article_count,
+        or None if there is no such author
+    """
+    with db_cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("SELECT index, name, article_count FROM authors WHERE index=%s",
+                    (author_id,))
+        return cur.fetchone()
+
+
+def get_articles_by_author(author_id, limit=PAGE_SIZE):
+    """
+    INPUT:
+        (int): author index
+        (int): number of articles to return
+
+    OUTPUT: list of dictionaries with index, title, subject
+        and last_submitted, newest first
+
+    Served by the article_authors_author index made in
+    populate_db/xml_to_postgres.py.
+    """
+    with db_cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("""SELECT a.index, a.title, a.subject, a.last_submitted
+            FROM article_authors aa JOIN articles a ON a.index = aa.article_id
+            WHERE aa.author_id = %s
+            ORDER BY a.last_submitted DESC, a.index DESC
+            LIMIT %s""", (author_id, limit))
+        return cur.fetchall()
+
+
+def similar_authors(author_id, topn=10):
+    """
+    INPUT:
+        author_id (int): author to find neighbors of
+        topn (int): number of neighbors
+
+    OUTPUT: list of dictionaries with index, name, article_count
+        and 'score', most similar first. Empty if the author has
+        no vector, e.g. too few articles when
+        populate_db/cache_author_vectors.py was run.
+    """
+    author_ids = g.served.author_ids
+    if author_ids is None:
+        return []
+    row = int(np.searchsorted(author_ids, author_id))
+    if row == len(author_ids) or author_ids[row] != author_id:
+        return []
+    index = g.served.author_index
+    ranked = [(int(author_ids[i]), score)
+              for i, score in index.search(index.vectors[row], topn=topn, exclude=row)]
+    with db_cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("SELECT index, name, article_count FROM authors WHERE index = ANY(%s)",
+                    ([i for i, _ in ranked],))
+        found = dict((author['index'], author) for author in cur.fetchall())
+    return [dict(found[i], score=score) for i, score in ranked if i in found]
+
+
+def get_filters():
+    """
+    OUTPUT: dictionary of the subject, since and until filters
+        given as request arguments or form fields, with dates
+        parsed; empty if there are none
+
+    Aborts with 400 on a malformed date, or if the live model
+    has no row filter (see populate_db/cache_row_filter.py).
+    """
+    filters = {}
+    if request.values.get('subject'):
+        filters['subject'] = request.values['subject']
+    for name in ('since', 'until'):
+        if request.values.get(name):
+            try:
+                filters[name] = datetime.strptime(request.values[name], '%Y-%m-%d').date()
+            except ValueError:
+                abort(400)
+    if filters and g.served.row_filter is None:
+        abort(400)
+    return filters
+
+
+def nearest(query_vec, topn, exclude=None):
+    """
+    INPUT:
+        query_vec (ndarray): vector to find neighbors of
+        topn (int): number of neighbors
+        exclude (int): article index to leave out of results
+
+    OUTPUT: list of (index, similarity) tuples, most similar first
+
+    Uses the ANN index of the live model. Pass ?exact=1
+    on any similarity route to use brute-force search instead,
+    which is handy for checking what the index misses.
+    Subject and date filters (see get_filters) are applied
+    inside the search, so only matching articles are scored.
+    """
+    filters = get_filters()
+    if filters:
+        index = g.served.exact_index if request.values.get('exact') else g.served.index
+        return filtered_search(index, g.served.exact_index, query_vec, g.served.row_filter,
+                               topn=topn, exclude=exclude, **filters)
+    if request.values.get('exact'):
+        return g.served.exact_index.search(query_vec, topn=topn, exclude=exclude)
+    return g.served.index.search(query_vec, topn=topn, exclude=exclude)
+
+
+def similar_articles(article_index, topn):
+    """
+    INPUT:
+        article_index (int): article to find neighbors of
+        topn (int): number of neighbors
+
+    OUTPUT: list of (index, similarity) tuples, most similar first
+
+    Served from the table precomputed by populate_db/cache_neighbors.py
+    when it covers this article, otherwise searched live.
+    Articles added after the table was built, and filtered
+    requests, are the usual misses.
+    """
+    neighbors = g.served.neighbors
+    if (neighbors is not None and not request.values.get('exact') and not get_filters()
+            and article_index < len(neighbors) and topn <= neighbors.shape[1]):
+        ids = neighbors[article_index, :topn]
+        scores = g.served.neighbor_scores[article_index, :topn]
+        return [(int(i), float(s)) for i, s in zip(ids, scores)]
+    return nearest(g.served.docvecs[article_index], topn=topn, exclude=article_index)
+
+def hybrid_search(query, words, timer, topn=100):
+    """
+    INPUT:
+        query (str): query as typed
+        words (list): its tokens the model knows
+        timer (StageTimer): records the time of each stage
+        topn (int): number of results
+
+    OUTPUT: list of (index, fused score) tuples, best first
+
+    Full-text matches from postgres, re-ranked by docvec
+    similarity to the query; see hybrid.py. Queries with no
+    words the model knows, such as an author name, are ranked
+    on the full-text match alone.
+    """
+    with timer.stage('lexical'):
+        with db_cursor() as cur:
+            ids, lexical = lexical_candidates(cur, query, limit=HYBRID_CANDIDATES)
+    filters = get_filters()
+    if filters:
+        with timer.stage('filter'):
+            keep = g.served.row_filter.allows(ids, **filters)
+            ids, lexical = ids[keep], lexical[keep]
+    vector = None
+    if words and len(ids):
+        with timer.stage('infer'):
+            q_vec = g.served.encoder.infer(words)
+        with timer.stage('rerank'):
+            vector = vector_scores(g.served.docvecs, q_vec, ids)
+    with timer.stage('fuse'):
+        return fuse(ids, lexical, vector, weight=HYBRID_WEIGHT, topn=topn)
+
 """
 ROUTES
 """
 
+@appserver.before_request
+def start_timer():
+    """
+    Time the stages of every request (see render_template,
+    db_cursor and the routes), and sample its stacks if
+    --profile_slow is set.
+    """
+    g.timer = StageTimer()
+    g.started = time.time()
+    if profiler is not None:
+        profiler.begin()
+
+@appserver.after_request
+def add_server_timing(response):
+    if g.timer.timings and 'Server-Timing' not in response.headers:
+        response.headers['Server-Timing'] = g.timer.header()
+    return response
+
+@appserver.teardown_request
+def record_timings(exc=None):
+    """Runs after the response is built, even if the request failed."""
+    elapsed = time.time() - g.started
+    metrics.observe_timer(request.endpoint or 'none', g.timer, seconds=elapsed)
+    if profiler is not None:
+        profiler.end('%s %s' % (request.method, request.full_path), 1000 * elapsed)
+
+@appserver.before_request
+def acquire_model():
+    """
+    Pin the live model for this request, so a model swap
+    midway through does not change what the request sees.
+    """
+    g.served = registry.acquire()
+
+@appserver.teardown_request
+def release_model(exc=None):
+    served = g.pop('served', None)
+    if served is not None:
+        registry.release(served)
+
 @appserver.route('/')
 @appserver.route('/topics/')
 @appserver.route('/topics/<subject>')
@@ -91,32 +422,99 @@ def browse_subjects(subject=None):
     if subject is None:
         return render_template("browse.html", subjects=get_subjects())
     else:
-        articles = get_articles_by_subject(subject)
-        return render_template("articles.html", articles=articles, subject=subject)
+        before = None
+        if request.args.get('before_index'):
+            # no before_date: the previous page ended among undated articles
+            try:
+                before_date = request.args.get('before_date')
+                if before_date:
+                    before_date = datetime.strptime(before_date, '%Y-%m-%d').date()
+                before = (before_date or None, int(request.args['before_index']))
+            except ValueError:
+                abort(400)
+        # one extra row tells us whether there is a next page
+        articles = get_articles_by_subject(subject, before, limit=PAGE_SIZE + 1)
+        next_page = None
+        if len(articles) > PAGE_SIZE:
+            articles = articles[:PAGE_SIZE]
+            last = articles[-1]
+            keyset = {'before_index': last['index']}
+            if last['last_submitted'] is not None:
+                keyset['before_date'] = last['last_submitted'].isoformat()
+            next_page = url_for('browse_subjects', subject=subject, **keyset)
+        return render_template("articles.html", articles=articles, subject=subject,
+                               next_page=next_page)
 
-@appserver.route('/article/<main_article_id>')
-def find_similars(main_article_id=None):
+@appserver.route('/article/<int:main_article_id>')
+def find_similars(main_article_id):
     main_article = get_article(main_article_id)
-    sims = model.docvecs.most_similar(int(main_article_id), topn=10) # list of (id, similarity)
-    sim_articles = get_articles([int(index) for index, sim in sims]) # list of dictionaries...
-    # we're gonna add similarity scores to each dictionary (article) in above list from sims
-    sort_these = []
-    for article in sim_articles:
-        sim_score = [score for idx, score in sims if article['index'] == idx ][0]
-        article.extend([round(sim_score, 2)])
-        sort_these.append(article)
+    if main_article is None:
+        abort(404)
+    if main_article_id < len(g.served.docvecs):
+        with g.timer.stage('similar'):
+            sims = similar_articles(main_article_id, topn=10) # list of (id, similarity)
+    else:
+        # loaded after the served model was built, so it has no vector yet
+        sims = []
+    sims = hydrate(sims) # list of dictionaries, most similar first, with 'score'
+    return render_template("doc.html", main_article=main_article, sims=sims,
+                           authors=get_article_authors(main_article_id),
+                           filters=request.args)
 
-    return render_template("doc.html", main_article=main_article, sims=sort_these)
+@appserver.route('/author/<int:author_id>')
+def author_page(author_id):
+    """
+    An author's latest articles and the authors whose
+    articles are, on average, closest to theirs.
+    """
+    author = get_author(author_id)
+    if author is None:
+        abort(404)
+    with g.timer.stage('similar'):
+        similar = similar_authors(author_id)
+    return render_template("author.html", author=author,
+                           articles=get_articles_by_author(author_id),
+                           similar=similar)
+
+@appserver.route('/authors')
+def find_author():
+    """
+    Look an author up by exact name, as written on arXiv,
+    e.g. /authors?name=Bialek, William
+    """
+    with db_cursor() as cur:
+        cur.execute("SELECT index FROM authors WHERE name=%s",
+                    (request.args.get('name', '').strip(),))
+        row = cur.fetchone()
+    if row is None:
+        abort(404)
+    return redirect(url_for('author_page', author_id=row[0]))
 
 @appserver.route('/search', methods=['POST'])
 def search():
     if request.method == 'POST':
         query = request.form['search']
-        q_vec = model.infer_vector(query.split())
-        results = model.docvecs.most_similar(positive=[q_vec], topn=100)
-        results = [int(r[0]) for r in results]
-        results = get_articles(results)
-        return render_template("search.html", articles=results, q=query)
+        timer = g.timer
+        with timer.stage('tokenize'):
+            # same tokens as training, minus words the model does not know
+            words = g.served.tokenizer(query)
+        if request.form.get('mode') == 'hybrid':
+            ranked = hybrid_search(query, words, timer, topn=100)
+        elif not words:
+            ranked = []
+        elif request.values.get('exact') or get_filters():
+            with timer.stage('infer'):
+                q_vec = g.served.encoder.infer(words)
+            with timer.stage('search'):
+                ranked = nearest(q_vec, topn=100)
+        else:
+            # inferred and scored together with other searches arriving at the same time
+            with timer.stage('infer+search'), waiting_on(g.served.batcher.thread):
+                ranked = g.served.batcher.search(words, topn=100)
+        with timer.stage('hydrate'):
+            results = hydrate(ranked)
+        return render_template("search.html", articles=results, q=query,
+                               filters=request.form, timings=timer.summary())
 
 @appserver.route('/analogy')
 def find_analogy():
@@ -134,18 +532,66 @@ def find_analogy():
     like2 = request.args.get('like2', '') # + woman
     unlike = request.args.get('unlike', '') # - man
 
-    likes = [word.lower() for word in [like1, like2] if word != '']
-    unlike = [word.lower() for word in list(unlike) if word not in ('', '#')]
+    likes = [word.lower() for word in [like1.strip(), like2.strip()] if word != '']
+    unlike = [word.lower() for word in unlike.split() if word != '#']
 
     if not likes and not unlike:
         return render_template("analogy.html", analogies=[], error=False)
     try:
-        analogies = model.most_similar(positive=likes, negative=unlike)
+        with g.timer.stage('analogy'):
+            analogies = g.served.analogies.most_similar(positive=likes, negative=unlike)
         return render_template("analogy.html", analogies=analogies)
-    except:
+    except KeyError:
         return render_template("analogy.html", analogies=[], error=True)
 
 
+def is_word_list(value):
+    """True for a JSON list of strings, e.g. ["king", "woman"]."""
+    return isinstance(value, list) and all(isinstance(word, str) for word in value)
+
+
+@appserver.route('/analogy/batch', methods=['POST'])
+def find_analogies():
+    """
+    Answer many analogy queries at once, scored together.
+
+    Request body, JSON:
+        {"queries": [{"positive": ["king", "woman"], "negative": ["man"]}, ...],
+         "topn": 10}
+
+    Response, one result per query in the same order:
+        {"results": [{"analogies": [["queen", 0.71], ...]},
+                     {"error": "word 'kng' not in vocabulary"}, ...]}
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400)
+    queries = body.get('queries')
+    topn = body.get('topn', 10)
+    if not isinstance(queries, list) or len(queries) > MAX_ANALOGY_BATCH or \
+            not isinstance(topn, int) or isinstance(topn, bool) or not 0 < topn <= 100:
+        abort(400)
+    parsed = []
+    for query in queries:
+        if not isinstance(query, dict):
+            abort(400)
+        positive, negative = query.get('positive', []), query.get('negative', [])
+        # a bare string would otherwise be iterated character by character
+        if not is_word_list(positive) or not is_word_list(negative):
+            abort(400)
+        parsed.append(([word.lower() for word in positive], [word.lower() for word in negative]))
+    queries = parsed
+    with g.timer.stage('analogy'):
+        answers = g.served.analogies.most_similar_batch(queries, topn=topn)
+    results = []
+    for result in answers:
+        if isinstance(result, Exception):
+            results.append({'error': result.args[0]})
+        else:
+            results.append({'analogies': result})
+    return jsonify(results=results)
+
+
 @appserver.route('/viz')
 def viz():
     """
@@ -158,23 +604,182 @@ def viz():
     This is what the louvain template does for
     topics.
 
-    I hope to expand this visualization to
-    articles in each topic.
+    The article-level graph is at /viz/articles.
     """
     csv_dest = url_for('static', filename='subject_distances.csv')
     return render_template("louvain.html", csv_dest=csv_dest)
 
 
-if __name__ == '__main__':
+@appserver.route('/viz/articles')
+def viz_articles():
+    """
+    Zoomable map of all articles, clustered by community.
+    The graph, communities and layout are computed offline by
+    graph.py; the page only fetches the tiles it shows.
+    """
+    if g.served.graph is None:
+        abort(404)
+    return render_template("graph.html")
+
 
+@appserver.route('/viz/tiles/<int:zoom>/<int:tx>/<int:ty>.json')
+def viz_tile(zoom, tx, ty):
+    """
+    One level-of-detail tile of the article graph, see graph.GraphTiles.
+    Article tiles get each article's title.
+    """
+    graph = g.served.graph
+    if graph is None or zoom > 20 or not (0 <= tx < 2 ** zoom and 0 <= ty < 2 ** zoom):
+        abort(404)
+    tile = graph.tile(zoom, tx, ty)
+    if tile['articles']:
+        titles = dict((article['index'], article['title'])
+                      for article in hydrate([(node['id'], 0.) for node in tile['nodes']]))
+        # copy, so the cached tile is not modified
+        tile = dict(tile, nodes=[dict(node, title=titles.get(node['id'], ''))
+                                 for node in tile['nodes']])
+    return jsonify(**tile)
+
+
+@appserver.route('/admin/reload', methods=['POST'])
+def reload_model():
+    """
+    Load a model version in the background and swap it in
+    once it is warm. Requests keep being served meanwhile.
+    Only accepted from the local machine.
+
+    Form fields:
+        version: version under the models directory to load,
+            defaults to its CURRENT version
+    """
+    if request.remote_addr not in LOCAL_ADDRESSES:
+        abort(403)
+    registry.reload_async(version=request.form.get('version'))
+    return jsonify(status='reloading', serving=registry.current.path)
+
+
+@appserver.route('/admin/pool')
+def pool_stats():
+    """
+    Database pool counters, including how long requests
+    have waited for a connection. Only accepted from the local machine.
+    """
+    if request.remote_addr not in LOCAL_ADDRESSES:
+        abort(403)
+    return jsonify(**pool.snapshot())
+
+
+@appserver.route('/metrics')
+def prometheus_metrics():
+    """
+    Prometheus text exposition: histograms of request and
+    stage durations by endpoint, plus the live model's load
+    time and array sizes, database pool counters, cache hit
+    rates and process memory. Only accepted from the
+    addresses in --metrics_allow, the local machine by default.
+    """
+    if request.remote_addr not in metrics_allow:
+        abort(403)
+    served = g.served
+    gauges = [('model_load_seconds', (), served.load_seconds),
+              ('model_loaded_timestamp_seconds', (), registry.loaded_at),
+              ('index_vectors', (), len(served.docvecs))]
+    arrays = [('docvecs', served.docvecs), ('neighbors', served.neighbors),
+              ('analogy_vectors', served.analogies.vectors)]
+    if served.author_index is not None:
+        arrays.append(('author_vectors', served.author_index.vectors))
+    gauges += [('index_bytes', (('array', name),), array.nbytes)
+               for name, array in arrays if array is not None]
+    gauges += [('db_pool_%s' % key, (), value) for key, value in sorted(pool.snapshot().items())]
+    caches = [('articles', article_cache), ('query_tokens', served.tokenizer.cache),
+              ('query_vectors', served.encoder.cache), ('analogies', served.analogies.cache)]
+    for name, cache in caches:
+        labels = (('cache', name),)
+        gauges += [('cache_hits', labels, cache.hits), ('cache_misses', labels, cache.misses),
+                   ('cache_entries', labels, len(cache))]
+    gauges += [('process_memory_mb', (('kind', kind),), mb)
+               for kind, mb in sorted(serving.memory_usage().items())]
+    response = make_response(metrics.render(gauges))
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return response
+
+
+def parse_args(argv=None):
+    """
+    INPUT: list of command line arguments, or None for sys.argv
+
+    OUTPUT: argparse Namespace of settings, as create_app() takes
+    """
     parser = argparse.ArgumentParser(description='Fire up flask server with appropriate model')
-    parser.add_argument('model_path', help="Name of model file")
-    parser.add_argument('port', help="Port to run on", default=5000)
-    args = parser.parse_args()
-
-    # run app in db connection context
-    with psycopg2.connect(dbname='arxiv') as conn:
-        # load model:
-        model = Doc2Vec.load(args.model_path)
-        # appserver.run(host='0.0.0.0', port=int(args.port), debug=True)
-        appserver.run(host='0.0.0.0', port=int(args.port))
+    parser.add_argument('model_path',
+                        help="Name of model file, of a model exported by serving.py, "
+                             "or of a models directory whose CURRENT version is served and followed")
+    parser.add_argument('port', nargs='?', default=5000, help="Port to run on")
+    parser.add_argument('--nprobe', type=int, default=16,
+                        help="IVF buckets scanned per query. Higher is slower but more exact")
+    parser.add_argument('--exact', action='store_true',
+                        help="Skip the IVF index and use brute-force search")
+    parser.add_argument('--codec', choices=sorted(CODECS),
+                        help="Score candidates on compressed docvecs built by quantize.py")
+    parser.add_argument('--rerank', type=int, default=100,
+                        help="Candidates re-ranked with full-precision vectors when --codec is set")
+    parser.add_argument('--poll', type=float, default=10,
+                        help="Seconds between checks of a models directory for a new version")
+    parser.add_argument('--dbname', default='arxiv', help="Name of postgres database")
+    parser.add_argument('--pool_size', type=int, default=10,
+                        help="Most database connections open at once")
+    parser.add_argument('--query_cache', type=int, default=10000,
+                        help="Inferred search query vectors to keep in memory")
+    parser.add_argument('--batch_wait', type=float, default=0.003,
+                        help="Seconds a search waits to be batched with concurrent searches")
+    parser.add_argument('--analogy_vocab', type=int, default=None,
+                        help="Answer analogies with only this many of the most frequent words")
+    parser.add_argument('--profile_slow', type=float, default=None,
+                        help="Sample the stacks of requests slower than this many ms into --profile_log")
+    parser.add_argument('--profile_log', default='slow_requests.log',
+                        help="File slow request stacks are appended to")
+    parser.add_argument('--metrics_allow', default=','.join(LOCAL_ADDRESSES),
+                        help="Comma-separated addresses allowed to read /metrics, "
+                             "e.g. your Prometheus server's")
+    return parser.parse_args(argv)
+
+
+def create_app(config):
+    """
+    INPUT: argparse Namespace from parse_args()
+
+    OUTPUT: the Flask app, with its database pool open and model loaded
+
+    Sets the module's pool, registry and profiler, so call it
+    once per process: from __main__ here, or from wsgi.py in
+    each gunicorn worker.
+    """
+    global pool, registry, profiler, metrics_allow
+    metrics_allow = tuple(address.strip() for address in config.metrics_allow.split(','))
+    options = dict(nprobe=config.nprobe, exact=config.exact, codec=config.codec,
+                   rerank=config.rerank, query_cache=config.query_cache,
+                   batch_wait=config.batch_wait, analogy_vocab=config.analogy_vocab)
+    if config.profile_slow is not None:
+        profiler = SlowRequestProfiler(config.profile_slow, path=config.profile_log)
+    # requests borrow connections from the pool, so they can run concurrently
+    pool = Pool(minconn=2, maxconn=config.pool_size, dbname=config.dbname)
+    listen('subjects_changed', subjects_cache.clear, dbname=config.dbname)
+    listen('articles_changed', article_cache.clear, dbname=config.dbname)
+    # load model:
+    if os.path.isdir(config.model_path):
+        registry = ModelRegistry.from_models_dir(config.model_path, poll_interval=config.poll,
+                                                 **options)
+        registry.watch()
+    else:
+        registry = ModelRegistry(config.model_path, **options)
+    serving.report_memory("Worker ready")
+    return appserver
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    create_app(args)
+    # appserver.run(host='0.0.0.0', port=int(args.port), debug=True)
+    appserver.run(host='0.0.0.0', port=int(args.port), threaded=True)
+    pool.close()
@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import platform
+import threading
+import subprocess
+import multiprocessing
+from datetime import date, timedelta
+from xml.sax.saxutils import escape
+from urllib.parse import urlencode
+from urllib.request import urlopen
+import numpy as np
+from gensim.models.doc2vec import Doc2Vec, TaggedDocument
+from tokenizer import tokenize
+from similarity import ExactIndex, IVFIndex, normalized, recall_at_k, index_path
+from quantize import CODECS, QuantizedIndex
+from registry import ServedModel
+import serving
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'populate_db'))
+import xml_to_postgres
+
+"""
+Benchmark ingestion, training and serving on a synthetic corpus,
+so the effect of a change can be measured and compared.
+
+Example use of this script:
+    $ python benchmark.py results.json --articles 20000
+    $ python benchmark.py results.json --articles 20000 --dbname arxiv_bench
+    $ python benchmark.py after.json --compare before.json
+
+The corpus is generated from --seed, so runs with the same
+options see the same data. Each article belongs to one of
+--subjects subjects; its words are drawn from a Zipf-like
+background distribution mixed with its subject's vocabulary,
+and its docvec from a cluster around its subject's centroid,
+so similarity search has structure to find. Both are written
+to --workdir: one OAI XML file per article, in the format
+populate_db/xml_to_postgres.py parses, and docvecs.npy, with
+the docvec of article i in row i like a trained model's.
+
+Stages, chosen with --stages:
+- ingest: files/s of parsing the XML in a process pool; with
+  --dbname also of xml_to_postgres.py loading it into that
+  database, which should be an empty scratch database
+- tokenize: words/s of tokenizer.tokenize
+- train: words/s of Doc2Vec training on the corpus
+- recall: recall@10 and ms/query of the IVF index at several
+  nprobe, and of each quantized codec, against exact search
+  over the synthetic docvecs
+- serve: p50/p99 latency of /article and /search under
+  --concurrency concurrent clients. Without --url, the work
+  of both routes runs in-process on a ServedModel of the model
+  trained by the train stage, standing in for the app and
+  database; with --url, real requests go to a running app.py
+
+Results, the options and the environment are saved as JSON.
+--compare prints every number next to an earlier run's.
+"""
+
+SYLLABLES = [c + v for c in 'bdfgklmnprstvz' for v in 'aeiou']
+STAGES = ('ingest', 'tokenize', 'train', 'recall', 'serve')
+
+
+def synthetic_words(n, rng):
+    """n distinct made-up words of two to four syllables."""
+    words = set()
+    while len(words) < n:
+        size = rng.randint(2, 5)
+        words.add(''.join(SYLLABLES[i] for i in rng.randint(len(SYLLABLES), size=size)))
+    return sorted(words)
+
+
+def unique_in_order(items):
+    seen = set()
+    return [item for item in items if not (item in seen or seen.add(item))]
+
+
+def synthetic_corpus(n_articles, n_subjects=20, vocab_size=20000, topic_share=0.3, seed=0):
+    """
+    Args:
+        n_articles (int): articles to generate
+        n_subjects (int): subjects they are spread over
+        vocab_size (int): distinct words
+        topic_share (float): share of each article's words drawn
+            from its subject's vocabulary rather than the background
+        seed (int): random seed
+
+    Returns:
+        list: one dict per article with title, authors (list),
+            subject, subject_id, abstract, dates (list) and arxiv_id
+    """
+    rng = np.random.RandomState(seed)
+    vocab = np.array(synthetic_words(vocab_size, rng))
+    # so a word's frequency has nothing to do with its spelling
+    rng.shuffle(vocab)
+    background = 1. / np.arange(1, vocab_size + 1) ** 1.1
+    background /= background.sum()
+    topics = [rng.choice(vocab_size, 200, replace=False) for _ in range(n_subjects)]
+    # own generator, so the first articles are the same whatever n_articles is
+    name_rng = np.random.RandomState(seed + 1)
+    names = synthetic_words(max(10, n_articles // 3), name_rng)
+    name_rng.shuffle(names)
+    authors = ['%s, %s' % (w.capitalize(), w[0].upper()) for w in names]
+    first_day = date(2007, 1, 1)
+
+    def text(subject, n_words, sentence=15):
+        from_topic = rng.rand(n_words) < topic_share
+        ids = rng.choice(vocab_size, n_words, p=background)
+        ids[from_topic] = rng.choice(topics[subject], from_topic.sum())
+        words = list(vocab[ids])
+        for i in range(sentence, n_words, sentence):
+            words[i - 1] += '.'
+        return ' '.join(words)
+
+    articles = []
+    for i in range(n_articles):
+        subject = rng.randint(n_subjects)
+        days = sorted(rng.randint(0, 9 * 365, size=rng.randint(1, 4)))
+        dates = [first_day + timedelta(days=int(d)) for d in days]
+        articles.append({
+            'title': text(subject, rng.randint(6, 14), sentence=100).capitalize(),
+            'authors': [authors[j] for j in
+                        unique_in_order(rng.zipf(1.5, size=rng.randint(1, 6)) % len(authors))],
+            'subject': 'Synthetic - Subject %02d' % subject,
+            'subject_id': subject,
+            'abstract': text(subject, rng.randint(80, 250)),
+            'dates': dates,
+            'arxiv_id': 'http://arxiv.org/abs/%s.%05d' % (dates[0].strftime('%y%m'), i),
+        })
+    return articles
+
+
+def oai_xml(article):
+    """An article in the OAI Dublin Core format harvested from arXiv."""
+    lines = ['<oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" '
+             'xmlns:dc="http://purl.org/dc/elements/1.1/">',
+             ' <dc:title>%s</dc:title>' % escape(article['title'])]
+    lines += [' <dc:creator>%s</dc:creator>' % escape(name) for name in article['authors']]
+    lines += [' <dc:subject>%s</dc:subject>' % escape(article['subject']),
+              ' <dc:description>%s</dc:description>' % escape(article['abstract']),
+              ' <dc:description>Comment: %d pages</dc:description>' % (len(article['abstract']) // 300 + 1)]
+    lines += [' <dc:date>%s</dc:date>' % d.isoformat() for d in article['dates']]
+    lines += [' <dc:type>text</dc:type>',
+              ' <dc:identifier>%s</dc:identifier>' % article['arxiv_id'],
+              ' </oai_dc:dc>']
+    return '\n'.join(lines) + '\n'
+
+
+def synthetic_docvecs(subject_ids, dim=100, spread=0.6, seed=0):
+    """
+    Args:
+        subject_ids (ndarray): subject of each article
+        dim (int): vector size
+        spread (float): noise around the subject centroid,
+            relative to the centroid's length
+        seed (int): random seed
+
+    Returns:
+        ndarray: unit-normalized float32 docvecs, article i in
+            row i + 1; row 0 is unused, as in a trained model
+    """
+    rng = np.random.RandomState(seed)
+    centroids = rng.randn(subject_ids.max() + 1, dim)
+    vectors = centroids[subject_ids] + spread * rng.randn(len(subject_ids), dim)
+    return normalized(np.vstack([np.zeros((1, dim)), vectors]))
+
+
+def write_corpus(articles, docvecs, workdir, options):
+    """
+    Write the XML files and docvecs, unless workdir already
+    holds a corpus generated with the same options.
+
+    Returns:
+        str: directory of the XML files
+    """
+    xml_dir = os.path.join(workdir, 'xml')
+    config_path = os.path.join(workdir, 'corpus.json')
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            if json.load(f) == options:
+                return xml_dir
+    if not os.path.isdir(xml_dir):
+        os.makedirs(xml_dir)
+    for name in os.listdir(xml_dir):
+        os.remove(os.path.join(xml_dir, name))
+    for i, article in enumerate(articles):
+        with open(os.path.join(xml_dir, 'article_%07d.xml' % i), 'w') as f:
+            f.write(oai_xml(article))
+    np.save(os.path.join(workdir, 'docvecs.npy'), docvecs)
+    with open(config_path, 'w') as f:
+        json.dump(options, f)
+    return xml_dir
+
+
+def latency_stats(latencies, seconds, errors=0):
+    """
+    Args:
+        latencies (list): seconds per request
+        seconds (float): wall time of the whole run
+
+    Returns:
+        dict: percentiles in ms, throughput and error count
+    """
+    ms = 1000 * np.array(latencies)
+    if not len(ms):
+        return {'requests': 0, 'errors': errors}
+    return {'requests': len(ms), 'errors': errors,
+            'p50_ms': float(np.percentile(ms, 50)), 'p90_ms': float(np.percentile(ms, 90)),
+            'p99_ms': float(np.percentile(ms, 99)), 'mean_ms': float(ms.mean()),
+            'requests_per_s': len(ms) / seconds}
+
+
+def load_test(call, jobs, concurrency):
+    """
+    Run call(job) for every job from concurrency threads at once.
+
+    Returns:
+        dict: as returned by latency_stats
+    """
+    jobs = list(jobs)
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def worker():
+        while True:
+            with lock:
+                if not jobs:
+                    return
+                job = jobs.pop()
+            start = time.time()
+            try:
+                call(job)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latency_stats(latencies, time.time() - start, errors[0])
+
+
+def bench_ingest(xml_dir, dbname=None, workers=None):
+    paths = sorted(os.path.join(xml_dir, name) for name in os.listdir(xml_dir))
+    pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+    start = time.time()
+    parsed = pool.map(xml_to_postgres.parse_file, paths, chunksize=64)
+    seconds = time.time() - start
+    pool.close()
+    pool.join()
+    result = {'files': len(paths), 'parse_files_per_s': len(paths) / seconds,
+              'parse_failed': sum(1 for row in parsed if row is None)}
+    if dbname:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'populate_db', 'xml_to_postgres.py')
+        command = [sys.executable, script, xml_dir, dbname, '--full',
+                   '--new_indices', os.path.join(os.path.dirname(xml_dir), 'new_indices.txt')]
+        if workers:
+            command += ['--workers', str(workers)]
+        start = time.time()
+        subprocess.check_call(command)
+        result['load_files_per_s'] = len(paths) / (time.time() - start)
+    return result
+
+
+def bench_tokenize(articles, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        words = sum(len(tokenize(a['title'], a['abstract'])) for a in articles)
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    return {'words': words, 'words_per_s': words / best, 'articles_per_s': len(articles) / best}
+
+
+def bench_train(articles, model_path, dim=100, workers=None):
+    documents = [TaggedDocument(tokenize(a['title'], a['abstract']), [i + 1])
+                 for i, a in enumerate(articles)]
+    words = sum(len(doc.words) for doc in documents)
+    start = time.time()
+    model = Doc2Vec(documents=documents, size=dim, workers=workers or multiprocessing.cpu_count())
+    seconds = time.time() - start
+    model.save(model_path)
+    # an index built for an earlier model would not match this one
+    if os.path.exists(index_path(model_path)):
+        os.remove(index_path(model_path))
+    # one pass builds the vocabulary, the others train
+    passes = getattr(model, 'iter', 1)
+    return {'words': words, 'passes': passes, 'seconds': seconds,
+            'words_per_s': words * passes / seconds}
+
+
+def bench_recall(vectors, n_queries=200, nprobes=(1, 4, 16, 64), seed=1):
+    n_queries = min(n_queries, len(vectors) - 1)
+    query_ids = np.random.RandomState(seed).choice(np.arange(1, len(vectors)), n_queries, replace=False)
+    exact = ExactIndex(vectors)
+    start = time.time()
+    for i in query_ids:
+        exact.search(vectors[i], 10, exclude=i)
+    result = {'queries': n_queries, 'exact_ms': 1000 * (time.time() - start) / n_queries}
+
+    n_lists = max(16, int(4 * np.sqrt(len(vectors))))
+    start = time.time()
+    ivf = IVFIndex.build(vectors, n_lists=n_lists)
+    result['ivf_build_s'] = time.time() - start
+    result['ivf_lists'] = n_lists
+    candidates = [('ivf_nprobe%d' % nprobe, ivf, nprobe) for nprobe in nprobes]
+    # pq needs a number of subvectors that divides the vector size
+    m = max(d for d in range(1, 21) if vectors.shape[1] % d == 0)
+    for name in sorted(CODECS):
+        codes = CODECS[name].build(vectors, m=m)
+        candidates.append((name, QuantizedIndex(codes, vectors, rerank=100), None))
+    for name, index, nprobe in candidates:
+        if nprobe is not None:
+            index.nprobe = nprobe
+        start = time.time()
+        for i in query_ids:
+            index.search(vectors[i], 10, exclude=i)
+        ms = 1000 * (time.time() - start) / n_queries
+        result[name] = {'recall_at_10': recall_at_k(index, exact, vectors, query_ids), 'ms': ms}
+    return result
+
+
+def bench_serve(articles, n_requests, concurrency, model_path=None, url=None, seed=2):
+    """
+    /article and /search latency, against url if given,
+    otherwise in-process on a ServedModel of model_path.
+    """
+    rng = np.random.RandomState(seed)
+    ids = rng.randint(1, len(articles) + 1, size=n_requests)
+    queries = [articles[i - 1]['title'] for i in rng.randint(1, len(articles) + 1, size=n_requests)]
+    result = {'concurrency': concurrency, 'mode': 'http' if url else 'in_process'}
+    if url:
+        url = url.rstrip('/')
+
+        def article(index):
+            urlopen('%s/article/%d' % (url, index), timeout=60).read()
+
+        def search(query):
+            urlopen('%s/search' % url, data=urlencode({'search': query}).encode('utf-8'),
+                    timeout=60).read()
+    else:
+        # served like production, through an IVF index built by similarity.py
+        if not os.path.exists(index_path(model_path)):
+            _, vectors = serving.load(model_path)
+            n_lists = max(16, int(4 * np.sqrt(len(vectors))))
+            IVFIndex.build(vectors, n_lists=n_lists).save(index_path(model_path))
+        served = ServedModel(model_path)
+        served.warm()
+
+        def article(index):
+            # what /article does when the neighbor table misses
+            served.index.search(served.docvecs[index], topn=10, exclude=index)
+
+        def search(query):
+            served.batcher.search(served.tokenizer(query), topn=100)
+    result['article'] = load_test(article, ids, concurrency)
+    result['search'] = load_test(search, queries, concurrency)
+    if not url:
+        served.close()
+    return result
+
+
+def environment():
+    import gensim
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count(), 'numpy': np.__version__,
+            'gensim': gensim.__version__}
+
+
+def flatten(results, prefix=''):
+    """{'a': {'b': 1}} -> {'a.b': 1}, numbers only."""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(old, new):
+    """Print every number of two runs' results side by side."""
+    old, new = flatten(old['results']), flatten(new['results'])
+    for key in sorted(set(old) | set(new)):
+        before, after = old.get(key), new.get(key)
+        if before and after:
+            print("%-40s %12.4g %12.4g %7.2fx" % (key, before, after, after / float(before)))
+        else:
+            print("%-40s %12s %12s" % (key, before, after))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='benchmark ingestion, training and serving on a synthetic corpus')
+    parser.add_argument('out', help="JSON file to write results to")
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help="Comma-separated stages to run, of %s" % ', '.join(STAGES))
+    parser.add_argument('--articles', type=int, default=10000, help="Size of the synthetic corpus")
+    parser.add_argument('--subjects', type=int, default=20, help="Subjects articles are spread over")
+    parser.add_argument('--vocab', type=int, default=20000, help="Distinct words in the corpus")
+    parser.add_argument('--dim', type=int, default=100, help="Docvec size")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic corpus")
+    parser.add_argument('--workdir', default='benchmark_data',
+                        help="Where the corpus and trained model are kept between runs")
+    parser.add_argument('--workers', type=int, help="Processes and threads, defaults to all cores")
+    parser.add_argument('--dbname', help="Empty scratch database to also time loading into")
+    parser.add_argument('--url', help="Base URL of a running app.py to load test, "
+                                      "e.g. http://localhost:5000; in-process if not given")
+    parser.add_argument('--requests', type=int, default=2000, help="Requests per route in the serve stage")
+    parser.add_argument('--concurrency', type=int, default=8, help="Concurrent clients in the serve stage")
+    parser.add_argument('--compare', help="Earlier results JSON to print these results against")
+    args = parser.parse_args()
+
+    stages = args.stages.split(',')
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error("unknown stages: %s" % ', '.join(sorted(unknown)))
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+    model_path = os.path.join(args.workdir, 'model')
+
+    corpus_options = {'articles': args.articles, 'subjects': args.subjects,
+                      'vocab': args.vocab, 'dim': args.dim, 'seed': args.seed}
+    start = time.time()
+    articles = synthetic_corpus(args.articles, n_subjects=args.subjects,
+                                vocab_size=args.vocab, seed=args.seed)
+    docvecs = synthetic_docvecs(np.array([a['subject_id'] for a in articles]),
+                                dim=args.dim, seed=args.seed)
+    xml_dir = write_corpus(articles, docvecs, args.workdir, corpus_options)
+    print("Corpus of %d articles ready in %.1fs" % (len(articles), time.time() - start))
+
+    results = {}
+    if 'ingest' in stages:
+        results['ingest'] = bench_ingest(xml_dir, dbname=args.dbname, workers=args.workers)
+    if 'tokenize' in stages:
+        results['tokenize'] = bench_tokenize(articles)
+    if 'train' in stages:
+        results['train'] = bench_train(articles, model_path, dim=args.dim, workers=args.workers)
+    if 'recall' in stages:
+        results['recall'] = bench_recall(docvecs)
+    if 'serve' in stages:
+        if not args.url and not os.path.exists(model_path):
+            parser.error("the in-process serve stage needs the model of the train stage")
+        results['serve'] = bench_serve(articles, args.requests, args.concurrency,
+                                       model_path=model_path, url=args.url)
+    for stage in stages:
+        print("%s: %s" % (stage, json.dumps(results[stage], sort_keys=True)))
+
+    report = {'options': vars(args), 'environment': environment(),
+              'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(start)),
+              'results': results}
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("Results written to %s" % args.out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+from collections import OrderedDict
+
+"""
+Small in-process caches for the web app.
+Safe to share between the threads serving requests.
+"""
+
+
+class LRUCache(object):
+    """
+    Keeps the maxsize most recently used entries.
+    Also counts hits and misses, to judge whether maxsize is right.
+    """
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return default
+
+    def get_many(self, keys):
+        """
+        Returns:
+            dict: {key: value} for the keys that are cached
+        """
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.data:
+                    self.data.move_to_end(key)
+                    found[key] = self.data[key]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class TTLCache(object):
+    """
+    Entries expire ttl seconds after they are stored, or
+    all at once when clear() is called, e.g. on a change notification.
+    """
+    def __init__(self, ttl=300.):
+        self.ttl = ttl
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or entry[0] < time.time():
+                return default
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = (time.time() + self.ttl, value)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+import multiprocessing
+import numpy as np
+import psycopg2
+from gensim.models.doc2vec import TaggedDocument
+from tokenizer import tokenize
+import argparse
+
+"""
+Tokenize the corpus once and keep it on disk, so gensim's
+passes over the data (one for the vocabulary, one per epoch)
+read token ids from a file instead of re-querying postgres
+and re-running the tokenizer each time.
+
+The cache is a directory holding:
+- tokens.int32: every document's token ids, back to back
+- offsets.npy: document k spans tokens[offsets[k]:offsets[k+1]]
+- tags.npy: article index of each document
+- vocab.txt: token of each id, one per line
+- fingerprint.json: state of the articles table when built
+
+xml_to_postgres.py appends articles and updates the title and
+abstract of ones whose files changed. The row count, largest
+index and a checksum of every title and abstract tell when the
+table has changed and the cache must be rebuilt.
+
+Example use of this script:
+    $ python corpus_cache.py arxiv path/to/cache_dir
+"""
+
+def tokenize_batch(rows):
+    """
+    Worker: tokenize a batch of (index, title, abstract) rows.
+    Ids are local to the batch; the parent maps them to global ids.
+
+    Returns:
+        tuple: (tags, lengths, ids, vocab) where vocab lists
+            the batch's distinct tokens in local id order
+    """
+    vocab = {}
+    ids = []
+    lengths = []
+    tags = []
+    for index, title, abstract in rows:
+        words = tokenize(title or '', abstract or '')
+        ids.extend(vocab.setdefault(word, len(vocab)) for word in words)
+        lengths.append(len(words))
+        tags.append(index)
+    local_vocab = sorted(vocab, key=vocab.get)
+    return tags, lengths, np.array(ids, dtype=np.int32), local_vocab
+
+
+def table_fingerprint(conn):
+    """
+    Returns:
+        dict: row count, largest index and a checksum of the
+            tokenized text of the articles table
+    """
+    with conn.cursor() as cur:
+        # sum of the first 32 bits of each article's md5; order does not matter
+        cur.execute("""SELECT count(*), max(index),
+                    coalesce(sum(('x' || left(md5(index || '|' || coalesce(title, '') || '|' ||
+                                                  coalesce(abstract, '')), 8))::bit(32)::int), 0)
+                    FROM articles""")
+        count, max_index, checksum = cur.fetchone()
+    return {'count': count, 'max_index': max_index, 'checksum': int(checksum)}
+
+
+def is_fresh(conn, cache_dir):
+    """True if cache_dir holds a cache built from the current articles table."""
+    path = os.path.join(cache_dir, 'fingerprint.json')
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        return json.load(f) == table_fingerprint(conn)
+
+
+def build(conn, cache_dir, workers=None, batch_size=5000):
+    """
+    Stream articles out of postgres, tokenize them in a process
+    pool, and write the cache. Writes to a temporary directory
+    first, so an interrupted build never leaves a half-written cache.
+
+    Args:
+        conn (connection): open psycopg2 connection
+        cache_dir (str): directory to write the cache to
+        workers (int): tokenizing processes, defaults to all cores
+        batch_size (int): rows per worker task
+    """
+    fingerprint = table_fingerprint(conn)
+    tmp_dir = cache_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    vocab = {}
+    offsets = [0]
+    tags = []
+    workers = workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers)
+    # a named cursor streams rows from the server instead of fetching them all
+    with conn.cursor(name='corpus_cache') as cur, \
+            open(os.path.join(tmp_dir, 'tokens.int32'), 'wb') as tokens:
+        cur.execute("SELECT index, title, abstract FROM articles ORDER BY index")
+        while True:
+            # hand the pool a few batches at a time, so memory stays bounded
+            window = [rows for rows in (cur.fetchmany(batch_size) for _ in range(2 * workers))
+                      if rows]
+            if not window:
+                break
+            for batch_tags, lengths, ids, local_vocab in pool.imap(tokenize_batch, window):
+                remap = np.array([vocab.setdefault(word, len(vocab)) for word in local_vocab],
+                                 dtype=np.int32)
+                remap[ids].tofile(tokens)
+                offsets.extend(offsets[-1] + np.cumsum(lengths))
+                tags.extend(batch_tags)
+            print("tokenized %d articles" % len(tags))
+    pool.close()
+    pool.join()
+
+    np.save(os.path.join(tmp_dir, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, 'tags.npy'), np.array(tags, dtype=np.int32))
+    with open(os.path.join(tmp_dir, 'vocab.txt'), 'w', encoding='utf-8') as f:
+        for word in sorted(vocab, key=vocab.get):
+            f.write(word + '\n')
+    with open(os.path.join(tmp_dir, 'fingerprint.json'), 'w') as f:
+        json.dump(fingerprint, f)
+
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+
+
+def ensure(conn, cache_dir, workers=None):
+    """Build the cache unless an up-to-date one already exists."""
+    if is_fresh(conn, cache_dir):
+        print("Using corpus cache at %s" % cache_dir)
+    else:
+        print("Building corpus cache at %s" % cache_dir)
+        build(conn, cache_dir, workers=workers)
+
+
+class CachedCorpus(object):
+    """
+    Streams TaggedDocuments from a cache built by build().
+    Like DocIterator in train.py, it can be iterated many
+    times; token ids are memory-mapped, not loaded.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, 'vocab.txt'), encoding='utf-8') as f:
+            # object array, so a document's words are one fancy-index away
+            self.vocab = np.array(f.read().splitlines(), dtype=object)
+        self.offsets = np.load(os.path.join(cache_dir, 'offsets.npy'))
+        self.tags = np.load(os.path.join(cache_dir, 'tags.npy'))
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __iter__(self):
+        path = os.path.join(self.cache_dir, 'tokens.int32')
+        if self.offsets[-1] == 0:
+            tokens = np.empty(0, dtype=np.int32)
+        else:
+            tokens = np.memmap(path, dtype=np.int32, mode='r')
+        offsets = self.offsets
+        for k, tag in enumerate(self.tags):
+            words = self.vocab[tokens[offsets[k]:offsets[k + 1]]].tolist()
+            yield TaggedDocument(words, [int(tag)])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='tokenize the articles table into a corpus cache')
+    parser.add_argument('dbname', help="Name of postgres database")
+    parser.add_argument('cache_dir', help="Directory to write the cache to")
+    parser.add_argument('--workers', type=int, help="Tokenizing processes, defaults to all cores")
+    args = parser.parse_args()
+
+    with psycopg2.connect(dbname=args.dbname) as conn:
+        build(conn, args.cache_dir, workers=args.workers)
+    print("Corpus cache can be found at %s" % args.cache_dir)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import time
+import select
+import threading
+from contextlib import contextmanager
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+"""
+Connection pool for the web app.
+
+psycopg2's ThreadedConnectionPool raises as soon as every
+connection is checked out. Pool wraps it with a semaphore so
+callers wait (up to a timeout) instead, and records how long
+they waited. Connections are in autocommit mode, so a failed
+query cannot leave one stuck in an aborted transaction, and a
+connection that errors at the network level is closed and
+replaced rather than returned to the pool.
+
+Example:
+    pool = Pool(dbname='arxiv', minconn=2, maxconn=10)
+    with pool.cursor() as cur:
+        cur.execute("SELECT 1")
+"""
+
+
+class PoolTimeout(Exception):
+    """No connection became free within the pool's timeout."""
+
+
+class Pool(object):
+
+    def __init__(self, minconn=1, maxconn=10, timeout=5., ping_after=30., **connect_kwargs):
+        """
+        Args:
+            minconn (int): connections opened up front
+            maxconn (int): most connections open at once
+            timeout (float): seconds to wait for a free connection
+            ping_after (float): connections idle longer than this
+                are checked with SELECT 1 before being handed out
+            connect_kwargs: passed to psycopg2.connect, e.g. dbname
+        """
+        self.pool = ThreadedConnectionPool(minconn, maxconn, **connect_kwargs)
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.lock = threading.Lock()
+        self.last_used = {}
+        self.stats = {'checkouts': 0, 'in_use': 0, 'wait_seconds_total': 0.,
+                      'wait_seconds_max': 0., 'timeouts': 0, 'reconnects': 0}
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.time() - self.last_used.get(id(conn), 0) < self.ping_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        conn = self.pool.getconn()
+        if not self._healthy(conn):
+            self.pool.putconn(conn, close=True)
+            conn = self.pool.getconn()
+            with self.lock:
+                self.stats['reconnects'] += 1
+        conn.autocommit = True
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the length of a with block.
+
+        Raises:
+            PoolTimeout: if none is free within the timeout
+        """
+        start = time.time()
+        if not self.slots.acquire(timeout=self.timeout):
+            with self.lock:
+                self.stats['timeouts'] += 1
+            raise PoolTimeout("no database connection free after %.1fs" % self.timeout)
+        waited = time.time() - start
+        with self.lock:
+            self.stats['checkouts'] += 1
+            self.stats['in_use'] += 1
+            self.stats['wait_seconds_total'] += waited
+            self.stats['wait_seconds_max'] = max(self.stats['wait_seconds_max'], waited)
+        conn = None
+        broken = False
+        try:
+            conn = self._checkout()
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # the server went away or the socket broke; do not reuse it
+            broken = True
+            raise
+        finally:
+            if conn is not None:
+                broken = broken or bool(conn.closed)
+                if broken:
+                    self.last_used.pop(id(conn), None)
+                else:
+                    self.last_used[id(conn)] = time.time()
+                self.pool.putconn(conn, close=broken)
+            with self.lock:
+                self.stats['in_use'] -= 1
+            self.slots.release()
+
+    @contextmanager
+    def cursor(self, **kwargs):
+        """Borrow a connection and open a cursor on it; kwargs go to conn.cursor()."""
+        with self.connection() as conn:
+            with conn.cursor(**kwargs) as cur:
+                yield cur
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: copy of the pool's counters plus its size
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        stats['size'] = self.maxconn
+        return stats
+
+    def close(self):
+        self.pool.closeall()
+
+
+def listen(channel, callback, poll_timeout=60., **connect_kwargs):
+    """
+    Call callback() whenever something runs NOTIFY on channel.
+    Runs on a daemon thread with its own connection, outside
+    the pool, and reconnects if that connection drops.
+
+    Args:
+        channel (str): postgres notification channel
+        callback (function): called with no arguments
+        connect_kwargs: passed to psycopg2.connect, e.g. dbname
+
+    Returns:
+        Thread: the listening thread
+    """
+    def run():
+        while True:
+            try:
+                conn = psycopg2.connect(**connect_kwargs)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute("LISTEN %s" % channel)
+                while True:
+                    if select.select([conn], [], [], poll_timeout) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        del conn.notifies[:]
+                        callback()
+            except psycopg2.Error as e:
+                print("Lost LISTEN connection for %s: %r" % (channel, e))
+                time.sleep(5)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import re
+import zlib
+
+"""
+Full text of articles, as extracted from their PDFs by
+populate_db/pdf_to_text.py and stored zlib-compressed in the
+`fulltext` table. Paragraphs are separated by a blank line.
+
+A paper's body is some fifty times the length of its abstract,
+and plain text compresses about 3:1, so compressing in the
+extraction workers keeps both the table and the bytes sent
+over the wire to train.py small.
+"""
+
+FORM_FEED = re.compile(r'\f')
+HYPHENATED = re.compile(r'(\w)-\n(\w)')
+BLANK_LINES = re.compile(r'\n\s*\n')
+
+
+def clean(text):
+    """
+    Undo pdftotext's layout: page breaks become paragraph
+    breaks, words hyphenated across lines are rejoined, and
+    each paragraph is put on one line.
+
+    Returns:
+        str: paragraphs separated by a blank line
+    """
+    text = HYPHENATED.sub(r'\1\2', FORM_FEED.sub('\n\n', text))
+    paragraphs = (' '.join(p.split()) for p in BLANK_LINES.split(text))
+    return '\n\n'.join(p for p in paragraphs if p)
+
+
+def compress(text):
+    return zlib.compress(text.encode('utf-8'), 6)
+
+
+def decompress(body):
+    """body is a bytes-like value of a bytea column, e.g. a memoryview."""
+    return zlib.decompress(bytes(body)).decode('utf-8')
+
+
+def paragraphs(text, min_words=50):
+    """
+    Split cleaned text into paragraphs, merging each short one,
+    such as a heading or an equation, into the next, so every
+    chunk has enough context to train on.
+
+    Args:
+        text (str): as returned by clean
+        min_words (int): fewest words in a chunk, except the last
+
+    Yields:
+        str: chunks of one or more paragraphs
+    """
+    chunk = []
+    words = 0
+    for paragraph in text.split('\n\n'):
+        if not paragraph:
+            # text of a PDF pdftotext got nothing out of
+            continue
+        chunk.append(paragraph)
+        words += paragraph.count(' ') + 1
+        if words >= min_words:
+            yield ' '.join(chunk)
+            chunk = []
+            words = 0
+    if chunk:
+        yield ' '.join(chunk)
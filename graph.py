@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+import time
+import numpy as np
+from scipy import sparse
+from similarity import normalized
+from cache import LRUCache
+import argparse
+
+"""
+Article-level similarity graph for /viz/articles.
+
+Everything expensive happens offline:
+1. The kNN graph comes from the neighbor table built by
+   populate_db/cache_neighbors.py, made symmetric.
+2. Louvain community detection groups articles into
+   communities, communities into larger ones, and so on,
+   giving a hierarchy a few levels deep.
+3. Every node of every level gets layout coordinates:
+   the top communities are placed by a 2d PCA of their mean
+   docvecs, and each community's members are placed inside
+   its disc by a PCA of their own vectors, down to articles.
+
+The result is stored next to the model as model.graph.npz and
+served as level-of-detail tiles: the unit square is cut into
+2**zoom x 2**zoom tiles, zoom 0 shows the coarsest communities,
+each zoom level shows one level finer, and the deepest shows
+articles. A tile never holds more than a fixed number of nodes,
+the largest first, so the browser only ever draws a few thousand.
+
+The Louvain implementation is vectorized over scipy.sparse:
+in each sweep every node picks its best neighboring community
+at once, and a random share of the nodes that would gain moves.
+That gives up Louvain's strict node-by-node order, which is
+too slow in Python for 600k articles, for sweeps that are a
+few sparse products each.
+
+Example use of this script:
+    $ python graph.py arxiv path/to/model
+"""
+
+
+def knn_graph(neighbors, scores):
+    """
+    Args:
+        neighbors (ndarray): (n, k) neighbor table, row i holding
+            the k nearest article indices to article i
+        scores (ndarray): (n, k) cosine similarities aligned with it
+
+    Returns:
+        csr_matrix: symmetric adjacency, weighted by similarity.
+            Pairs with similarity <= 0 are left out.
+    """
+    n, k = neighbors.shape
+    rows = np.repeat(np.arange(n), k)
+    cols = np.asarray(neighbors).ravel()
+    weights = np.asarray(scores, dtype=np.float32).ravel()
+    keep = (weights > 0) & (cols != rows)
+    A = sparse.coo_matrix((weights[keep], (rows[keep], cols[keep])), shape=(n, n)).tocsr()
+    return A.maximum(A.T).tocsr()
+
+
+def membership(labels, n_communities):
+    """Sparse (nodes x communities) 0/1 matrix of a partition."""
+    n = len(labels)
+    return sparse.csr_matrix((np.ones(n, dtype=np.float32), (np.arange(n), labels)),
+                             shape=(n, n_communities))
+
+
+def modularity(A, labels):
+    """
+    Args:
+        A (csr_matrix): symmetric adjacency, self-loops allowed
+        labels (ndarray): community of each node
+
+    Returns:
+        float: Newman modularity of the partition
+    """
+    P = membership(labels, labels.max() + 1)
+    inner = P.T.dot(A).dot(P).diagonal().sum()
+    sigma = np.asarray(P.T.dot(np.asarray(A.sum(axis=1)).ravel())).ravel()
+    m2 = sigma.sum()
+    return float((inner - (sigma ** 2).sum() / m2) / m2)
+
+
+def compact(labels):
+    """Renumber labels to 0..K-1."""
+    return np.unique(labels, return_inverse=True)[1]
+
+
+def louvain_level(A, max_sweeps=30, min_fraction=0.5, min_moved=1e-3, seed=0):
+    """
+    Local-moving phase of Louvain on one level of the graph.
+
+    Args:
+        A (csr_matrix): symmetric adjacency
+        max_sweeps (int): most passes over all nodes
+        min_fraction (float): every improving node moves in the
+            first sweep, which merges fastest; the share that moves
+            then decays to this, so nodes stop chasing each other
+            between communities
+        min_moved (float): stop once fewer than this share of nodes move
+        seed (int): random seed, so runs are reproducible
+
+    Returns:
+        ndarray: community of each node, numbered 0..K-1
+    """
+    rng = np.random.RandomState(seed)
+    n = A.shape[0]
+    degree = np.asarray(A.sum(axis=1)).ravel()
+    m2 = degree.sum()
+    self_loops = A.diagonal()
+    labels = np.arange(n)
+    for sweep in range(max_sweeps):
+        K = labels.max() + 1
+        sigma = np.bincount(labels, weights=degree, minlength=K)
+        # links from every node to every community it touches
+        links = A.dot(membership(labels, K)).tocoo()
+        i, c, w = links.row, links.col, links.data.astype(np.float64)
+        own = c == labels[i]
+        # gain of joining c, with node i itself taken out of its own community
+        gain = (w - np.where(own, self_loops[i], 0) -
+                degree[i] * (sigma[c] - np.where(own, degree[i], 0)) / m2)
+        stay = -degree * (sigma[labels] - degree) / m2
+        stay[i[own]] = gain[own]
+
+        # best other community of each node: sort by node, then gain
+        order = np.lexsort((-gain[~own], i[~own]))
+        i, c, gain = i[~own][order], c[~own][order], gain[~own][order]
+        first = np.concatenate([[True], i[1:] != i[:-1]])[:len(i)]
+        best = labels.copy()
+        best_gain = np.full(n, -np.inf)
+        best[i[first]] = c[first]
+        best_gain[i[first]] = gain[first]
+
+        share = max(min_fraction, 1. - 0.05 * sweep)
+        move = (best_gain > stay + 1e-12) & (rng.rand(n) < share)
+        if move.sum() < max(1, min_moved * n):
+            if move.any():
+                labels[move] = best[move]
+            break
+        labels[move] = best[move]
+        labels = compact(labels)
+    return compact(labels)
+
+
+def louvain(A, max_levels=6, min_gain=1e-4, seed=0):
+    """
+    Args:
+        A (csr_matrix): symmetric adjacency over articles
+        max_levels (int): most levels of communities
+        min_gain (float): stop adding levels once modularity
+            improves by less than this
+
+    Returns:
+        list: one array per level; levels[0] maps articles to their
+            communities, levels[l] maps level-l communities to
+            level-(l+1) communities
+    """
+    levels = []
+    quality = modularity(A, np.arange(A.shape[0]))
+    while len(levels) < max_levels:
+        labels = louvain_level(A, seed=seed + len(levels))
+        n_communities = labels.max() + 1
+        if n_communities == A.shape[0]:
+            break
+        P = membership(labels, n_communities)
+        A = P.T.dot(A).dot(P).tocsr()
+        new_quality = modularity(A, np.arange(n_communities))
+        levels.append(labels)
+        print("level %d: %d communities, modularity %.3f" % (
+            len(levels), n_communities, new_quality))
+        if new_quality - quality < min_gain:
+            break
+        quality = new_quality
+    return levels
+
+
+def pca_2d(vectors):
+    """
+    Returns:
+        ndarray: (n, 2) projection of vectors onto their two
+            principal axes, centered on their mean
+    """
+    centered = vectors - vectors.mean(axis=0)
+    if len(vectors) < 2:
+        return np.zeros((len(vectors), 2))
+    _, _, axes = np.linalg.svd(centered, full_matrices=False)
+    projected = np.zeros((len(vectors), 2))
+    projected[:, :min(2, len(axes))] = centered.dot(axes[:2].T)
+    return projected
+
+
+def separate(xy, radius, n_iter=50):
+    """
+    Push apart overlapping discs, a few nudges at a time.
+    Quadratic in the number of discs, so only used on the top level.
+    """
+    xy = xy.copy()
+    for _ in range(n_iter):
+        delta = xy[:, np.newaxis, :] - xy[np.newaxis, :, :]
+        dist = np.sqrt((delta ** 2).sum(axis=2)) + 1e-9
+        overlap = radius[:, np.newaxis] + radius[np.newaxis, :] - dist
+        np.fill_diagonal(overlap, 0)
+        overlap = np.maximum(overlap, 0)
+        if not overlap.any():
+            break
+        xy += 0.5 * (delta / dist[:, :, np.newaxis] * overlap[:, :, np.newaxis]).sum(axis=1)
+        xy = np.clip(xy, radius[:, np.newaxis], 1 - radius[:, np.newaxis])
+    return xy
+
+
+def place_children(parent_xy, parent_radius, parents, vectors, sizes):
+    """
+    Lay out one level inside the discs of the level above.
+
+    Args:
+        parent_xy (ndarray): (P, 2) centers of the parents
+        parent_radius (ndarray): (P,) radii of the parents
+        parents (ndarray): parent of each child
+        vectors (ndarray): (C, d) vector of each child
+        sizes (ndarray): (C,) articles under each child
+
+    Returns:
+        tuple: (xy, radius) of the children
+    """
+    parent_sizes = np.bincount(parents, weights=sizes, minlength=len(parent_xy))
+    # children cover most of their parent's area
+    radius = 0.8 * parent_radius[parents] * np.sqrt(sizes / parent_sizes[parents])
+    xy = parent_xy[parents].astype(np.float64)
+    order = np.argsort(parents, kind='mergesort')
+    starts = np.flatnonzero(np.concatenate([[True], parents[order][1:] != parents[order][:-1]]))
+    for start, end in zip(starts, np.append(starts[1:], len(order))):
+        members = order[start:end]
+        if len(members) < 2:
+            continue
+        projected = pca_2d(vectors[members])
+        extent = np.sqrt((projected ** 2).sum(axis=1)).max()
+        if extent > 0:
+            room = np.maximum(parent_radius[parents[members[0]]] - radius[members], 0)
+            xy[members] += projected / extent * room[:, np.newaxis]
+    return xy, radius
+
+
+def strongest_edges(A, k):
+    """
+    Keep each node's k heaviest edges, dropping self-loops.
+
+    Returns:
+        csr_matrix
+    """
+    A = A.tocoo()
+    keep = A.row != A.col
+    row, col, weight = A.row[keep], A.col[keep], A.data[keep]
+    order = np.lexsort((-weight, row))
+    row, col, weight = row[order], col[order], weight[order]
+    starts = np.searchsorted(row, np.arange(A.shape[0]))
+    rank = np.arange(len(row)) - starts[row]
+    keep = rank < k
+    return sparse.csr_matrix((weight[keep], (row[keep], col[keep])), shape=A.shape)
+
+
+def build_layers(A, levels, vectors, ids, subject_codes, edge_k=5):
+    """
+    Turn the hierarchy into drawable layers, coarsest first.
+
+    Args:
+        A (csr_matrix): article adjacency
+        levels (list): from louvain()
+        vectors (ndarray): normalized docvec of each node of A
+        ids (ndarray): article index of each node of A
+        subject_codes (ndarray): subject of each node of A, as an int
+        edge_k (int): edges kept per node
+
+    Returns:
+        list: one dict of arrays per layer, with ids, x, y, r,
+            size, parent (position in the layer above, -1 at the
+            top), label (subject code) and the edges in CSR form
+    """
+    n_subjects = subject_codes.max() + 1
+    graphs = [A]
+    sums = [vectors.astype(np.float64)]
+    sizes = [np.ones(A.shape[0])]
+    # articles of each subject under each node, to label communities
+    # with their most common subject
+    counts = sparse.csr_matrix((np.ones(len(ids)), (np.arange(len(ids)), subject_codes)),
+                               shape=(len(ids), n_subjects))
+    labels_of = [subject_codes]
+    for labels in levels:
+        P = membership(labels, labels.max() + 1)
+        graphs.append(P.T.dot(graphs[-1]).dot(P).tocsr())
+        sums.append(np.asarray(P.T.dot(sums[-1])))
+        sizes.append(np.asarray(P.T.dot(sizes[-1])).ravel())
+        counts = P.T.dot(counts).tocsr()
+        labels_of.append(counts.toarray().argmax(axis=1))
+
+    # top level: PCA of the community vectors, discs sized by articles
+    top = len(levels)
+    xy = pca_2d(normalized(sums[top]))
+    radius = np.sqrt(0.5 * sizes[top] / (np.pi * sizes[top].sum()))
+    span = np.abs(xy).max() or 1.
+    xy = 0.5 + xy / span * (0.5 - radius.max())
+    layouts = {top: (separate(xy, radius) if len(xy) <= 2000 else xy, radius)}
+    for level in range(top - 1, -1, -1):
+        parent_xy, parent_radius = layouts[level + 1]
+        layouts[level] = place_children(parent_xy, parent_radius, levels[level],
+                                        normalized(sums[level]), sizes[level])
+
+    layers = []
+    for level in range(top, -1, -1):
+        xy, radius = layouts[level]
+        edges = strongest_edges(graphs[level], edge_k)
+        layers.append({
+            'ids': ids if level == 0 else np.arange(len(sizes[level])),
+            'x': xy[:, 0].astype(np.float32),
+            'y': xy[:, 1].astype(np.float32),
+            'r': radius.astype(np.float32),
+            'size': sizes[level].astype(np.int32),
+            'parent': levels[level] if level < top else np.full(len(sizes[level]), -1, dtype=np.int64),
+            'label': labels_of[level].astype(np.int32),
+            'indptr': edges.indptr,
+            'indices': edges.indices.astype(np.int32),
+            'weights': edges.data.astype(np.float32),
+        })
+    return layers
+
+
+def save(path, layers, subject_names):
+    arrays = {'subjects': np.array(subject_names), 'n_layers': np.array(len(layers))}
+    for t, layer in enumerate(layers):
+        for key, value in layer.items():
+            arrays['layer%d_%s' % (t, key)] = value
+    np.savez(path, **arrays)
+
+
+class GraphTiles(object):
+    """
+    Serves the layers written by save() as level-of-detail tiles.
+    """
+    FIELDS = ('ids', 'x', 'y', 'r', 'size', 'parent', 'label', 'indptr', 'indices', 'weights')
+
+    def __init__(self, path, max_nodes=1000):
+        """
+        Args:
+            path (str): file written by save()
+            max_nodes (int): most nodes in one tile
+        """
+        data = np.load(path)
+        self.subjects = data['subjects'].tolist()
+        self.max_nodes = max_nodes
+        # tiles never change for a given file, so popular ones are kept
+        self.cache = LRUCache(maxsize=2000)
+        self.layers = []
+        for t in range(int(data['n_layers'])):
+            layer = dict((key, data['layer%d_%s' % (t, key)]) for key in self.FIELDS)
+            # largest nodes first, so a full tile keeps the most important ones
+            layer['order'] = np.argsort(-layer['size'], kind='mergesort')
+            self.layers.append(layer)
+
+    def tile(self, zoom, tx, ty):
+        """
+        Args:
+            zoom (int): 0 shows the whole map in one tile
+            tx, ty (int): tile column and row, in [0, 2**zoom)
+
+        Returns:
+            dict: the layer shown at this zoom, its nodes whose
+                centers fall in the tile and the edges between them
+        """
+        key = (zoom, tx, ty)
+        tile = self.cache.get(key)
+        if tile is None:
+            tile = self._tile(zoom, tx, ty)
+            self.cache.put(key, tile)
+        return tile
+
+    def _tile(self, zoom, tx, ty):
+        t = min(zoom, len(self.layers) - 1)
+        layer = self.layers[t]
+        width = 1. / 2 ** zoom
+        x0, y0 = tx * width, ty * width
+        inside = ((layer['x'] >= x0) & (layer['x'] < x0 + width) &
+                  (layer['y'] >= y0) & (layer['y'] < y0 + width))
+        order = layer['order']
+        selected = order[inside[order]]
+        truncated = len(selected) > self.max_nodes
+        selected = selected[:self.max_nodes]
+
+        chosen = np.zeros(len(layer['x']), dtype=bool)
+        chosen[selected] = True
+        edges = []
+        indptr, indices, weights = layer['indptr'], layer['indices'], layer['weights']
+        for node in selected:
+            for j in range(indptr[node], indptr[node + 1]):
+                other = indices[j]
+                # each undirected edge once
+                if chosen[other] and (node < other or not self._has_edge(layer, other, node)):
+                    edges.append((int(layer['ids'][node]), int(layer['ids'][other]),
+                                  round(float(weights[j]), 3)))
+        nodes = [{'id': int(layer['ids'][i]),
+                  'x': round(float(layer['x'][i]), 6), 'y': round(float(layer['y'][i]), 6),
+                  'r': round(float(layer['r'][i]), 6), 'size': int(layer['size'][i]),
+                  'parent': int(layer['parent'][i]),
+                  'label': self.subjects[layer['label'][i]]}
+                 for i in selected]
+        return {'zoom': zoom, 'layer': t, 'articles': t == len(self.layers) - 1,
+                'nodes': nodes, 'edges': edges, 'truncated': truncated}
+
+    @staticmethod
+    def _has_edge(layer, a, b):
+        start, end = layer['indptr'][a], layer['indptr'][a + 1]
+        return b in layer['indices'][start:end]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='build the article graph shown by /viz/articles')
+    parser.add_argument('dbname', help="Name of postgres database")
+    parser.add_argument('path_to_model', help="Trained or exported Doc2Vec model")
+    parser.add_argument('--edge_k', type=int, default=5, help="Edges kept per node and level")
+    args = parser.parse_args()
+
+    # imported here so GraphTiles and the layout need neither gensim nor a database driver
+    import psycopg2
+    import serving
+    neighbors_file = serving.neighbors_path(args.path_to_model)
+    try:
+        neighbors = np.load(neighbors_file, mmap_mode='r')
+    except IOError:
+        raise SystemExit("No neighbor table at %s; run populate_db/cache_neighbors.py first" %
+                         neighbors_file)
+    scores = np.load(serving.scores_path(args.path_to_model), mmap_mode='r')
+    model, vectors = serving.load(args.path_to_model)
+
+    start = time.time()
+    A = knn_graph(neighbors, scores)
+    # rows with no article (e.g. row 0) have no edges; leave them out
+    ids = np.flatnonzero(np.asarray(A.sum(axis=1)).ravel() > 0)
+    A = A[ids][:, ids].tocsr()
+    print("kNN graph: %d articles, %d edges in %.1fs" % (len(ids), A.nnz // 2, time.time() - start))
+
+    subject_of = {}
+    with psycopg2.connect(dbname=args.dbname) as conn:
+        with conn.cursor(name='graph_subjects') as cur:
+            cur.execute("SELECT index, subject FROM articles")
+            for index, subject in cur:
+                subject_of[index] = subject or ''
+    subject_names = sorted(set(subject_of.values()) | set(['']))
+    codes = dict((name, j) for j, name in enumerate(subject_names))
+    subject_codes = np.array([codes[subject_of.get(int(i), '')] for i in ids], dtype=np.int32)
+
+    start = time.time()
+    levels = louvain(A)
+    print("Louvain in %.1fs" % (time.time() - start))
+
+    start = time.time()
+    layers = build_layers(A, levels, np.asarray(vectors[ids]), ids, subject_codes,
+                          edge_k=args.edge_k)
+    save(serving.graph_path(args.path_to_model), layers, subject_names)
+    print("Layout of %s nodes in %.1fs, written to %s" % (
+        ' / '.join(str(len(layer['x'])) for layer in layers), time.time() - start,
+        serving.graph_path(args.path_to_model)))
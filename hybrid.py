@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from similarity import normalized
+
+"""
+Hybrid search: postgres full-text search picks the candidates,
+docvec similarity re-ranks them, and the two rankings are fused.
+
+infer_vector handles topical queries well but knows nothing of
+author names, arXiv ids or acronyms too rare to be in the
+vocabulary; full-text search is the opposite. Fusing ranks
+rather than raw scores means ts_rank's unbounded scale and
+cosine similarity never have to be calibrated against each
+other. Only the lexical candidates are scored, so the vector
+stage touches a few hundred rows instead of the whole corpus.
+
+The search_vector column and its GIN index are created by
+populate_db/xml_to_postgres.py.
+"""
+
+# matches if the words match after english stemming, or exactly,
+# which is what names and arXiv ids need
+LEXICAL_QUERY = """
+    SELECT index, ts_rank_cd(search_vector, query) AS rank
+    FROM articles,
+         (SELECT plainto_tsquery('english', %s) || plainto_tsquery('simple', %s) AS query) q
+    WHERE search_vector @@ query
+    ORDER BY rank DESC
+    LIMIT %s"""
+
+
+def lexical_candidates(cur, text, limit=1000):
+    """
+    Args:
+        cur (cursor): open psycopg2 cursor
+        text (str): query as typed
+        limit (int): most candidates to return
+
+    Returns:
+        tuple: (ids, ranks) arrays, best lexical match first
+    """
+    cur.execute(LEXICAL_QUERY, (text, text, limit))
+    rows = cur.fetchall()
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    ranks = np.array([row[1] for row in rows], dtype=np.float32)
+    return ids, ranks
+
+
+def vector_scores(vectors, query, ids):
+    """
+    Cosine similarity of query to each candidate. Candidates
+    without a row in vectors, i.e. ingested since the model was
+    last updated, get -inf so they rank last on this signal.
+
+    Args:
+        vectors (ndarray): unit-normalized docvecs
+        query (ndarray): 1d query vector
+        ids (ndarray): candidate article indices
+
+    Returns:
+        ndarray: scores aligned with ids
+    """
+    query = normalized(query[np.newaxis, :])[0]
+    scores = np.full(len(ids), -np.inf, dtype=np.float32)
+    known = ids < len(vectors)
+    scores[known] = np.dot(vectors[ids[known]], query)
+    return scores
+
+
+def ranks_of(scores):
+    """1-based rank of each score, highest first."""
+    ranks = np.empty(len(scores), dtype=np.int64)
+    ranks[np.argsort(-scores, kind='mergesort')] = np.arange(1, len(scores) + 1)
+    return ranks
+
+
+def fuse(ids, lexical, vector=None, weight=0.5, k=60, topn=100):
+    """
+    Weighted reciprocal rank fusion:
+        score = (1 - weight) / (k + lexical rank) + weight / (k + vector rank)
+
+    Args:
+        ids (ndarray): candidate article indices
+        lexical (ndarray): lexical scores aligned with ids
+        vector (ndarray): vector scores aligned with ids, or None
+            if the query had no words the model knows
+        weight (float): share of the vector signal, in [0, 1]
+        k (int): damping; larger k flattens the difference
+            between the top few ranks
+        topn (int): number of results
+
+    Returns:
+        list: (index, fused score) tuples, best first
+    """
+    if not len(ids):
+        return []
+    fused = (1. - weight) / (k + ranks_of(lexical))
+    if vector is not None:
+        fused += weight / (k + ranks_of(vector))
+    best = np.argsort(-fused, kind='mergesort')[:topn]
+    return [(int(ids[i]), float(fused[i])) for i in best]
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import zlib
+import time
+import queue
+import threading
+import numpy as np
+from cache import LRUCache
+from similarity import search_batch
+
+"""
+Query embedding for /search.
+
+infer_vector runs several epochs of SGD in Python for every
+query, so repeated queries are worth caching. gensim seeds the
+starting vector from hash(), which differs between processes,
+and draws window sizes from model.random. QueryEncoder fixes both,
+so the same tokens always give the same vector and the cache
+returns what a fresh inference would.
+
+SearchBatcher collects searches that arrive within a few
+milliseconds of each other on one thread, infers their vectors,
+and scores them all against the docvecs in one matrix multiply.
+"""
+
+
+def stable_hash(string):
+    """Replacement for gensim's default hashfxn that is the same in every process."""
+    return zlib.crc32(string.encode('utf-8'))
+
+
+class QueryEncoder(object):
+    """
+    Deterministic, cached infer_vector.
+    """
+    def __init__(self, model, cache_size=10000, seed=1):
+        """
+        Args:
+            model (Doc2Vec): model to infer with
+            cache_size (int): query vectors to keep
+            seed (int): seed for model.random before each inference
+        """
+        self.model = model
+        self.model.hashfxn = stable_hash
+        self.seed = seed
+        self.cache = LRUCache(maxsize=cache_size)
+        # model.random is shared state, so inferences take turns
+        self.lock = threading.Lock()
+
+    def infer(self, words):
+        """
+        Args:
+            words (list): query tokens
+
+        Returns:
+            ndarray: inferred vector
+        """
+        key = tuple(words)
+        vector = self.cache.get(key)
+        if vector is None:
+            with self.lock:
+                self.model.random = np.random.RandomState(self.seed)
+                vector = self.model.infer_vector(list(words))
+            self.cache.put(key, vector)
+        return vector
+
+
+class SearchBatcher(object):
+    """
+    Groups concurrent searches on one worker thread.
+    """
+    def __init__(self, encoder, index, max_batch=32, max_wait=0.003):
+        """
+        Args:
+            encoder (QueryEncoder): turns tokens into vectors
+            index: similarity index to search, e.g. ExactIndex
+            max_batch (int): most queries scored together
+            max_wait (float): seconds to wait for more queries
+                once the first one of a batch has arrived
+        """
+        self.encoder = encoder
+        self.index = index
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def search(self, words, topn=100):
+        """
+        Blocks until the batch holding this query has been scored.
+
+        Returns:
+            list: (index, similarity) tuples, most similar first
+        """
+        job = {'words': words, 'topn': topn, 'done': threading.Event()}
+        self.queue.put(job)
+        job['done'].wait()
+        if 'error' in job:
+            raise job['error']
+        return job['result']
+
+    def close(self):
+        """Stop the worker thread once queued searches are done."""
+        self.queue.put(None)
+
+    def _next_batch(self):
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        # the first caller waits at most max_wait, however many join it
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                job = self.queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if job is None:
+                # finish this batch, then stop
+                self.queue.put(None)
+                break
+            batch.append(job)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                queries = np.array([self.encoder.infer(job['words']) for job in batch])
+                topn = max(job['topn'] for job in batch)
+                results = search_batch(self.index, queries, topn)
+                for job, result in zip(batch, results):
+                    job['result'] = result[:job['topn']]
+            except Exception as e:
+                for job in batch:
+                    job['error'] = e
+            for job in batch:
+                job['done'].set()
@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+import numpy as np
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from similarity import normalized
+
+"""
+Precompute one vector per author, the normalized mean of the
+docvecs of their articles, so app.py can answer "authors
+similar to X" with one matrix-vector product over a small
+in-memory matrix instead of aggregating articles per request.
+
+Example use of this script:
+    $ python cache_author_vectors.py arxiv path/to/model --min_articles 2
+
+writes two arrays next to the model:
+- model.author_ids.npy: int32 authors.index of each row, ascending
+- model.author_vectors.npy: float32 unit-normalized mean docvecs
+
+Authors with fewer than min_articles articles are left out;
+one-paper authors are the majority on arXiv, and their vector
+is just that paper's. Needs the article_authors table, see
+make_authors_table.py. Articles added by update_model.py count
+once this script is re-run for the new version.
+"""
+
+
+def author_vectors(author_ids, article_ids, vectors, min_articles=2, block_authors=10000):
+    """
+    Args:
+        author_ids (ndarray): author of each (author, article) pair
+        article_ids (ndarray): article of each pair, a row of vectors
+        vectors (ndarray): unit-normalized docvecs
+        min_articles (int): fewest articles an author needs
+        block_authors (int): authors summed at a time, which bounds
+            memory to about their article count times the vector size
+
+    Returns:
+        tuple: (ids, author vectors), ids ascending
+    """
+    # articles ingested since the model was last updated have no vector yet
+    known = article_ids < len(vectors)
+    author_ids, article_ids = author_ids[known], article_ids[known]
+    order = np.argsort(author_ids, kind='mergesort')
+    author_ids, article_ids = author_ids[order], article_ids[order]
+    counts = np.bincount(author_ids)
+    keep = counts[author_ids] >= min_articles
+    author_ids, article_ids = author_ids[keep], article_ids[keep]
+    if not len(author_ids):
+        return np.empty(0, dtype=np.int32), np.empty((0, vectors.shape[1]), dtype=np.float32)
+
+    starts = np.flatnonzero(np.concatenate([[True], author_ids[1:] != author_ids[:-1]]))
+    ends = np.append(starts[1:], len(author_ids))
+    sums = np.empty((len(starts), vectors.shape[1]), dtype=np.float32)
+    for block in range(0, len(starts), block_authors):
+        first, last = starts[block], ends[min(block + block_authors, len(starts)) - 1]
+        sums[block:block + block_authors] = np.add.reduceat(
+            vectors[article_ids[first:last]], starts[block:block + block_authors] - first, axis=0)
+    # the mean and the sum point the same way, so normalizing the sum is enough
+    return author_ids[starts].astype(np.int32), normalized(sums)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="precompute mean docvec of every author")
+    parser.add_argument('dbname', help="Name of postgres database")
+    parser.add_argument('path_to_model', help="Trained or exported Doc2Vec model")
+    parser.add_argument('--min_articles', type=int, default=2,
+                        help="Leave out authors with fewer articles than this")
+    args = parser.parse_args()
+
+    # imported here so author_vectors() needs neither gensim nor a database driver
+    import psycopg2
+    import serving
+    start = time.time()
+    model, vectors = serving.load(args.path_to_model)
+    with psycopg2.connect(dbname=args.dbname) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT author_id, article_id FROM article_authors")
+            pairs = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 2)
+    ids, author_vecs = author_vectors(pairs[:, 0], pairs[:, 1], vectors,
+                                      min_articles=args.min_articles)
+    np.save(serving.author_ids_path(args.path_to_model), ids)
+    np.save(serving.author_vectors_path(args.path_to_model), author_vecs)
+    print("%d author vectors from %d authorships in %.1fs" % (
+        len(ids), len(pairs), time.time() - start))
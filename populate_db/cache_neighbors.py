@@ -0,0 +1,147 @@
+import os
+import sys
+import time
+import multiprocessing
+import numpy as np
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+"""
+Precompute the top k neighbors of every article, so the
+/article route can look them up instead of searching.
+
+Example use of this script:
+    $ python cache_neighbors.py path/to/model --k 20
+
+writes two arrays next to the model:
+- model.neighbors.npy: int32, row i holds the k nearest
+  article indices to article i, most similar first
+- model.neighbor_scores.npy: float16 cosine similarities
+  aligned with the above
+
+The similarity matrix is never held in memory. Each worker
+takes a block of rows, multiplies it against one tile of
+columns at a time, and keeps a running top k per row.
+Peak memory per worker is about block_rows * block_cols * 4 bytes.
+
+Tip: numpy's BLAS may start its own threads in every worker.
+Run with OMP_NUM_THREADS=1 (or OPENBLAS_NUM_THREADS=1)
+to avoid oversubscribing the cores.
+"""
+
+
+def merge_top_k(best_ids, best_scores, ids, scores, k):
+    """
+    Merge a tile's scores into the running top k of each row.
+
+    Args:
+        best_ids, best_scores (ndarray): running top k, shape (rows, k)
+        ids (ndarray): column indices of the tile, shape (cols,)
+        scores (ndarray): tile scores, shape (rows, cols)
+        k (int): neighbors to keep
+
+    Returns:
+        tuple: (best_ids, best_scores), unsorted within each row
+    """
+    rows = np.arange(len(scores))[:, np.newaxis]
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = scores[rows, part]
+        ids = ids[part]
+    else:
+        ids = np.broadcast_to(ids, scores.shape)
+    all_scores = np.hstack([best_scores, scores])
+    all_ids = np.hstack([best_ids, ids])
+    part = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+    return all_ids[rows, part], all_scores[rows, part]
+
+
+def process_block(job):
+    """
+    Compute the top k neighbors for rows [start, end)
+    and write them straight into the output arrays.
+    Runs in a worker process; all arrays are memory-mapped.
+    """
+    vectors_file, out_ids_file, out_scores_file, start, end, k, block_cols = job
+    vectors = np.load(vectors_file, mmap_mode='r')
+    block = np.asarray(vectors[start:end])
+    n_rows = end - start
+    best_ids = np.full((n_rows, k), -1, dtype=np.int64)
+    best_scores = np.full((n_rows, k), -np.inf, dtype=np.float32)
+    rows = np.arange(n_rows)
+
+    for col_start in range(0, len(vectors), block_cols):
+        col_end = min(col_start + block_cols, len(vectors))
+        scores = np.dot(block, np.asarray(vectors[col_start:col_end]).T)
+        # an article is not its own neighbor
+        self_cols = np.arange(start, end) - col_start
+        on_tile = (self_cols >= 0) & (self_cols < col_end - col_start)
+        scores[rows[on_tile], self_cols[on_tile]] = -np.inf
+        best_ids, best_scores = merge_top_k(
+            best_ids, best_scores, np.arange(col_start, col_end), scores, k)
+
+    order = np.argsort(-best_scores, axis=1)
+    out_ids = np.load(out_ids_file, mmap_mode='r+')
+    out_scores = np.load(out_scores_file, mmap_mode='r+')
+    out_ids[start:end] = best_ids[rows[:, np.newaxis], order]
+    out_scores[start:end] = best_scores[rows[:, np.newaxis], order]
+    out_ids.flush()
+    out_scores.flush()
+    return end - start
+
+
+def cache_neighbors(vectors_file, out_ids_file, out_scores_file, k=20,
+                    block_rows=512, block_cols=32768, n_workers=None):
+    """
+    Fill the neighbor arrays for every row of a .npy docvec file.
+
+    Args:
+        vectors_file (str): .npy of unit-normalized docvecs
+        out_ids_file (str): .npy to write neighbor indices to
+        out_scores_file (str): .npy to write similarities to
+        k (int): neighbors per article
+        block_rows (int): rows handed to a worker at a time
+        block_cols (int): columns scored at a time within a block
+        n_workers (int): processes to use, defaults to all cores
+    """
+    n_docs = len(np.load(vectors_file, mmap_mode='r'))
+    np.lib.format.open_memmap(out_ids_file, mode='w+', dtype=np.int32, shape=(n_docs, k))
+    np.lib.format.open_memmap(out_scores_file, mode='w+', dtype=np.float16, shape=(n_docs, k))
+
+    jobs = [(vectors_file, out_ids_file, out_scores_file,
+             start, min(start + block_rows, n_docs), k, block_cols)
+            for start in range(0, n_docs, block_rows)]
+    pool = multiprocessing.Pool(n_workers or multiprocessing.cpu_count())
+    done = 0
+    for n in pool.imap_unordered(process_block, jobs):
+        done += n
+        print("%d of %d articles" % (done, n_docs))
+    pool.close()
+    pool.join()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="precompute top k neighbors of every article")
+    parser.add_argument('path_to_model', help="Trained Doc2Vec model")
+    parser.add_argument('--k', type=int, default=20, help="Neighbors to store per article")
+    parser.add_argument('--block_rows', type=int, default=512)
+    parser.add_argument('--block_cols', type=int, default=32768)
+    args = parser.parse_args()
+
+    # imported here so the neighbor computation itself does not need gensim
+    import serving
+    # workers memory-map the vectors instead of each getting a copy.
+    # Models exported by serving.py already have them on disk.
+    vectors_file = serving.docvecs_file(args.path_to_model)
+    if not os.path.exists(vectors_file):
+        model, vectors = serving.load(args.path_to_model)
+        np.save(vectors_file, vectors)
+        del model, vectors
+
+    start = time.time()
+    cache_neighbors(vectors_file, serving.neighbors_path(args.path_to_model),
+                    serving.scores_path(args.path_to_model), k=args.k,
+                    block_rows=args.block_rows, block_cols=args.block_cols)
+    print("Done in %.1fs" % (time.time() - start))
@@ -0,0 +1,40 @@
+import os
+import sys
+import time
+import numpy as np
+import psycopg2
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import serving
+from similarity import RowFilter
+
+"""
+Store the subject and submission date of every article next
+to a model, so /search and /article can filter similar
+articles by subject and date without asking the database.
+
+Example use of this script:
+    $ python cache_row_filter.py arxiv path/to/model
+
+writes model.row_filter.npz. update_model.py refreshes it for
+each new version; re-run this script after retraining.
+"""
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="store subject and date of every article for filtering")
+    parser.add_argument('dbname', help="Name of postgres database")
+    parser.add_argument('path_to_model', help="Trained or exported Doc2Vec model")
+    args = parser.parse_args()
+
+    start = time.time()
+    missing = None
+    if os.path.exists(serving.missing_rows_path(args.path_to_model)):
+        missing = np.load(serving.missing_rows_path(args.path_to_model))
+    with psycopg2.connect(dbname=args.dbname) as conn:
+        row_filter = RowFilter.from_db(conn, missing=missing)
+    row_filter.save(serving.row_filter_path(args.path_to_model))
+    print("Stored %d articles in %d subjects in %.1fs" % (
+        len(row_filter.order), len(row_filter.subjects), time.time() - start))
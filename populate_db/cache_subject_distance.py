@@ -1,12 +1,11 @@
 import pickle
 import pandas as pd
-import gensim
-from gensim.models.doc2vec import Doc2Vec
 import psycopg2
 import psycopg2.extras
 import numpy as np
 from scipy.spatial.distance import pdist, squareform
 import argparse
+import time
 
 """
 Note: You have to have ran cache_subject_hash.py before
@@ -36,21 +35,55 @@ def get_subject_hash(dbname):
             subject_hash = {i[0]: i[1] for i in results}
             return subject_hash
 
-def get_subject_vectors(subject_ids):
+def get_subject_articles(dbname):
+    """
+    INPUT: (str) name of database containing the articles table
+    OUTPUT: (tuple) two int arrays, article index and subject_id
+        of every article that has a subject
+
+    One query, streamed from the server with a named cursor
+    in batches, instead of one query per subject.
+    """
+    indices = []
+    subject_ids = []
+    with psycopg2.connect(dbname=dbname) as conn:
+        with conn.cursor(name='subject_articles') as cur:
+            cur.itersize = 100000
+            cur.execute("SELECT index, subject_id FROM articles WHERE subject_id IS NOT NULL")
+            for index, subject_id in cur:
+                indices.append(index)
+                subject_ids.append(subject_id)
+    return np.array(indices, dtype=np.int64), np.array(subject_ids, dtype=np.int64)
+
+def get_subject_vectors(indices, subject_ids, docvecs, block_rows=65536):
     """
     Get panda DataFrame where each row is a subject's average docvec
     and index is the subject_id
+
+    INPUT:
+        indices, subject_ids (ndarray): from get_subject_articles
+        docvecs (ndarray): docvec matrix, row i for article index i
+        block_rows (int): articles summed at a time, bounding
+            the copy of their docvecs to block_rows rows
+
+    Articles are sorted by subject (and by index within a subject,
+    so docvecs are read in order), then each block's per-subject
+    sums are taken with one np.add.reduceat.
     """
-    subject_vectors = {}
-    with psycopg2.connect(dbname='arxiv') as conn:
-        for subject_id in subject_ids:
-            cur = conn.cursor()
-            cur.execute("SELECT index FROM articles WHERE subject_id='%s'"%subject_id)
-            article_ids = cur.fetchall()
-            article_vectors = np.array([model.docvecs[id[0]] for id in article_ids])
-            subject_vectors[subject_id] = np.mean(article_vectors, axis=0)
-    # turn the dictionary into a dataframe and return
-    return pd.DataFrame(subject_vectors).T
+    known = indices < len(docvecs)
+    indices, subject_ids = indices[known], subject_ids[known]
+    order = np.lexsort((indices, subject_ids))
+    indices, subject_ids = indices[order], subject_ids[order]
+
+    present, codes, counts = np.unique(subject_ids, return_inverse=True, return_counts=True)
+    sums = np.zeros((len(present), docvecs.shape[1]), dtype=np.float64)
+    for start in range(0, len(indices), block_rows):
+        block_codes = codes[start:start + block_rows]
+        starts = np.flatnonzero(np.concatenate([[True], block_codes[1:] != block_codes[:-1]]))
+        # each subject appears once in block_codes[starts], so += does not drop any sums
+        sums[block_codes[starts]] += np.add.reduceat(
+            docvecs[indices[start:start + block_rows]], starts, axis=0)
+    return pd.DataFrame(sums / counts[:, np.newaxis], index=present)
 
 def get_distance_mat(subject_vectors, dist='cosine'):
     """
@@ -64,14 +97,26 @@ def get_distance_mat(subject_vectors, dist='cosine'):
     distance_mat = pd.DataFrame(Y, index=subject_vectors.index, columns=subject_vectors.index)
     return distance_mat
 
-def get_n_closest(distance_mat, subject_id, n=5):
+def get_n_closest(distance_mat, n=5):
     """
-    Sorts a distance matrix's column for a particular subject and returns 
-    n closest subject_ids
+    INPUT: distance matrix from get_distance_mat, number of neighbors
+    OUTPUT: list of (subject_id, related_id, distance) tuples,
+        the n closest subjects to every subject, closest first
+
+    One argpartition over the whole matrix picks every row's
+    n nearest; only those n are then sorted.
     """
-    s = distance_mat.loc[subject_id]
-    closest = s.sort_values()[1:1+n]
-    return closest
+    D = distance_mat.values.copy()
+    # a subject is not its own neighbor
+    np.fill_diagonal(D, np.inf)
+    n = min(n, len(D) - 1)
+    if n < 1:
+        return []
+    nearest = np.argpartition(D, n - 1, axis=1)[:, :n]
+    rows = np.arange(len(D))[:, np.newaxis]
+    nearest = nearest[rows, np.argsort(D[rows, nearest], axis=1)]
+    ids = distance_mat.index.values
+    return [(ids[i], ids[j], D[i, j]) for i in range(len(D)) for j in nearest[i]]
 
 
 if __name__ == '__main__':
@@ -82,24 +127,31 @@ if __name__ == '__main__':
     parser.add_argument('n_closest', help="How many closest subjects to look into")
     args = parser.parse_args()
 
+    # imported here so the subject vectors and distances can be computed without gensim
+    from gensim.models.doc2vec import Doc2Vec
+    start = time.time()
     model = Doc2Vec.load(args.path_to_model)
-
     subject_hash = get_subject_hash(args.dbname)
-    subject_ids = list(subject_hash.keys())
+    print("Loaded model and %d subjects in %.1fs" % (len(subject_hash), time.time() - start))
 
-    # loop over subjects and average docvecs belonging to subject.
-    # place in dictionary
-    subject_vectors = get_subject_vectors(subject_ids)
-    distance_mat = get_distance_mat(subject_vectors)
+    start = time.time()
+    indices, subject_ids = get_subject_articles(args.dbname)
+    print("Read %d articles in %.1fs" % (len(indices), time.time() - start))
+
+    # average docvecs belonging to each subject
+    start = time.time()
+    subject_vectors = get_subject_vectors(indices, subject_ids, model.docvecs.doctag_syn0)
+    print("Averaged %d subject vectors in %.2fs" % (len(subject_vectors), time.time() - start))
 
+    start = time.time()
+    distance_mat = get_distance_mat(subject_vectors)
     to_csv = []
-    for subj_id in subject_ids:
-        relateds = get_n_closest(distance_mat, subj_id, n=int(args.n_closest))
-        for related_id, dist in relateds.iteritems():
-            weight = round(1./dist)
-            #weight = round((1-dist) * 10)
-            row = (subj_id, related_id, weight, subject_hash[subj_id], subject_hash[related_id])
-            to_csv.append(row)
+    for subj_id, related_id, dist in get_n_closest(distance_mat, n=int(args.n_closest)):
+        weight = round(1./dist)
+        #weight = round((1-dist) * 10)
+        row = (subj_id, related_id, weight, subject_hash[subj_id], subject_hash[related_id])
+        to_csv.append(row)
+    print("Found %d edges in %.2fs" % (len(to_csv), time.time() - start))
 
     edges = pd.DataFrame(to_csv, columns=['source', 'target', 'weight', 'source_name', 'target_name'])
     edges.to_csv('../static/subject_distances.csv', index=False)
@@ -0,0 +1,35 @@
+import psycopg2
+import argparse
+from xml_to_postgres import create_author_tables, assign_authors
+
+"""
+Split the `|`-joined authors column of articles loaded so far
+into the authors and article_authors tables. xml_to_postgres.py
+keeps them up to date for articles it loads afterwards.
+
+Example use of this script:
+    $ python make_authors_table.py arxiv
+"""
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='fill the authors tables from articles')
+    parser.add_argument('dbname', nargs='?', default='arxiv', help="Name of postgres database")
+    parser.add_argument('--batch_size', type=int, default=50000, help="Articles per transaction")
+    args = parser.parse_args()
+
+    with psycopg2.connect(dbname=args.dbname) as conn:
+        with conn.cursor() as cur:
+            create_author_tables(cur)
+            conn.commit()
+
+            # articles without authors rows, e.g. all of them on the first run
+            cur.execute("""SELECT index FROM articles a
+                WHERE NOT EXISTS (SELECT 1 FROM article_authors aa WHERE aa.article_id = a.index)
+                ORDER BY index""")
+            indices = [row[0] for row in cur.fetchall()]
+            for start in range(0, len(indices), args.batch_size):
+                assign_authors(cur, indices[start:start + args.batch_size])
+                conn.commit()
+                print("split authors of %d of %d articles" % (
+                    min(start + args.batch_size, len(indices)), len(indices)))
@@ -16,10 +16,11 @@ if __name__ == '__main__':
                 """
             cur.execute(make_table)
 
-            add_index = "ALTER TABLE subjects ADD COLUMN subject_id serial PRIMARY KEY"
+            # app.py and cache_subject_distance.py refer to this key as subjects.index
+            add_index = "ALTER TABLE subjects ADD COLUMN IF NOT EXISTS index serial PRIMARY KEY"
             cur.execute(add_index)
 
-            add_col = "ALTER TABLE articles ADD COLUMN subject_id int"
+            add_col = "ALTER TABLE articles ADD COLUMN IF NOT EXISTS subject_id int"
             cur.execute(add_col)
 
             fill_col = """
@@ -28,3 +29,24 @@ if __name__ == '__main__':
             FROM subjects s
             where s.subject = a.subject"""
             cur.execute(fill_col)
+
+            # article counts per subject, so the home page does not
+            # have to GROUP BY the whole articles table.
+            # xml_to_postgres.py keeps them up to date as articles arrive.
+            add_counts = "ALTER TABLE subjects ADD COLUMN IF NOT EXISTS article_count int NOT NULL DEFAULT 0"
+            cur.execute(add_counts)
+
+            fill_counts = """
+            UPDATE subjects s
+            SET article_count = c.n
+            FROM (SELECT subject_id, COUNT(*) AS n FROM articles GROUP BY subject_id) c
+            WHERE c.subject_id = s.index"""
+            cur.execute(fill_counts)
+
+            # serves the paginated subject listing in app.py:
+            # WHERE subject_id = ... ORDER BY last_submitted DESC, index DESC
+            # where each page starts below the last (last_submitted, index) seen
+            make_listing_index = """CREATE INDEX IF NOT EXISTS
+                articles_subject_listing
+                ON articles (subject_id, last_submitted DESC, index DESC)"""
+            cur.execute(make_listing_index)
@@ -0,0 +1,172 @@
+import os
+import sys
+import time
+import subprocess
+import multiprocessing
+import psycopg2
+import argparse
+from xml_to_postgres import copy_rows, chunker_iter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fulltext
+
+"""
+Extract the text of downloaded PDFs into the `fulltext` table.
+
+Example use of this script:
+    $ python pdf_to_text.py path/to/pdf_dir arxiv --workers 8 --timeout 60
+
+PDFs come from scrape/download_pdf.py, named after their arXiv
+id. Each is converted by poppler's pdftotext in a pool of
+worker processes; a file that takes longer than --timeout
+seconds is killed and recorded as such, so one pathological
+PDF cannot stall the run. Workers clean and compress the text
+themselves, see fulltext.py, and the parent streams results
+into postgres with COPY, committing every --batch_size files.
+
+Every file gets a row, status 'ok' or why it has no text, and
+a re-run skips articles that already have one. Interrupted
+runs therefore pick up at the last committed batch;
+--retry_failed also re-extracts files that failed before.
+
+train.py --fulltext trains on the result.
+"""
+
+# below this many characters a PDF is most likely scanned images
+MIN_CHARS = 200
+
+
+def create_fulltext_table(cur):
+    """
+    body is the zlib-compressed UTF-8 text, NULL unless status is 'ok'.
+    chars is the length of the uncompressed text.
+    """
+    cur.execute("""CREATE TABLE IF NOT EXISTS fulltext (
+                    article_id integer PRIMARY KEY REFERENCES articles (index),
+                    status text NOT NULL,
+                    chars integer,
+                    body bytea,
+                    extracted_at timestamp DEFAULT now()
+                )""")
+
+
+def extract(job):
+    """
+    Worker: convert one PDF.
+
+    Args:
+        job (tuple): (article index, path to PDF, timeout in seconds)
+
+    Returns:
+        tuple: (article index, status, chars, compressed body)
+            where status is 'ok', 'empty', 'timeout' or 'error'
+    """
+    index, path, timeout = job
+    try:
+        out = subprocess.check_output(['pdftotext', '-q', '-enc', 'UTF-8', path, '-'],
+                                      stderr=subprocess.DEVNULL, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return index, 'timeout', None, None
+    except (subprocess.CalledProcessError, OSError):
+        return index, 'error', None, None
+    text = fulltext.clean(out.decode('utf-8', 'replace'))
+    if len(text) < MIN_CHARS:
+        return index, 'empty', len(text), None
+    return index, 'ok', len(text), fulltext.compress(text)
+
+
+def pdfs_to_extract(conn, pdf_dir, retry_failed=False):
+    """
+    Returns:
+        list: (article index, path) of PDFs in pdf_dir whose
+            article is in the database and not yet extracted
+    """
+    with conn.cursor() as cur:
+        # arxiv_id is stored as the abstract's URL; files are named
+        # after the bare id, with '/' of old-style ids as '_'
+        cur.execute("""SELECT replace(regexp_replace(arxiv_id, '^http://arxiv.org/abs/', ''), '/', '_'),
+                       index FROM articles""")
+        indices = dict(cur.fetchall())
+        cur.execute("SELECT article_id FROM fulltext" +
+                    (" WHERE status = 'ok'" if retry_failed else ""))
+        done = set(row[0] for row in cur.fetchall())
+    todo = []
+    for name in sorted(os.listdir(pdf_dir)):
+        stem, ext = os.path.splitext(name)
+        index = indices.get(stem)
+        if ext == '.pdf' and index is not None and index not in done:
+            todo.append((index, os.path.join(pdf_dir, name)))
+    return todo
+
+
+def bulk_extract(conn, todo, workers=None, timeout=60, batch_size=500):
+    """
+    Extract PDFs in parallel and upsert them into `fulltext`,
+    one transaction per batch.
+
+    Args:
+        conn (connection): open psycopg2 connection
+        todo (list): (article index, path) pairs
+        workers (int): extraction processes, defaults to all cores
+        timeout (int): seconds allowed per PDF
+        batch_size (int): files per COPY and commit
+
+    Returns:
+        dict: count of files per status
+    """
+    stats = {}
+    columns = ('article_id', 'status', 'chars', 'body')
+    with conn.cursor() as cur:
+        cur.execute("""CREATE TEMP TABLE fulltext_staging (
+                        article_id integer,
+                        status text,
+                        chars integer,
+                        body bytea
+                    ) ON COMMIT DELETE ROWS""")
+        conn.commit()
+        pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+        jobs = [(index, path, timeout) for index, path in todo]
+        # unordered, so one slow file does not hold back the results behind it
+        results = pool.imap_unordered(extract, jobs, chunksize=4)
+        done = 0
+        for batch in chunker_iter(results, batch_size):
+            copy_rows(cur, batch, 'fulltext_staging', columns)
+            cur.execute("""INSERT INTO fulltext (article_id, status, chars, body)
+                        SELECT article_id, status, chars, body FROM fulltext_staging
+                        ON CONFLICT (article_id) DO UPDATE
+                        SET status = EXCLUDED.status, chars = EXCLUDED.chars,
+                            body = EXCLUDED.body, extracted_at = now()""")
+            conn.commit()
+            for row in batch:
+                stats[row[1]] = stats.get(row[1], 0) + 1
+            done += len(batch)
+            print("extracted %d of %d files: %s" % (done, len(jobs), stats))
+        pool.close()
+        pool.join()
+    return stats
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='extract text of downloaded PDFs into the database')
+    parser.add_argument('pdf_dir', help="Folder of PDFs written by scrape/download_pdf.py")
+    parser.add_argument('dbname', help="Name of postgres database")
+    parser.add_argument('--workers', type=int, help="Extraction processes, defaults to all cores")
+    parser.add_argument('--timeout', type=int, default=60, help="Seconds allowed per PDF")
+    parser.add_argument('--batch_size', type=int, default=500, help="Files per transaction")
+    parser.add_argument('--retry_failed', action='store_true',
+                        help="Also re-extract files that timed out, failed or had no text")
+    args = parser.parse_args()
+
+    with psycopg2.connect(dbname=args.dbname) as conn:
+        with conn.cursor() as cur:
+            create_fulltext_table(cur)
+            conn.commit()
+        todo = pdfs_to_extract(conn, args.pdf_dir, retry_failed=args.retry_failed)
+        print("Extracting %d PDFs..." % len(todo))
+        start = time.time()
+        stats = bulk_extract(conn, todo, workers=args.workers, timeout=args.timeout,
+                             batch_size=args.batch_size)
+        elapsed = time.time() - start
+        print("%d files in %.1fs (%.1f files/s): %s" % (
+            len(todo), elapsed, len(todo) / max(elapsed, 1e-9), stats))
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
-import psycopg2
 import os
+import io
+import binascii
+import time
+import multiprocessing
 from xml.etree import ElementTree as ET
 from datetime import datetime
 import argparse
@@ -24,6 +27,25 @@ would parse files in xml_dir for the following fields:
 - arxiv_id
 and insert into a PostgreSQL database. 
 
+Files are parsed in a process pool. Parsed rows are streamed
+with COPY into a temporary staging table, and merged into
+`articles` with a single INSERT that adds new arxiv_ids and
+updates the title, authors, subject, abstract and date of ones
+already present if they changed (requires PostgreSQL 9.5+ for
+ON CONFLICT). Updated articles keep their `index`.
+The articles table also gets a full-text search_vector column
+with a GIN index (PostgreSQL 9.6+), for app.py's hybrid search.
+
+Loaded files are recorded in a `loaded_files` manifest table,
+keyed by path, with their size and modification time. A re-run
+only parses files that are new or have changed since, so daily
+harvests can be dropped into the same directory. The `index`
+of every article inserted by a run is written to a text file,
+one per line, and that of every updated article to another, for
+downstream stages: update_model.py embeds the new articles and
+re-embeds the updated ones. Running app.py processes are sent an
+articles_changed notification so they drop cached titles.
+
 Note: The database must already exist!
 See harvest.py for more information on how XML files were retrieved.
 
@@ -217,26 +239,381 @@ def chunker(seq, size):
     return (seq[pos:pos + size] for pos in range(0, len(seq), size))
 
 
+def chunker_iter(iterable, size):
+    """
+    Like chunker, but for iterators whose length is unknown,
+    such as results streaming back from a process pool.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+COLUMNS = ('title', 'authors', 'subject', 'abstract', 'last_submitted', 'arxiv_id')
+# overwritten when a changed file is loaded again
+MUTABLE_COLUMNS = ('title', 'authors', 'subject', 'abstract', 'last_submitted')
+
+
+def parse_file(file_path):
+    """Worker wrapper around get_fields for the process pool.
+
+    Returns:
+        tuple: fields as returned by get_fields
+        None: if the file is not XML or cannot be parsed,
+            e.g. malformed XML, a date not in Y-m-d format or
+            an empty identifier or description element
+    """
+    try:
+        return get_fields(file_path) or None
+    except (ET.ParseError, ValueError, AttributeError, TypeError):
+        return None
+
+
+def copy_escape(value):
+    """Format one value for PostgreSQL's COPY text format.
+
+    Args:
+        value: str, date, bytes or None
+
+    Returns:
+        str: value with backslashes, tabs and newlines escaped,
+            bytes in bytea hex format, or \\N for NULL
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bytes):
+        return '\\\\x' + binascii.hexlify(value).decode('ascii')
+    if not isinstance(value, str):
+        value = str(value)
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def copy_rows(cur, rows, table, columns=COLUMNS):
+    """Stream rows into a table with COPY.
+
+    Args:
+        cur (cursor): open psycopg2 cursor
+        rows (list): tuples of values in columns order
+        table (str): destination table
+        columns (tuple): column names of the values in each row
+    """
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(copy_escape(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    cur.copy_expert("COPY %s (%s) FROM STDIN" % (table, ', '.join(columns)), buf)
+
+
+def manifest_entry(file_path):
+    """
+    Returns:
+        tuple: (absolute path, size in bytes, mtime) identifying
+            a file's current contents
+    """
+    st = os.stat(file_path)
+    return (os.path.abspath(file_path), st.st_size, st.st_mtime)
+
+
+def list_xml_files(data_dir):
+    """
+    Returns:
+        list: manifest entries (path, size, mtime) of every XML file in data_dir
+    """
+    return [manifest_entry(os.path.join(data_dir, fname))
+            for fname in os.listdir(data_dir) if fname.endswith('.xml')]
+
+
+def files_to_load(conn, data_dir):
+    """List XML files in data_dir that are not in the manifest
+    with their current size and mtime.
+
+    Args:
+        conn (connection): open psycopg2 connection
+        data_dir (str): folder holding XML files from OAI
+
+    Returns:
+        list: manifest entries (path, size, mtime) of new or changed files
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT path, size, mtime FROM loaded_files")
+        loaded = set(cur.fetchall())
+    return [entry for entry in list_xml_files(data_dir) if entry not in loaded]
+
+
+def assign_subjects(cur, indices):
+    """Give newly inserted articles their subject_id, adding
+    subjects not seen before, and add them to the subjects'
+    article counts. Does nothing until make_subjects_table.py
+    has created the subjects table.
+
+    Args:
+        cur (cursor): open psycopg2 cursor, inside the load transaction
+        indices (list): `index` of the new articles
+    """
+    cur.execute("SELECT to_regclass('subjects')")
+    if cur.fetchone()[0] is None or not indices:
+        return
+    cur.execute("""INSERT INTO subjects (subject)
+                SELECT DISTINCT a.subject FROM articles a
+                WHERE a.index = ANY(%s) AND a.subject IS NOT NULL
+                AND NOT EXISTS (SELECT 1 FROM subjects s WHERE s.subject = a.subject)""",
+                (indices,))
+    cur.execute("""UPDATE articles a SET subject_id = s.index
+                FROM subjects s
+                WHERE s.subject = a.subject AND a.index = ANY(%s)""", (indices,))
+    cur.execute("""UPDATE subjects s SET article_count = s.article_count + c.n
+                FROM (SELECT subject_id, COUNT(*) AS n FROM articles
+                      WHERE index = ANY(%s) GROUP BY subject_id) c
+                WHERE c.subject_id = s.index""", (indices,))
+    # tells running app.py processes to drop their cached counts
+    cur.execute("NOTIFY subjects_changed")
+
+
+def unassign_subjects(cur, indices):
+    """Take updated articles out of their subjects' article
+    counts and clear their subject_id, so assign_subjects() can
+    give them their possibly changed subject.
+
+    Args:
+        cur (cursor): open psycopg2 cursor, inside the load transaction
+        indices (list): `index` of the updated articles
+    """
+    cur.execute("SELECT to_regclass('subjects')")
+    if cur.fetchone()[0] is None or not indices:
+        return
+    cur.execute("""UPDATE subjects s SET article_count = s.article_count - c.n
+                FROM (SELECT subject_id, COUNT(*) AS n FROM articles
+                      WHERE index = ANY(%s) GROUP BY subject_id) c
+                WHERE c.subject_id = s.index""", (indices,))
+    cur.execute("UPDATE articles SET subject_id = NULL WHERE index = ANY(%s)", (indices,))
+
+
+# weighted full-text document of an article; {row} is NEW. in the trigger
+SEARCH_VECTOR = """setweight(to_tsvector('english', coalesce({row}title, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce({row}arxiv_id, '')), 'A') ||
+    setweight(to_tsvector('simple', replace(coalesce({row}authors, ''), '|', ' ')), 'B') ||
+    setweight(to_tsvector('english', coalesce({row}abstract, '')), 'C')"""
+
+
+def create_search_index(cur):
+    """Add the search_vector column that app.py's hybrid search
+    queries, kept up to date by a trigger so bulk loads need not
+    compute it, and a GIN index over it. Rows loaded before the
+    column existed are filled in once. Safe to run repeatedly.
+
+    Args:
+        cur (cursor): open psycopg2 cursor
+    """
+    cur.execute("ALTER TABLE articles ADD COLUMN IF NOT EXISTS search_vector tsvector")
+    cur.execute("""CREATE OR REPLACE FUNCTION articles_search_vector() RETURNS trigger AS $$
+                BEGIN
+                    NEW.search_vector := %s;
+                    RETURN NEW;
+                END
+                $$ LANGUAGE plpgsql""" % SEARCH_VECTOR.format(row='NEW.'))
+    cur.execute("DROP TRIGGER IF EXISTS articles_search_vector ON articles")
+    cur.execute("""CREATE TRIGGER articles_search_vector
+                BEFORE INSERT OR UPDATE OF title, authors, abstract, arxiv_id ON articles
+                FOR EACH ROW EXECUTE PROCEDURE articles_search_vector()""")
+    cur.execute("UPDATE articles SET search_vector = %s WHERE search_vector IS NULL" %
+                SEARCH_VECTOR.format(row=''))
+    cur.execute("""CREATE INDEX IF NOT EXISTS articles_search_vector_idx
+                ON articles USING GIN (search_vector)""")
+
+
+def create_author_tables(cur):
+    """Create the authors table and the article_authors join
+    table, if missing. Authors are split out of the `|`-joined
+    articles.authors column by assign_authors(); run
+    make_authors_table.py once to fill them for articles loaded
+    before the tables existed.
+
+    Args:
+        cur (cursor): open psycopg2 cursor
+    """
+    cur.execute("""CREATE TABLE IF NOT EXISTS authors (
+                    index serial PRIMARY KEY,
+                    name text UNIQUE NOT NULL,
+                    article_count int NOT NULL DEFAULT 0
+                )""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS article_authors (
+                    article_id int REFERENCES articles (index),
+                    author_id int REFERENCES authors (index),
+                    position smallint,
+                    PRIMARY KEY (article_id, position)
+                )""")
+    # the author page lists an author's articles
+    cur.execute("""CREATE INDEX IF NOT EXISTS article_authors_author
+                ON article_authors (author_id, article_id)""")
+
+
+def assign_authors(cur, indices):
+    """Add the authors of newly inserted articles to the authors
+    and article_authors tables, and to the authors' article counts.
+
+    Args:
+        cur (cursor): open psycopg2 cursor, inside the load transaction
+        indices (list): `index` of the new articles
+    """
+    if not indices:
+        return
+    cur.execute("""INSERT INTO authors (name)
+                SELECT DISTINCT trim(x.name)
+                FROM articles a, unnest(string_to_array(a.authors, '|')) AS x(name)
+                WHERE a.index = ANY(%s) AND trim(x.name) <> ''
+                ON CONFLICT (name) DO NOTHING""", (indices,))
+    cur.execute("""INSERT INTO article_authors (article_id, author_id, position)
+                SELECT a.index, au.index, x.position
+                FROM articles a
+                CROSS JOIN LATERAL unnest(string_to_array(a.authors, '|'))
+                    WITH ORDINALITY AS x(name, position)
+                JOIN authors au ON au.name = trim(x.name)
+                WHERE a.index = ANY(%s)
+                ON CONFLICT DO NOTHING""", (indices,))
+    cur.execute("""UPDATE authors au SET article_count = au.article_count + c.n
+                FROM (SELECT author_id, COUNT(DISTINCT article_id) AS n FROM article_authors
+                      WHERE article_id = ANY(%s) GROUP BY author_id) c
+                WHERE c.author_id = au.index""", (indices,))
+
+
+def unassign_authors(cur, indices):
+    """Remove updated articles from article_authors and from
+    their authors' article counts, so assign_authors() can add
+    their possibly changed authors.
+
+    Args:
+        cur (cursor): open psycopg2 cursor, inside the load transaction
+        indices (list): `index` of the updated articles
+    """
+    if not indices:
+        return
+    cur.execute("""UPDATE authors au SET article_count = au.article_count - c.n
+                FROM (SELECT author_id, COUNT(DISTINCT article_id) AS n FROM article_authors
+                      WHERE article_id = ANY(%s) GROUP BY author_id) c
+                WHERE c.author_id = au.index""", (indices,))
+    cur.execute("DELETE FROM article_authors WHERE article_id = ANY(%s)", (indices,))
+
+
+def bulk_load(conn, entries, workers=None, batch_size=5000):
+    """Parse files in parallel and load them into `articles`,
+    recording every parsed file in the manifest in the same transaction.
+
+    Args:
+        conn (connection): open psycopg2 connection
+        entries (list): manifest entries (path, size, mtime) of files to load
+        workers (int): parsing processes, defaults to all cores
+        batch_size (int): rows per COPY
+
+    Returns:
+        dict: counts of files, parsed rows, inserted rows, updated
+            rows, unchanged duplicates and unparseable files, plus
+            new_indices and updated_indices: `index` of every
+            inserted and every updated article
+    """
+    stats = {'files': len(entries), 'parsed': 0, 'failed': 0}
+    with conn.cursor() as cur:
+        cur.execute("""CREATE TEMP TABLE loaded_files_staging (
+                        path text,
+                        size bigint,
+                        mtime double precision
+                    ) ON COMMIT DROP""")
+        # file_order keeps the serial index in the same order as the files
+        cur.execute("""CREATE TEMP TABLE articles_staging (
+                        file_order bigserial,
+                        title text,
+                        authors text,
+                        subject text,
+                        abstract text,
+                        last_submitted date,
+                        arxiv_id text
+                    ) ON COMMIT DROP""")
+
+        pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+        parsed = pool.imap(parse_file, [entry[0] for entry in entries], chunksize=64)
+        for batch in chunker_iter(zip(entries, parsed), batch_size):
+            rows = [row for entry, row in batch if row is not None]
+            stats['failed'] += len(batch) - len(rows)
+            stats['parsed'] += len(rows)
+            copy_rows(cur, rows, 'articles_staging')
+            # unparseable files stay out of the manifest and are retried next run
+            copy_rows(cur, [entry for entry, row in batch if row is not None],
+                      'loaded_files_staging', ('path', 'size', 'mtime'))
+            print("staged %d of %d files" % (stats['parsed'] + stats['failed'], stats['files']))
+        pool.close()
+        pool.join()
+
+        # only the last staged file of an arxiv_id is merged, since one
+        # statement cannot update a row twice; rows that are unchanged
+        # are left alone. xmax is 0 in a row this statement inserted.
+        cur.execute("""INSERT INTO articles ({columns})
+                    SELECT {columns} FROM (
+                        SELECT *, row_number() OVER (PARTITION BY arxiv_id
+                                                     ORDER BY file_order DESC) AS latest
+                        FROM articles_staging) s
+                    WHERE latest = 1 OR arxiv_id IS NULL
+                    ORDER BY file_order
+                    ON CONFLICT (arxiv_id) DO UPDATE
+                    SET ({mutable}) = ({excluded})
+                    WHERE ({current}) IS DISTINCT FROM ({excluded})
+                    RETURNING index, xmax = 0""".format(
+                        columns=', '.join(COLUMNS),
+                        mutable=', '.join(MUTABLE_COLUMNS),
+                        current=', '.join('articles.' + c for c in MUTABLE_COLUMNS),
+                        excluded=', '.join('EXCLUDED.' + c for c in MUTABLE_COLUMNS)))
+        merged = cur.fetchall()
+        stats['new_indices'] = sorted(index for index, inserted in merged if inserted)
+        stats['updated_indices'] = sorted(index for index, inserted in merged if not inserted)
+        stats['inserted'] = len(stats['new_indices'])
+        stats['updated'] = len(stats['updated_indices'])
+        unassign_subjects(cur, stats['updated_indices'])
+        unassign_authors(cur, stats['updated_indices'])
+        assign_subjects(cur, stats['new_indices'] + stats['updated_indices'])
+        assign_authors(cur, stats['new_indices'] + stats['updated_indices'])
+        if stats['updated_indices']:
+            # tells running app.py processes to drop their cached titles
+            cur.execute("NOTIFY articles_changed")
+
+        cur.execute("""INSERT INTO loaded_files (path, size, mtime)
+                    SELECT path, size, mtime FROM loaded_files_staging
+                    ON CONFLICT (path) DO UPDATE
+                    SET size = EXCLUDED.size, mtime = EXCLUDED.mtime, loaded_at = now()""")
+    conn.commit()
+    stats['duplicates'] = stats['parsed'] - stats['inserted'] - stats['updated']
+    return stats
+
+
 if __name__ == '__main__':
     """This script requires an existing database and a folder
     of XML files to parse.
-    It will create a table if none exists, and parse all files
-    to insert into the database.
-    If the file has already been inserted, it will skip without
-    an error, but there is a performance cost when such 
-    exceptions are caught, so it is recommended to either drop
-    existing tables and re-insert fresh from the files, or 
-    place new files in a separate directory from those already
-    inserted.
+    It will create tables if none exist, and parse all files
+    not yet recorded in the manifest to insert into the database.
+    Files whose arxiv_id is already in the table update
+    that article if their fields changed, and are otherwise
+    counted as duplicates.
     """
 
     parser = argparse.ArgumentParser(description=
         'Parses xml files for fields and inserts into database')
     parser.add_argument('data_dir', help="Path to data folder holding XML files from OAI")
     parser.add_argument('dbname', help="Name of **existing** postgres database.")
+    parser.add_argument('--workers', type=int, help="Parsing processes, defaults to all cores")
+    parser.add_argument('--new_indices', default='new_indices.txt',
+                        help="File to write the index of each newly inserted article to")
+    parser.add_argument('--updated_indices', default='updated_indices.txt',
+                        help="File to write the index of each article whose fields changed to")
+    parser.add_argument('--full', action='store_true',
+                        help="Ignore the manifest and parse every file in data_dir")
     args = parser.parse_args()
 
-    filenames = os.listdir(args.data_dir)
+    # imported here so the parsing functions can be used without a database driver
+    import psycopg2
     with psycopg2.connect(dbname=args.dbname) as conn:
         with conn.cursor() as cur:
             
@@ -250,37 +627,36 @@ if __name__ == '__main__':
                         arxiv_id text UNIQUE
                     )"""
             cur.execute(sql_create)
+            create_search_index(cur)
+            create_author_tables(cur)
+
+            sql_manifest = """CREATE TABLE IF NOT EXISTS loaded_files (
+                        path text PRIMARY KEY,
+                        size bigint,
+                        mtime double precision,
+                        loaded_at timestamp DEFAULT now()
+                    )"""
+            cur.execute(sql_manifest)
             conn.commit()
 
-            """
-            Prepare to insert rows in batches
-            Using batches helps speed tremendously (~100x)
-            """
-            batch_size = 1000
-            batch_num = 1
-            # there's some way of using unnest here 
-            # that's probably faster
-            query_template = """
-                INSERT INTO articles 
-                (title, authors, subject, abstract, last_submitted, arxiv_id) 
-                VALUES (%s, %s, %s, %s, %s, %s)
-                """
-            print("Processing %d files in batches of %d..."%(len(filenames), batch_size))
-            for batch in chunker(filenames, batch_size):
-                skips = 0
-                for fname in batch:
-                    file_path = os.path.join(args.data_dir, fname)
-                    values = get_fields(file_path)
-                    try:
-                        cur.execute(query_template, values)
-                    except psycopg2.IntegrityError:
-                        # record already exists
-                        skips += 1
-                        conn.rollback()
-                        continue
-                """Done with batch.
-                Commit batch to disk to free memory"""
-                conn.commit()
-                
-                print("batch %d, skipped %d"%(batch_num, skips))
-                batch_num += 1
\ No newline at end of file
+        if args.full:
+            entries = list_xml_files(args.data_dir)
+        else:
+            entries = files_to_load(conn, args.data_dir)
+        print("Processing %d new or changed files..." % len(entries))
+        start = time.time()
+        stats = bulk_load(conn, entries, workers=args.workers)
+        elapsed = time.time() - start
+        print("%d files in %.1fs (%.0f files/s): inserted %d, updated %d, "
+              "skipped %d duplicates, %d not parsed" % (
+                  stats['files'], elapsed, stats['files'] / max(elapsed, 1e-9),
+                  stats['inserted'], stats['updated'], stats['duplicates'], stats['failed']))
+
+        with open(args.new_indices, 'w') as f:
+            for index in stats['new_indices']:
+                f.write("%d\n" % index)
+        print("Indices of new articles written to %s" % args.new_indices)
+        with open(args.updated_indices, 'w') as f:
+            for index in stats['updated_indices']:
+                f.write("%d\n" % index)
+        print("Indices of updated articles written to %s" % args.updated_indices)
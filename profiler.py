@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import sys
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+"""
+Sampling profiler for slow requests.
+
+While a request runs, a background thread looks at the request
+thread's stack every interval seconds and counts the stacks it
+sees. When the request ends, the counts are thrown away unless
+it took longer than the threshold; then they are appended to a
+log, most frequent stack first, so the log shows where slow
+requests spend their time without profiling the fast ones.
+
+Stacks are written collapsed, one per line with frames joined
+by ';' and the sample count last, which flamegraph.pl reads:
+    $ grep -v '^#' slow_requests.log | flamegraph.pl > slow.svg
+
+Sampling only reads stacks, so the request threads are not
+slowed down beyond the GIL the sampler briefly holds.
+
+Work a request hands to another thread, such as the
+SearchBatcher's, would show up only as the request waiting.
+Wrap the wait in waiting_on(thread) and, for its duration, the
+request's samples are that thread's stack instead, below the
+request's own stack and the thread's name. Every request
+waiting on the same batch is charged for it, as each of them
+waited for all of it.
+"""
+
+
+def collapse(frame):
+    """
+    Returns:
+        str: 'file:function:line' of each frame, outermost first,
+            joined by ';'
+    """
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append('%s:%s:%d' % (code.co_filename, code.co_name, frame.f_lineno))
+        frame = frame.f_back
+    return ';'.join(reversed(frames))
+
+
+class SlowRequestProfiler(object):
+    """
+    Call begin() when a request starts and end() when it
+    finishes, on the thread serving it.
+    """
+    def __init__(self, threshold_ms, path='slow_requests.log', interval=0.005, top=20):
+        """
+        Args:
+            threshold_ms (float): requests at least this slow are logged
+            path (str): log file, appended to
+            interval (float): seconds between samples
+            top (int): most distinct stacks logged per request
+        """
+        self.threshold_ms = threshold_ms
+        self.path = path
+        self.interval = interval
+        self.top = top
+        self.samples = {}
+        # request thread ident -> (ident, name) of the thread it waits on
+        self.waiting = {}
+        self.lock = threading.Lock()
+        # keeps concurrent end()s from interleaving their lines
+        self.write_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            # under the lock, so end() never reads counts being updated
+            with self.lock:
+                if not self.samples:
+                    continue
+                frames = sys._current_frames()
+                for ident, counts in self.samples.items():
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    stack = collapse(frame)
+                    helper, name = self.waiting.get(ident, (None, None))
+                    if frames.get(helper) is not None:
+                        stack = '%s;[%s];%s' % (stack, name, collapse(frames[helper]))
+                    counts[stack] += 1
+
+    def begin(self):
+        with self.lock:
+            self.samples[threading.get_ident()] = Counter()
+
+    @contextmanager
+    def waiting_on(self, thread):
+        """
+        Sample thread instead of the calling request thread
+        while the request blocks on it.
+
+        Args:
+            thread (Thread): e.g. a SearchBatcher's thread
+        """
+        ident = threading.get_ident()
+        with self.lock:
+            if ident in self.samples:
+                self.waiting[ident] = (thread.ident, thread.name)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.waiting.pop(ident, None)
+
+    def end(self, label, elapsed_ms):
+        """
+        Args:
+            label (str): what the request was, e.g. 'GET /search'
+            elapsed_ms (float): how long it took
+        """
+        # once popped, the sampler no longer touches counts
+        with self.lock:
+            counts = self.samples.pop(threading.get_ident(), None)
+            self.waiting.pop(threading.get_ident(), None)
+        if counts is None or elapsed_ms < self.threshold_ms:
+            return
+        lines = ['# %s %s took %.1fms, %d samples' % (
+            time.strftime('%Y-%m-%d %H:%M:%S'), label, elapsed_ms, sum(counts.values()))]
+        lines.extend('%s %d' % (stack, n) for stack, n in counts.most_common(self.top))
+        # not under self.lock, so slow disk does not hold up sampling or begin()
+        with self.write_lock:
+            with open(self.path, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
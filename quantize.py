@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import numpy as np
+from similarity import ExactIndex, IVFIndex, normalized, top_k, batch_top_k, recall_at_k, index_path
+import argparse
+
+"""
+Compressed docvec storage for similarity search.
+
+Candidates are scored on compact codes that stay in memory.
+The best `rerank` of them are then re-scored exactly against
+the full-precision docvecs, which are read from the memory-mapped
+.npy written by serving.py, so only those few rows are paged in.
+
+Three encodings are available:
+- float16: half precision, 2x smaller than float32
+- int8: one byte per dimension with a per-dimension scale, 4x smaller
+- pq: product quantization. Each vector is cut into m subvectors,
+  and each subvector is stored as the id of its nearest
+  of 256 centroids: m bytes per vector.
+  With 100 dimensions and m=20 that is 20x smaller.
+
+Example use of this script:
+    $ python quantize.py path/to/model --codec pq --m 20
+
+writes path/to/model.pq.npz and reports memory saved and
+recall@10 against exact search, with and without re-ranking.
+"""
+
+
+def codes_path(model_path, codec):
+    """Where the codes of a given codec are stored for a model."""
+    return '%s.%s.npz' % (model_path, codec)
+
+
+class Codes(object):
+    """
+    Base class: a matrix of encoded docvecs, plus whatever
+    parameters are needed to score a query against it.
+    Subclasses implement build(), _encode_rows() and _score_rows().
+    """
+    name = None
+
+    def __init__(self, codes, **params):
+        self.codes = codes
+        self.params = params
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + sum(p.nbytes for p in self.params.values())
+
+    def save(self, path):
+        np.savez(path, codes=self.codes, **self.params)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        params = dict((key, data[key]) for key in data.files if key != 'codes')
+        return cls(data['codes'], **params)
+
+    def encode(self, vectors, batch_size=65536):
+        """
+        Encode vectors with this instance's parameters.
+
+        Args:
+            vectors (ndarray): unit-normalized vectors, one per row
+
+        Returns:
+            ndarray: one row of codes per vector
+        """
+        return np.concatenate([self._encode_rows(np.asarray(vectors[start:start + batch_size]))
+                               for start in range(0, max(len(vectors), 1), batch_size)])
+
+    def extend(self, ids, vectors):
+        """
+        Encode new rows without refitting the parameters,
+        growing the code matrix if ids run past its end.
+        Used by update_model.py for incrementally added articles.
+
+        Args:
+            ids (ndarray): row (article index) of each vector
+            vectors (ndarray): unit-normalized vectors for those rows
+        """
+        n_rows = max(len(self.codes), int(np.max(ids)) + 1)
+        if n_rows > len(self.codes):
+            grown = np.zeros((n_rows,) + self.codes.shape[1:], dtype=self.codes.dtype)
+            grown[:len(self.codes)] = self.codes
+            self.codes = grown
+        self.codes[ids] = self.encode(vectors)
+
+    def scores(self, query, ids=None, batch_size=65536):
+        """
+        Approximate similarity of a normalized query to each
+        encoded vector, computed in batches to bound temporary memory.
+
+        Args:
+            query (ndarray): 1d unit-normalized query
+            ids (ndarray): rows to score, or None for all rows
+
+        Returns:
+            ndarray: float32 scores aligned with ids
+        """
+        n = len(self.codes) if ids is None else len(ids)
+        out = np.empty(n, dtype=np.float32)
+        for start in range(0, n, batch_size):
+            rows = slice(start, start + batch_size)
+            codes = self.codes[rows] if ids is None else self.codes[ids[rows]]
+            out[rows] = self._score_rows(codes, query)
+        return out
+
+    def scores_batch(self, queries, ids):
+        """
+        Like scores(), for several queries at once.
+
+        Args:
+            queries (ndarray): 2d array of unit-normalized queries
+            ids (ndarray): rows to score
+
+        Returns:
+            ndarray: float32 (len(ids), len(queries)) scores
+        """
+        return self._score_rows_batch(self.codes[ids], queries).astype(np.float32)
+
+    def _score_rows_batch(self, codes, queries):
+        return np.column_stack([self._score_rows(codes, query) for query in queries])
+
+
+class Float16Codes(Codes):
+    name = 'float16'
+
+    @classmethod
+    def build(cls, vectors, **kwargs):
+        return cls(np.asarray(vectors, dtype=np.float16))
+
+    def _encode_rows(self, vectors):
+        return vectors.astype(np.float16)
+
+    def _score_rows(self, codes, query):
+        return np.dot(codes.astype(np.float32), query)
+
+    def _score_rows_batch(self, codes, queries):
+        return np.dot(codes.astype(np.float32), queries.T)
+
+
+class Int8Codes(Codes):
+    """
+    Symmetric scalar quantization: dimension d is stored as
+    round(v[d] / scale[d]) with scale[d] = max|v[d]| / 127.
+    """
+    name = 'int8'
+
+    @classmethod
+    def build(cls, vectors, **kwargs):
+        scale = np.abs(vectors).max(axis=0) / 127.
+        scale[scale == 0] = 1.
+        codes = cls(None, scale=scale.astype(np.float32))
+        codes.codes = codes.encode(vectors)
+        return codes
+
+    def _encode_rows(self, vectors):
+        # vectors added later may fall outside the range the scale was fit on
+        return np.clip(np.round(vectors / self.params['scale']), -127, 127).astype(np.int8)
+
+    def _score_rows(self, codes, query):
+        return np.dot(codes.astype(np.float32), query * self.params['scale'])
+
+    def _score_rows_batch(self, codes, queries):
+        return np.dot(codes.astype(np.float32), (queries * self.params['scale']).T)
+
+
+class PQCodes(Codes):
+    """
+    Product quantization with 256 centroids per subspace,
+    so each subvector code fits in one byte.
+    """
+    name = 'pq'
+
+    @classmethod
+    def build(cls, vectors, m=20, n_iter=10, sample_size=50000, seed=0, **kwargs):
+        """
+        Args:
+            vectors (ndarray): unit-normalized docvecs
+            m (int): number of subvectors; must divide the vector size
+            n_iter (int): k-means iterations per subspace
+            sample_size (int): codebooks are trained on this many vectors
+        """
+        dim = vectors.shape[1]
+        if dim % m:
+            raise ValueError("m=%d does not divide vector size %d" % (m, dim))
+        sub = dim // m
+        rng = np.random.RandomState(seed)
+        sample = np.asarray(vectors[rng.choice(len(vectors), min(sample_size, len(vectors)),
+                                               replace=False)])
+        codebooks = np.empty((m, 256, sub), dtype=np.float32)
+        for j in range(m):
+            codebooks[j] = kmeans(sample[:, j * sub:(j + 1) * sub], 256, n_iter, rng)
+        codes = cls(None, codebooks=codebooks)
+        codes.codes = codes.encode(vectors)
+        return codes
+
+    def _encode_rows(self, vectors):
+        codebooks = self.params['codebooks']
+        m, _, sub = codebooks.shape
+        codes = np.empty((len(vectors), m), dtype=np.uint8)
+        for j in range(m):
+            codes[:, j] = nearest_centroid(vectors[:, j * sub:(j + 1) * sub], codebooks[j])
+        return codes
+
+    def _score_rows(self, codes, query):
+        codebooks = self.params['codebooks']
+        m, _, sub = codebooks.shape
+        # lookup table: similarity of each query subvector to each centroid
+        lut = np.einsum('jks,js->jk', codebooks, query.reshape(m, sub))
+        return lut[np.arange(m), codes].sum(axis=1)
+
+    def _score_rows_batch(self, codes, queries):
+        codebooks = self.params['codebooks']
+        m, _, sub = codebooks.shape
+        luts = np.einsum('jks,qjs->jkq', codebooks, queries.reshape(len(queries), m, sub))
+        out = np.zeros((len(codes), len(queries)), dtype=np.float32)
+        for j in range(m):
+            out += luts[j][codes[:, j]]
+        return out
+
+
+CODECS = dict((c.name, c) for c in [Float16Codes, Int8Codes, PQCodes])
+
+
+def nearest_centroid(data, centroids):
+    """Index of the closest centroid (Euclidean) for each row of data."""
+    return np.argmax(np.dot(data, centroids.T) - 0.5 * (centroids ** 2).sum(axis=1), axis=1)
+
+
+def kmeans(data, k, n_iter, rng):
+    """
+    Plain Euclidean k-means.
+
+    Returns:
+        ndarray: (k, dim) centroids
+    """
+    k = min(k, len(data))
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = nearest_centroid(data, centroids)
+        counts = np.bincount(assign, minlength=k)
+        filled = counts > 0
+        for d in range(data.shape[1]):
+            sums = np.bincount(assign, weights=data[:, d], minlength=k)
+            centroids[filled, d] = sums[filled] / counts[filled]
+    return centroids
+
+
+class QuantizedIndex(object):
+    """
+    Scores candidates on compressed codes, then re-ranks
+    the best `rerank` of them with full-precision vectors.
+    Has the same search() signature as ExactIndex.
+    """
+    def __init__(self, codes, vectors, rerank=100, coarse=None, missing=None):
+        """
+        Args:
+            codes (Codes): encoded docvecs
+            vectors (ndarray): full-precision unit-normalized docvecs,
+                ideally memory-mapped so only re-ranked rows are read
+            rerank (int): shortlist size for exact re-ranking;
+                0 returns the approximate scores as they are
+            coarse (IVFIndex): if given, only its candidate buckets
+                are scored instead of every row
+            missing (ndarray): rows with no vector, which are not
+                scored; the coarse index never holds them
+        """
+        self.codes = codes
+        self.vectors = vectors
+        self.rerank = rerank
+        self.coarse = coarse
+        # rows scored without a coarse index
+        self.rows = np.arange(len(codes.codes))
+        if missing is not None and len(missing):
+            self.rows = np.setdiff1d(self.rows, missing)
+
+    def search(self, query, topn=10, exclude=None):
+        query = normalized(query[np.newaxis, :])[0]
+        if self.coarse is not None:
+            ids = self.coarse.candidates(query)
+        else:
+            ids = self.rows
+        if exclude is not None:
+            ids = ids[ids != exclude]
+        return self._rerank(query, ids, self.codes.scores(query, ids), topn)
+
+    def search_batch(self, queries, topn=10, block_rows=65536):
+        """
+        Same as search() for each row of queries, decoding each
+        block of codes, or each probed bucket with a coarse index,
+        once for all the queries that score it.
+
+        Returns:
+            list: for each query, (index, similarity) tuples, most similar first
+        """
+        queries = normalized(queries)
+        if self.coarse is not None:
+            groups = self.coarse.probe_groups(queries)
+        else:
+            every = np.arange(len(queries))
+            groups = ((self.rows[start:start + block_rows], every)
+                      for start in range(0, len(self.rows), block_rows))
+        k = max(topn, self.rerank)
+        best = batch_top_k(groups, lambda rows, which: self.codes.scores_batch(queries[which], rows),
+                           len(queries), k)
+        return [self._rerank(query, ids, scores, topn)
+                for query, (ids, scores) in zip(queries, best)]
+
+    def _rerank(self, query, ids, scores, topn):
+        """Best topn of the candidates, re-ranked at full precision unless rerank is 0."""
+        if not self.rerank:
+            return top_k(scores, ids, topn)
+        shortlist = np.array([i for i, _ in top_k(scores, ids, max(topn, self.rerank))])
+        if not len(shortlist):
+            return []
+        # sorted ids read the memory map sequentially
+        shortlist.sort()
+        exact = np.dot(self.vectors[shortlist], query)
+        return top_k(exact, shortlist, topn)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='build compressed docvecs and report recall')
+    parser.add_argument('path_to_model', help="Trained Doc2Vec model")
+    parser.add_argument('--codec', default='all', choices=['all'] + sorted(CODECS))
+    parser.add_argument('--m', type=int, default=20, help="Subvectors for product quantization")
+    parser.add_argument('--n_check', type=int, default=200,
+                        help="Documents to use when checking recall against exact search")
+    args = parser.parse_args()
+
+    # imported here so the codecs themselves do not need gensim
+    import serving
+    model, vectors = serving.load(args.path_to_model)
+    exact = ExactIndex(vectors)
+    query_ids = np.random.RandomState(1).choice(len(vectors), args.n_check, replace=False)
+    full_bytes = len(vectors) * vectors.shape[1] * 4
+    print("float32: %.1fMB" % (full_bytes / 1e6))
+
+    coarse = None
+    if os.path.exists(index_path(args.path_to_model)):
+        coarse = IVFIndex.load(index_path(args.path_to_model), vectors)
+
+    names = sorted(CODECS) if args.codec == 'all' else [args.codec]
+    for name in names:
+        start = time.time()
+        codes = CODECS[name].build(vectors, m=args.m)
+        codes.save(codes_path(args.path_to_model, name))
+        print("%s: %.1fMB (%.1fx smaller), built in %.1fs" % (
+            name, codes.nbytes / 1e6, full_bytes / float(codes.nbytes), time.time() - start))
+        for ivf in [None, coarse] if coarse is not None else [None]:
+            for rerank in (0, 100):
+                index = QuantizedIndex(codes, vectors, rerank=rerank, coarse=ivf)
+                print("  %s rerank=%d recall@10=%.3f" % (
+                    'ivf' if ivf is not None else 'all rows', rerank,
+                    recall_at_k(index, exact, vectors, query_ids)))
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+import os
+import gc
+import time
+import threading
+import numpy as np
+import serving
+from similarity import ExactIndex, IVFIndex, RowFilter, index_path
+from quantize import CODECS, QuantizedIndex, codes_path
+from serving import neighbors_path, scores_path, row_filter_path
+from inference import QueryEncoder, SearchBatcher
+from tokenizer import QueryTokenizer
+from graph import GraphTiles
+from analogy import AnalogyIndex
+
+"""
+Serve a model that can be replaced while the app is running.
+
+The registry holds one live ServedModel. Each request acquires it
+when it starts and releases it when it ends, so a request keeps
+the version it started on even if a swap happens midway.
+New versions are loaded and warmed up on a background thread
+and then swapped in under a lock; the old version's arrays are
+dropped as soon as its last request has released it.
+
+Swaps are triggered either by the CURRENT pointer in a models
+directory changing (see serving.publish and update_model.py),
+which a watcher thread polls for, or by calling reload(),
+e.g. from the app's admin route.
+"""
+
+
+class ServedModel(object):
+    """
+    Everything the app needs from one model version:
+    the gensim model, the normalized docvecs, the similarity
+    indexes, the precomputed neighbor table, row filter, author
+    vectors and article graph, if any, the word-analogy index and
+    the query-vector cache. The caches belong to the version, so a
+    swap never serves vectors inferred by the previous model.
+    """
+    def __init__(self, path, nprobe=16, exact=False, codec=None, rerank=100,
+                 query_cache=10000, batch_wait=0.003, analogy_vocab=None):
+        """
+        Args:
+            path (str): exported or plain Doc2Vec model
+            nprobe (int): IVF buckets scanned per query
+            exact (bool): use brute-force search even if an IVF index exists
+            codec (str): score on compressed codes built by quantize.py
+            rerank (int): candidates re-ranked at full precision with codec
+            query_cache (int): inferred query vectors to keep
+            batch_wait (float): seconds a search waits for others to
+                arrive and be scored with it
+            analogy_vocab (int): answer analogies with only this many
+                of the most frequent words, None for all of them
+        """
+        start = time.time()
+        self.path = path
+        self.active = 0
+        self.retired = False
+        self.model, self.docvecs = serving.load(path)
+        # index gaps update_model.py had no article for are all-zero rows
+        missing = None
+        if os.path.exists(serving.missing_rows_path(path)):
+            missing = np.load(serving.missing_rows_path(path))
+        self.exact_index = ExactIndex(self.docvecs, missing=missing)
+        # the IVF index is built offline by similarity.py
+        if exact or not os.path.exists(index_path(path)):
+            self.index = self.exact_index
+        else:
+            self.index = IVFIndex.load(index_path(path), self.docvecs, nprobe=nprobe)
+        if codec:
+            codes = CODECS[codec].load(codes_path(path, codec))
+            coarse = self.index if isinstance(self.index, IVFIndex) else None
+            self.index = QuantizedIndex(codes, self.docvecs, rerank=rerank, coarse=coarse,
+                                        missing=missing)
+        # neighbor table is built offline by populate_db/cache_neighbors.py
+        self.neighbors = self.neighbor_scores = None
+        if os.path.exists(neighbors_path(path)):
+            self.neighbors = np.load(neighbors_path(path), mmap_mode='r')
+            self.neighbor_scores = np.load(scores_path(path), mmap_mode='r')
+        # subject and date of each row, built by populate_db/cache_row_filter.py
+        self.row_filter = None
+        if os.path.exists(row_filter_path(path)):
+            self.row_filter = RowFilter.load(row_filter_path(path))
+        # mean docvec per author, built by populate_db/cache_author_vectors.py
+        self.author_ids = self.author_index = None
+        if os.path.exists(serving.author_vectors_path(path)):
+            self.author_ids = np.load(serving.author_ids_path(path), mmap_mode='r')
+            self.author_index = ExactIndex(np.load(serving.author_vectors_path(path), mmap_mode='r'))
+        # article graph and layout for /viz/articles, built by graph.py
+        self.graph = None
+        if os.path.exists(serving.graph_path(path)):
+            self.graph = GraphTiles(serving.graph_path(path))
+        self.tokenizer = QueryTokenizer(self.model.vocab, cache_size=query_cache)
+        self.encoder = QueryEncoder(self.model, cache_size=query_cache)
+        self.batcher = SearchBatcher(self.encoder, self.index, max_wait=batch_wait)
+        self.analogies = AnalogyIndex(self.model, top_n=analogy_vocab, cache_size=query_cache)
+        self.load_seconds = time.time() - start
+
+    def warm(self):
+        """
+        Run one search, one inference and one analogy, so the first
+        real request does not pay for page faults and lazy setup.
+        """
+        self.encoder.infer(['warm', 'up'])
+        self.analogies.most_similar(positive=self.analogies.words[:1], topn=1)
+        row = len(self.docvecs) // 2
+        self.index.search(self.docvecs[row], topn=10, exclude=row)
+
+    def close(self):
+        """Drop references to the arrays so their memory can be freed."""
+        self.batcher.close()
+        self.encoder.cache.clear()
+        self.analogies.cache.clear()
+        self.analogies = None
+        self.tokenizer = None
+        self.model = self.docvecs = None
+        self.index = self.exact_index = None
+        self.neighbors = self.neighbor_scores = None
+        self.row_filter = None
+        self.author_ids = self.author_index = None
+        self.graph = None
+
+
+class ModelRegistry(object):
+    """
+    Holds the live ServedModel and swaps in new ones.
+    """
+    def __init__(self, path, models_dir=None, poll_interval=10, **options):
+        """
+        Args:
+            path (str): model to serve at startup
+            models_dir (str): directory to watch for new versions,
+                or None to serve path until reload() is called
+            poll_interval (float): seconds between checks of models_dir
+            options: passed on to ServedModel
+        """
+        self.models_dir = models_dir
+        self.poll_interval = poll_interval
+        self.options = options
+        self.lock = threading.Lock()
+        self.loading = threading.Lock()
+        self.version = serving.current_version(models_dir) if models_dir else None
+        # last value of CURRENT the watcher acted on
+        self.seen = self.version
+        self.current = ServedModel(path, **options)
+        self.current.warm()
+        self.loaded_at = time.time()
+
+    @classmethod
+    def from_models_dir(cls, models_dir, **options):
+        """Serve the CURRENT version of models_dir and follow it as it changes."""
+        version = serving.current_version(models_dir)
+        if version is None:
+            raise ValueError("No CURRENT version in %s" % models_dir)
+        return cls(serving.model_path(models_dir, version), models_dir=models_dir, **options)
+
+    def acquire(self):
+        """Pin the live model for the length of a request."""
+        with self.lock:
+            served = self.current
+            served.active += 1
+            return served
+
+    def release(self, served):
+        """Unpin a model. A retired model is closed once nothing uses it."""
+        with self.lock:
+            served.active -= 1
+            drained = served.retired and served.active == 0
+        if drained:
+            served.close()
+            gc.collect()
+
+    def reload(self, version=None):
+        """
+        Load, warm up and swap in a new model. Runs in the caller's
+        thread; use reload_async() to keep serving meanwhile.
+
+        Args:
+            version (str): version of models_dir to load; defaults to
+                the CURRENT one. Without a models_dir, the live
+                model's file is reloaded from disk.
+
+        Raises:
+            ValueError: no version was given and models_dir has no CURRENT
+        """
+        with self.loading:
+            current = None
+            if self.models_dir:
+                current = serving.current_version(self.models_dir)
+                version = version or current
+                if version is None:
+                    raise ValueError("No CURRENT version in %s" % self.models_dir)
+                path = serving.model_path(self.models_dir, version)
+            else:
+                path = self.current.path
+            start = time.time()
+            served = ServedModel(path, **self.options)
+            served.warm()
+            with self.lock:
+                old = self.current
+                self.current = served
+                self.version = version
+                # the watcher waits for CURRENT to change again, so it
+                # neither reloads this version nor reverts a pinned one
+                self.seen = current
+                self.loaded_at = time.time()
+                old.retired = True
+                drained = old.active == 0
+            if drained:
+                old.close()
+                gc.collect()
+            print("Swapped in %s in %.1fs" % (path, time.time() - start))
+
+    def reload_async(self, version=None):
+        thread = threading.Thread(target=self.reload, args=(version,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def watch(self):
+        """Start a daemon thread that reloads when CURRENT changes."""
+        def poll():
+            while True:
+                time.sleep(self.poll_interval)
+                try:
+                    version = serving.current_version(self.models_dir)
+                    if version and version != self.seen:
+                        self.reload(version)
+                except Exception as e:
+                    # keep serving the old model and try again next poll
+                    print("Reload failed: %r" % e)
+        thread = threading.Thread(target=poll)
+        thread.daemon = True
+        thread.start()
+        return thread
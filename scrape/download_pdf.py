@@ -1,50 +1,306 @@
-import psycopg2
-from psycopg2.extras import DictCursor
-import requests
 import os
-import shutil
+import sys
+import json
 import time
 import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+from requests.adapters import HTTPAdapter
 """
-While we can get PDFs this way,
-the remaining pipeline for parsing 
-PDF and storing to database is not yet set up.
+Download the PDF of every article, a bounded number at a time.
+
+Example use of this script:
+    $ python download_pdf.py arxiv --out_dir pdf --workers 8 --rate 4
+
+All workers share one requests.Session, so connections to
+the server are kept alive and reused rather than opened per
+file, and one token bucket, so --rate caps requests per second
+across the pool no matter how many workers there are.
+
+Bodies are streamed to a .part file in chunks and renamed into
+place once complete, so a PDF on disk is always a whole one and
+memory stays flat however large the file. The outcome of each
+id is appended to a state file (out_dir/state.jsonl by default)
+as it happens; re-running the script skips ids that are done
+and retries the ones that failed, with exponential backoff on
+429, 5xx and connection errors within a run.
+
+--base_url points the downloader at another server, e.g. a
+local stand-in for testing:
+    $ (cd fixtures && python -m http.server 8000) &
+    $ python download_pdf.py --ids_file ids.txt --base_url http://localhost:8000/
+
+arXiv asks bulk users to stay gentle; keep --rate low when
+pointed at arxiv.org.
 """
 
+# outcomes that are final; anything else is retried on the next run
+DONE = ('ok', 'missing', 'not_pdf')
+RETRY_STATUS = (429, 500, 502, 503, 504)
+ABS_URL = 'http://arxiv.org/abs/'
 
-if __name__ == '__main__':
 
-    os.system('mkdir -p pdf')
-    os.system('mkdir -p text')
-
-    with psycopg2.connect(dbname='arxiv') as conn:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("SELECT arxiv_id FROM articles")
-            numtot = 0
-            numok = 0
-            for arxiv_id in cur:
-                
-                numtot += 1
-                pdf_path = os.path.join('pdf', arxiv_id) + '.pdf'
-                
-                # bail if file exists
-                if os.path.isfile(pdf_path):
-                    print("File exists")
-                    continue
-                # bail if bad URL or no PDF:
-                pdf_url = "http://arxiv.org/pdf/%s.pdf"%article['arxiv_id']
-                h = requests.head(pdf_url)
-                if not any([h.status_code == 200, h.headers['Content-Type'] == 'application/pdf']):
-                    print("Bad url on try %d"%numtot)
+def short_id(arxiv_id):
+    """xml_to_postgres.py stores the abstract's URL as arxiv_id."""
+    return arxiv_id[len(ABS_URL):] if arxiv_id.startswith(ABS_URL) else arxiv_id
+
+
+def pdf_filename(arxiv_id):
+    """Old-style ids like math/0501001 contain a slash."""
+    return arxiv_id.replace('/', '_') + '.pdf'
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket: acquire() blocks until a token is
+    available. Tokens refill at rate per second up to burst.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_for = (1 - self.tokens) / self.rate
+            time.sleep(wait_for)
+
+
+class DownloadState(object):
+    """
+    Append-only log of one JSON line per finished attempt;
+    the last line for an id wins. A crash loses at most the
+    line being written, which load() skips.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.status = {}
+        self.attempts = {}
+        self.lock = threading.Lock()
+        self.fp = open(path, 'a')
+        if os.path.getsize(path):
+            self.load()
+
+    def load(self):
+        with open(self.path) as fp:
+            for line in fp:
+                if not line.endswith('\n'):
+                    # end the line a crash cut short, or the next record would join it
+                    self.fp.write('\n')
+                try:
+                    entry = json.loads(line)
+                except ValueError:
                     continue
-                req = requests.get(pdf_url)
-                with open(pdf_path, 'wb') as fp:
-                    fp.write(req.content)
-                    numok+=1
-
-                # slightly hacky way to not get blocked:
-                time.sleep(0.1 + random.uniform(0,0.2))
-                
-                # print some info
-                if numtot%100==0:
-                    print("Got %d of %d tries"%(numok, numtot))
+                self.status[entry['id']] = entry['status']
+                self.attempts[entry['id']] = entry['attempts']
+
+    def done(self, arxiv_id):
+        return self.status.get(arxiv_id) in DONE
+
+    def record(self, arxiv_id, status, attempts):
+        with self.lock:
+            self.status[arxiv_id] = status
+            self.attempts[arxiv_id] = self.attempts.get(arxiv_id, 0) + attempts
+            self.fp.write(json.dumps({'id': arxiv_id, 'status': status,
+                                      'attempts': self.attempts[arxiv_id]}) + '\n')
+            self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+
+class Retry(Exception):
+    """A failure worth trying again, with the server's Retry-After if any."""
+    def __init__(self, reason, after=None):
+        super(Retry, self).__init__(reason)
+        self.after = after
+
+
+def make_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch(session, url, path, timeout=30, chunk_size=1 << 16):
+    """
+    Stream url to path via a temporary file.
+
+    Returns:
+        str: 'ok', 'missing' if the server has no such file,
+            'not_pdf' if it answered with something else, e.g.
+            arXiv's page for articles withdrawn or without a PDF,
+            or 'http_<code>' for other statuses, retried next run
+
+    Raises:
+        Retry: on 429, 5xx, connection errors and timeouts
+    """
+    try:
+        response = session.get(url, stream=True, timeout=timeout)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        raise Retry(type(e).__name__)
+    # closing returns the connection to the pool even when the body is not read
+    try:
+        if response.status_code in RETRY_STATUS:
+            after = response.headers.get('Retry-After')
+            raise Retry('HTTP %d' % response.status_code,
+                        float(after) if after and after.isdigit() else None)
+        if response.status_code == 404:
+            return 'missing'
+        if response.status_code != 200:
+            return 'http_%d' % response.status_code
+        if not response.headers.get('Content-Type', '').startswith('application/pdf'):
+            return 'not_pdf'
+        part = path + '.part'
+        written = 0
+        try:
+            with open(part, 'wb') as fp:
+                for chunk in response.iter_content(chunk_size):
+                    fp.write(chunk)
+                    written += len(chunk)
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            os.remove(part)
+            raise Retry(type(e).__name__)
+        # older urllib3 ends a body cut short without complaint
+        length = response.headers.get('Content-Length', '')
+        if length.isdigit() and 'Content-Encoding' not in response.headers and \
+                written != int(length):
+            os.remove(part)
+            raise Retry('truncated at %d of %s bytes' % (written, length))
+        os.replace(part, path)
+        return 'ok'
+    finally:
+        response.close()
+
+
+def download(session, bucket, base_url, out_dir, arxiv_id, max_retries=5, backoff=1.):
+    """
+    Fetch one PDF, backing off exponentially with full jitter
+    between attempts.
+
+    Returns:
+        tuple: (status, attempts made); status is 'error' if
+            every attempt failed or one failed unexpectedly,
+            e.g. the disk filled up, so that one bad article
+            does not stop the others
+    """
+    url = base_url + arxiv_id + '.pdf'
+    path = os.path.join(out_dir, pdf_filename(arxiv_id))
+    for attempt in range(1, max_retries + 1):
+        bucket.acquire()
+        try:
+            return fetch(session, url, path), attempt
+        except Retry as e:
+            if attempt == max_retries:
+                print("Giving up on %s: %s" % (arxiv_id, e))
+                break
+            delay = e.after if e.after is not None else random.uniform(0, backoff * 2 ** attempt)
+            time.sleep(delay)
+        except Exception as e:
+            print("Failed on %s: %s: %s" % (arxiv_id, type(e).__name__, e))
+            return 'error', attempt
+    return 'error', max_retries
+
+
+def download_all(ids, out_dir, state, workers=8, rate=4., base_url='https://arxiv.org/pdf/',
+                 max_retries=5, report_every=100):
+    """
+    Download every id not already done, at most workers at a time.
+    Ids are submitted a window at a time so that a queue of
+    600k futures is never built up front.
+
+    Returns:
+        dict: count of each outcome in this run
+    """
+    session = make_session(workers)
+    bucket = TokenBucket(rate, burst=workers)
+    counts = {}
+    pending = set()
+    finished = 0
+
+    def collect(futures):
+        for future in futures:
+            arxiv_id = future.arxiv_id
+            if future.exception() is not None:
+                # download() reports its own failures; this is a last resort
+                print("Failed on %s: %r" % (arxiv_id, future.exception()))
+                status, attempts = 'error', 1
+            else:
+                status, attempts = future.result()
+            state.record(arxiv_id, status, attempts)
+            counts[status] = counts.get(status, 0) + 1
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for arxiv_id in ids:
+            if state.done(arxiv_id) or os.path.isfile(os.path.join(out_dir, pdf_filename(arxiv_id))):
+                counts['skipped'] = counts.get('skipped', 0) + 1
+                continue
+            if len(pending) >= 4 * workers:
+                completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(completed)
+                finished += len(completed)
+                if finished // report_every != (finished - len(completed)) // report_every:
+                    print("%d downloaded, %s" % (finished, counts))
+            future = executor.submit(download, session, bucket, base_url, out_dir,
+                                     arxiv_id, max_retries)
+            future.arxiv_id = arxiv_id
+            pending.add(future)
+        collect(wait(pending)[0])
+    session.close()
+    return counts
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="download article PDFs concurrently")
+    parser.add_argument('dbname', nargs='?', default='arxiv', help="Name of postgres database")
+    parser.add_argument('--out_dir', default='pdf', help="Where PDFs are written")
+    parser.add_argument('--state', default=None,
+                        help="Resumable state file, default out_dir/state.jsonl")
+    parser.add_argument('--workers', type=int, default=8, help="Concurrent downloads")
+    parser.add_argument('--rate', type=float, default=4.,
+                        help="Most requests per second across all workers")
+    parser.add_argument('--max_retries', type=int, default=5,
+                        help="Attempts per PDF before it is left for the next run")
+    parser.add_argument('--base_url', default='https://arxiv.org/pdf/',
+                        help="Prefix of PDF urls; point at a local server to test")
+    parser.add_argument('--ids_file', default=None,
+                        help="Read arXiv ids, one per line, from this file instead of the database")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    if args.ids_file:
+        with open(args.ids_file) as fp:
+            ids = [line.strip() for line in fp if line.strip()]
+    else:
+        # imported here so the downloader itself needs no database driver
+        import psycopg2
+        with psycopg2.connect(dbname=args.dbname) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT arxiv_id FROM articles WHERE arxiv_id IS NOT NULL ORDER BY index")
+                ids = [short_id(row[0]) for row in cur]
+
+    state = DownloadState(args.state or os.path.join(args.out_dir, 'state.jsonl'))
+    start = time.time()
+    try:
+        counts = download_all(ids, args.out_dir, state, workers=args.workers, rate=args.rate,
+                              base_url=args.base_url, max_retries=args.max_retries)
+    finally:
+        state.close()
+    print("%s in %.1fs" % (counts, time.time() - start))
+    sys.exit(1 if counts.get('error') else 0)
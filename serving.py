@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import numpy as np
+from gensim.models import Doc2Vec
+import argparse
+
+"""
+Export a trained model into the artifacts the web app needs,
+laid out so several app processes can share one copy in memory.
+
+A full Doc2Vec model holds everything needed to keep training.
+The app only needs:
+- unit-normalized docvecs, for similarity search
+- unit-normalized word vectors, for /analogy
+- the vocabulary, word vectors and output layer (syn1/syn1neg),
+  which infer_vector uses to embed search queries
+
+Example use of this script:
+    $ python serving.py path/to/model path/to/serving_dir
+
+writes serving_dir/model (a gensim model with the docvecs
+stripped and every large array in its own .npy file),
+serving_dir/model.docvecs_norm.npy and serving_dir/model.words_norm.npy,
+and copies the IVF index, neighbor table, row filter, author
+vectors and article graph if they exist.
+
+Start the app with serving_dir/model as the model path.
+Arrays are opened with mmap, so processes serving the same
+export share the operating system's page cache instead of
+each holding a private copy.
+
+Exports can also be kept as numbered versions under one models
+directory, with a CURRENT file naming the live one:
+    $ python serving.py path/to/model models/ --version v1
+
+update_model.py publishes new versions there.
+"""
+
+# files built next to a model by similarity.py and populate_db/cache_*.py
+SIDECARS = ['.ivf.npz', '.neighbors.npy', '.neighbor_scores.npy', '.row_filter.npz',
+            '.author_ids.npy', '.author_vectors.npy', '.graph.npz']
+
+
+def docvecs_normalized(model):
+    """Unit-normalized docvecs of a loaded Doc2Vec model."""
+    model.docvecs.init_sims()
+    return model.docvecs.doctag_syn0norm
+
+
+def docvecs_file(model_path):
+    """Where the normalized docvecs of an exported model are stored."""
+    return model_path + '.docvecs_norm.npy'
+
+
+def words_file(model_path):
+    """Where the normalized word vectors of an exported model are stored."""
+    return model_path + '.words_norm.npy'
+
+
+def neighbors_path(model_path):
+    """Where populate_db/cache_neighbors.py stores neighbor indices for a model."""
+    return model_path + '.neighbors.npy'
+
+
+def scores_path(model_path):
+    """Where populate_db/cache_neighbors.py stores neighbor similarities for a model."""
+    return model_path + '.neighbor_scores.npy'
+
+
+def row_filter_path(model_path):
+    """Where populate_db/cache_row_filter.py stores subjects and dates of a model's rows."""
+    return model_path + '.row_filter.npz'
+
+
+def missing_rows_path(model_path):
+    """Where update_model.py lists the docvec rows it left without a vector."""
+    return model_path + '.missing_rows.npy'
+
+
+def author_ids_path(model_path):
+    """Where populate_db/cache_author_vectors.py stores the author of each author vector."""
+    return model_path + '.author_ids.npy'
+
+
+def author_vectors_path(model_path):
+    """Where populate_db/cache_author_vectors.py stores normalized mean docvecs of authors."""
+    return model_path + '.author_vectors.npy'
+
+
+def graph_path(model_path):
+    """Where graph.py stores the article graph and its layout for /viz/articles."""
+    return model_path + '.graph.npz'
+
+
+def export(model_path, out_dir):
+    """
+    Args:
+        model_path (str): trained Doc2Vec model
+        out_dir (str): directory to write the serving artifacts to
+
+    Returns:
+        str: path of the exported model, to pass to app.py
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    out_path = os.path.join(out_dir, 'model')
+
+    model = Doc2Vec.load(model_path)
+    np.save(docvecs_file(out_path), docvecs_normalized(model))
+    model.init_sims()
+    np.save(words_file(out_path), model.syn0norm)
+
+    # infer_vector does not read the trained docvecs, so drop them
+    model.docvecs.doctag_syn0 = np.empty((0, model.vector_size), dtype=np.float32)
+    model.docvecs.doctag_syn0_lockf = np.empty(0, dtype=np.float32)
+    model.docvecs.doctag_syn0norm = None
+    model.syn0norm = None
+    # sep_limit=0 stores every array as its own .npy, so all of them can be mmapped
+    model.save(out_path, sep_limit=0)
+
+    for suffix in SIDECARS:
+        if os.path.exists(model_path + suffix):
+            shutil.copy(model_path + suffix, out_path + suffix)
+    return out_path
+
+
+def load(model_path):
+    """
+    Load a model for serving.
+
+    Exported models are memory-mapped read-only. A plain trained
+    model is loaded into memory as before, and its normalized
+    vectors are computed on the spot.
+
+    Args:
+        model_path (str): exported or plain Doc2Vec model
+
+    Returns:
+        tuple: (model, docvecs) where docvecs holds the
+            unit-normalized docvec of article i in row i
+    """
+    if not os.path.exists(docvecs_file(model_path)):
+        model = Doc2Vec.load(model_path)
+        return model, docvecs_normalized(model)
+
+    model = Doc2Vec.load(model_path, mmap='r')
+    # gensim's most_similar uses syn0norm if it is already set
+    model.syn0norm = np.load(words_file(model_path), mmap_mode='r')
+    docvecs = np.load(docvecs_file(model_path), mmap_mode='r')
+    return model, docvecs
+
+
+def model_path(models_dir, version):
+    """Path of the exported model of a version under models_dir."""
+    return os.path.join(models_dir, version, 'model')
+
+
+def current_version(models_dir):
+    """
+    Returns:
+        str: name of the live version in models_dir
+        None: if nothing has been published yet
+    """
+    path = os.path.join(models_dir, 'CURRENT')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+
+def publish(models_dir, version):
+    """
+    Make version the live one. The pointer is replaced atomically,
+    so readers see either the old or the new version, never neither.
+    """
+    tmp_path = os.path.join(models_dir, 'CURRENT.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(version + '\n')
+    os.replace(tmp_path, os.path.join(models_dir, 'CURRENT'))
+
+
+def memory_usage():
+    """
+    Memory of the current process in MB, read from /proc (Linux only).
+
+    Returns:
+        dict: rss (resident), pss (resident, with shared pages
+            divided among the processes sharing them), shared and
+            private. pss is the fair per-worker cost.
+            Empty if /proc is unavailable.
+    """
+    fields = {'Rss': 'rss', 'Pss': 'pss',
+              'Shared_Clean': 'shared', 'Shared_Dirty': 'shared',
+              'Private_Clean': 'private', 'Private_Dirty': 'private'}
+    usage = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            lines = f.readlines()
+    except IOError:
+        return usage
+    for line in lines:
+        parts = line.split()
+        key = parts[0].rstrip(':')
+        if key in fields:
+            usage[fields[key]] = usage.get(fields[key], 0) + int(parts[1]) / 1024.
+    return usage
+
+
+def report_memory(label):
+    """Print this process's memory usage, for startup logs."""
+    usage = memory_usage()
+    if not usage:
+        print("%s: memory usage unavailable" % label)
+        return
+    print("%s (pid %d): rss=%.0fMB pss=%.0fMB shared=%.0fMB private=%.0fMB" % (
+        label, os.getpid(), usage['rss'], usage['pss'],
+        usage['shared'], usage['private']))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='export a model for memory-mapped serving')
+    parser.add_argument('path_to_model', help="Trained Doc2Vec model")
+    parser.add_argument('out_dir', help="Directory for the serving artifacts")
+    parser.add_argument('--version',
+                        help="Export into out_dir/VERSION and publish it as the current version")
+    args = parser.parse_args()
+
+    if args.version:
+        out_path = export(args.path_to_model, os.path.join(args.out_dir, args.version))
+        publish(args.out_dir, args.version)
+    else:
+        out_path = export(args.path_to_model, args.out_dir)
+    print("Serving model can be found at %s" % out_path)
@@ -0,0 +1,613 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import argparse
+import datetime
+import time
+
+"""
+Nearest-neighbor search over document vectors.
+
+gensim's docvecs.most_similar computes a dot product against
+every document vector on every call. That is fine for a few
+thousand documents, but with 600k+ articles it costs tens of
+milliseconds per request and grows with the corpus.
+
+This module offers two interchangeable indexes with the
+same search() signature:
+
+- ExactIndex: brute force, same results as most_similar.
+  Use it as the reference when checking recall.
+- IVFIndex: an inverted-file index. Vectors are clustered
+  into n_lists cells with spherical k-means, and a query only
+  scans the nprobe cells whose centroids are closest.
+  nprobe is the recall/latency knob: higher is slower but
+  closer to exact.
+
+RowFilter restricts a search to articles of one subject and/or
+a date range. Rows are kept grouped by subject and sorted by
+date within each group, so the rows matching a filter are one
+contiguous slice found by binary search, and a filtered query
+only scores that slice. filtered_search() picks between that
+and the IVF index's candidates that pass the filter, whichever
+scans fewer rows.
+
+Build the IVF index offline, next to the model:
+    $ python similarity.py path/to/model --n_lists 1024
+
+which writes path/to/model.ivf.npz and prints recall@10
+against exact search for a sample of documents.
+"""
+
+
+def normalized(vectors):
+    """
+    Args:
+        vectors (ndarray): 2d array, one vector per row
+
+    Returns:
+        ndarray: float32 copy with every row scaled to unit length.
+            All-zero rows are left as zeros.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.sqrt((vectors ** 2).sum(axis=1))[:, np.newaxis]
+    norms[norms == 0] = 1.
+    return vectors / norms
+
+
+def top_k(scores, ids, topn):
+    """
+    Pick the topn highest scores without sorting everything.
+
+    Args:
+        scores (ndarray): 1d array of similarity scores
+        ids (ndarray): 1d array of document indices, aligned with scores
+        topn (int): number of results wanted
+
+    Returns:
+        list: (index, score) tuples, best first
+    """
+    if len(scores) > topn:
+        best = np.argpartition(-scores, topn)[:topn]
+    else:
+        best = np.arange(len(scores))
+    best = best[np.argsort(-scores[best])]
+    return [(int(ids[i]), float(scores[i])) for i in best]
+
+
+class ExactIndex(object):
+    """
+    Brute-force cosine similarity over all document vectors.
+    Gives the same neighbors as model.docvecs.most_similar.
+    """
+    def __init__(self, vectors, missing=None):
+        """
+        Args:
+            vectors (ndarray): unit-normalized docvecs,
+                where row i is the vector for article index i
+            missing (ndarray): rows with no vector, left as zeros
+                by update_model.py, which are never returned
+        """
+        self.vectors = vectors
+        self.missing = missing if missing is not None and len(missing) else None
+
+    def search(self, query, topn=10, exclude=None, ids=None):
+        """
+        Args:
+            query (ndarray): 1d query vector, need not be normalized
+            topn (int): number of neighbors to return
+            exclude (int): article index to leave out of results,
+                e.g. the article we are finding neighbors for
+            ids (ndarray): only score these rows, e.g. from RowFilter.rows()
+
+        Returns:
+            list: (index, similarity) tuples, most similar first
+        """
+        query = normalized(query[np.newaxis, :])[0]
+        if ids is None:
+            scores = np.dot(self.vectors, query)
+            if exclude is not None:
+                scores[exclude] = -np.inf
+            if self.missing is not None:
+                scores[self.missing] = -np.inf
+            ids = np.arange(len(scores))
+        else:
+            if exclude is not None:
+                ids = ids[ids != exclude]
+            scores = np.dot(self.vectors[ids], query)
+        # with few enough rows, the -inf ones are still picked
+        return [(i, score) for i, score in top_k(scores, ids, topn) if score > -np.inf]
+
+    def search_batch(self, queries, topn=10, block_rows=65536):
+        """
+        Search for several queries with one matrix multiply per
+        block of docvecs, instead of one pass over them per query.
+
+        Args:
+            queries (ndarray): 2d array, one query vector per row
+            topn (int): number of neighbors per query
+            block_rows (int): docvecs scored at a time, which
+                bounds the score matrix to block_rows x len(queries)
+
+        Returns:
+            list: for each query, (index, similarity) tuples, most similar first
+        """
+        queries = normalized(queries)
+        best_ids = [[] for _ in queries]
+        best_scores = [[] for _ in queries]
+        for start in range(0, len(self.vectors), block_rows):
+            scores = np.dot(self.vectors[start:start + block_rows], queries.T)
+            if self.missing is not None:
+                in_block = self.missing[(self.missing >= start) & (self.missing < start + block_rows)]
+                scores[in_block - start] = -np.inf
+            k = min(topn, len(scores))
+            top = np.argpartition(-scores, k - 1, axis=0)[:k]
+            for j in range(len(queries)):
+                best_ids[j].append(top[:, j] + start)
+                best_scores[j].append(scores[top[:, j], j])
+        return [[(i, score) for i, score in top_k(np.concatenate(s), np.concatenate(ids), topn)
+                 if score > -np.inf]
+                for ids, s in zip(best_ids, best_scores)]
+
+
+class IVFIndex(object):
+    """
+    Inverted-file index: documents are bucketed by their nearest
+    centroid, and only the nprobe closest buckets are scanned.
+
+    The buckets are stored CSR-style: list_ids holds document
+    indices grouped by bucket, and bucket j spans
+    list_ids[offsets[j]:offsets[j+1]].
+    """
+    def __init__(self, vectors, centroids, offsets, list_ids, nprobe=16):
+        self.vectors = vectors
+        self.centroids = centroids
+        self.offsets = offsets
+        self.list_ids = list_ids
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(cls, vectors, n_lists=1024, n_iter=10, sample_size=100000, seed=0):
+        """
+        Cluster vectors with spherical k-means and bucket them.
+
+        Args:
+            vectors (ndarray): unit-normalized docvecs
+            n_lists (int): number of buckets. sqrt(n_docs) to
+                4*sqrt(n_docs) is a reasonable range.
+            n_iter (int): k-means iterations
+            sample_size (int): centroids are trained on a random
+                sample of this many vectors to bound build time
+            seed (int): random seed, so builds are reproducible
+
+        Returns:
+            IVFIndex
+        """
+        rng = np.random.RandomState(seed)
+        n_docs = len(vectors)
+        n_lists = min(n_lists, n_docs)
+        sample = vectors[rng.choice(n_docs, min(sample_size, n_docs), replace=False)]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assign = np.argmax(np.dot(sample, centroids.T), axis=1)
+            for j in range(n_lists):
+                members = sample[assign == j]
+                if len(members):
+                    centroids[j] = members.sum(axis=0)
+            centroids = normalized(centroids)
+
+        assign = assign_to_lists(vectors, centroids)
+        list_ids = np.argsort(assign, kind='mergesort').astype(np.int32)
+        counts = np.bincount(assign, minlength=n_lists)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(vectors, centroids, offsets, list_ids)
+
+    def save(self, path):
+        """
+        Store the centroids and buckets. The vectors themselves
+        are not saved; they come from the model at load time.
+        """
+        np.savez(path, centroids=self.centroids,
+                 offsets=self.offsets, list_ids=self.list_ids)
+
+    @classmethod
+    def load(cls, path, vectors, nprobe=16):
+        """
+        Args:
+            path (str): file written by save()
+            vectors (ndarray): the same unit-normalized docvecs
+                the index was built from
+            nprobe (int): buckets scanned per query
+
+        Returns:
+            IVFIndex
+        """
+        data = np.load(path)
+        return cls(vectors, data['centroids'], data['offsets'],
+                   data['list_ids'], nprobe=nprobe)
+
+    def add(self, ids):
+        """
+        Bucket rows of self.vectors, keeping the existing centroids.
+        Rows already in the index are moved to the bucket of their
+        current vector. Used by update_model.py for incrementally
+        added articles and re-inferred updated ones.
+
+        Args:
+            ids (ndarray): rows (article indices) to add
+        """
+        n_lists = len(self.centroids)
+        old_assign = np.repeat(np.arange(n_lists), np.diff(self.offsets))
+        replaced = np.zeros(len(self.vectors), dtype=bool)
+        replaced[ids] = True
+        keep = ~replaced[self.list_ids]
+        new_assign = assign_to_lists(self.vectors[ids], self.centroids)
+        assign = np.concatenate([old_assign[keep], new_assign])
+        all_ids = np.concatenate([self.list_ids[keep], np.asarray(ids, dtype=np.int32)])
+        order = np.argsort(assign, kind='mergesort')
+        self.list_ids = all_ids[order]
+        counts = np.bincount(assign, minlength=n_lists)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def scan_size(self, nprobe=None):
+        """Average number of documents a search scores."""
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        return len(self.list_ids) * nprobe // len(self.centroids)
+
+    def probe_groups(self, queries, nprobe=None):
+        """
+        Group a batch of queries by the buckets they probe, so each
+        bucket is scored against all its queries in one multiply.
+
+        Args:
+            queries (ndarray): 2d array of normalized queries
+
+        Yields:
+            tuple: (document indices in a bucket, numbers of the
+                queries that probe it)
+        """
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        centroid_scores = np.dot(queries, self.centroids.T)
+        probes = np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe]
+        for j in np.unique(probes):
+            yield (self.list_ids[self.offsets[j]:self.offsets[j + 1]],
+                   np.where((probes == j).any(axis=1))[0])
+
+    def candidates(self, query, nprobe=None):
+        """
+        Returns:
+            ndarray: document indices in the nprobe buckets
+                closest to the (normalized) query
+        """
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        centroid_scores = np.dot(self.centroids, query)
+        probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        return np.concatenate([self.list_ids[self.offsets[j]:self.offsets[j + 1]]
+                               for j in probe])
+
+    def search(self, query, topn=10, exclude=None, nprobe=None):
+        """
+        Same as ExactIndex.search, but only scores documents in
+        the nprobe closest buckets.
+
+        Args:
+            nprobe (int): overrides the index default for this query
+        """
+        query = normalized(query[np.newaxis, :])[0]
+        ids = self.candidates(query, nprobe)
+        if exclude is not None:
+            ids = ids[ids != exclude]
+        scores = np.dot(self.vectors[ids], query)
+        return top_k(scores, ids, topn)
+
+    def search_batch(self, queries, topn=10):
+        """
+        Same as search() for each row of queries, scoring each
+        probed bucket once for all the queries that probe it.
+
+        Returns:
+            list: for each query, (index, similarity) tuples, most similar first
+        """
+        queries = normalized(queries)
+        best = batch_top_k(self.probe_groups(queries),
+                           lambda rows, which: np.dot(self.vectors[rows], queries[which].T),
+                           len(queries), topn)
+        return [top_k(scores, ids, topn) for ids, scores in best]
+
+
+class RowFilter(object):
+    """
+    Subject and submission date of every docvec row, laid out so
+    the rows matching a filter can be sliced out without a scan.
+
+    order lists the rows grouped by subject, oldest first within
+    each subject; subject j spans order[offsets[j]:offsets[j+1]]
+    and days[k] is the date of row order[k]. date_order and
+    date_days hold the same rows sorted by date alone, for
+    filters without a subject. Rows with no subject or date,
+    such as row 0, which no article uses, are left out.
+
+    row_order and row_days, and all_rows and all_days, are the
+    same two layouts sorted by row instead of date, so allows()
+    can look up a few candidate rows by binary search.
+    """
+    def __init__(self, subjects, order, offsets, days, date_order, date_days):
+        self.subjects = subjects
+        self.subject_codes = dict((subject, j) for j, subject in enumerate(subjects))
+        self.order = order
+        self.offsets = offsets
+        self.days = days
+        self.date_order = date_order
+        self.date_days = date_days
+        group = np.repeat(np.arange(len(subjects)), np.diff(offsets))
+        by_row = np.lexsort((order, group))
+        self.row_order = order[by_row]
+        self.row_days = days[by_row]
+        by_row = np.argsort(date_order, kind='mergesort')
+        self.all_rows = date_order[by_row]
+        self.all_days = date_days[by_row]
+
+    @classmethod
+    def from_arrays(cls, rows, subject_names, days):
+        """
+        Args:
+            rows (ndarray): article indices (docvec rows)
+            subject_names (list): subject of each row
+            days (ndarray): submission date of each row,
+                as days since 1970-01-01
+
+        Returns:
+            RowFilter
+        """
+        subjects = sorted(set(subject_names))
+        codes = dict((subject, j) for j, subject in enumerate(subjects))
+        subject_ids = np.array([codes[name] for name in subject_names], dtype=np.int32)
+        rows = np.asarray(rows, dtype=np.int32)
+        days = np.asarray(days, dtype=np.int32)
+        by_subject = np.lexsort((days, subject_ids))
+        counts = np.bincount(subject_ids, minlength=len(subjects))
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        by_date = np.argsort(days, kind='mergesort')
+        return cls(subjects, rows[by_subject], offsets, days[by_subject],
+                   rows[by_date], days[by_date])
+
+    @classmethod
+    def from_db(cls, conn, missing=None):
+        """
+        Read subject and date of every article.
+
+        Args:
+            conn (connection): open psycopg2 connection
+            missing (ndarray): rows with no vector, left out
+
+        Returns:
+            RowFilter
+        """
+        epoch = datetime.date(1970, 1, 1)
+        missing = set() if missing is None else set(missing.tolist())
+        rows, subject_names, days = [], [], []
+        with conn.cursor(name='row_filter') as cur:
+            cur.execute("SELECT index, subject, last_submitted FROM articles \
+                WHERE subject IS NOT NULL AND last_submitted IS NOT NULL")
+            for index, subject, submitted in cur:
+                if index in missing:
+                    continue
+                rows.append(index)
+                subject_names.append(subject)
+                days.append((submitted - epoch).days)
+        return cls.from_arrays(rows, subject_names, days)
+
+    def save(self, path):
+        np.savez(path, subjects=np.array(self.subjects), order=self.order,
+                 offsets=self.offsets, days=self.days,
+                 date_order=self.date_order, date_days=self.date_days)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['subjects'].tolist(), data['order'], data['offsets'], data['days'],
+                   data['date_order'], data['date_days'])
+
+    def rows(self, subject=None, since=None, until=None):
+        """
+        Args:
+            subject (str): subject name, or None for any subject
+            since (date): earliest submission date, inclusive
+            until (date): latest submission date, inclusive
+
+        Returns:
+            ndarray: matching rows. A view, do not modify it.
+        """
+        if subject is None:
+            order, days = self.date_order, self.date_days
+        else:
+            j = self.subject_codes.get(subject)
+            if j is None:
+                return self.order[:0]
+            start, end = self.offsets[j], self.offsets[j + 1]
+            order, days = self.order[start:end], self.days[start:end]
+        epoch = datetime.date(1970, 1, 1)
+        lo = 0 if since is None else np.searchsorted(days, (since - epoch).days, 'left')
+        hi = len(days) if until is None else np.searchsorted(days, (until - epoch).days, 'right')
+        return order[lo:hi]
+
+    def allows(self, ids, subject=None, since=None, until=None):
+        """
+        Which of the given rows match a filter, without building
+        the list of all rows that do.
+
+        Args:
+            ids (ndarray): candidate rows, e.g. from IVFIndex.candidates()
+            subject, since, until: as for rows()
+
+        Returns:
+            ndarray: boolean mask over ids
+        """
+        if subject is None:
+            rows, days = self.all_rows, self.all_days
+        else:
+            j = self.subject_codes.get(subject)
+            if j is None:
+                return np.zeros(len(ids), dtype=bool)
+            start, end = self.offsets[j], self.offsets[j + 1]
+            rows, days = self.row_order[start:end], self.row_days[start:end]
+        if not len(rows):
+            return np.zeros(len(ids), dtype=bool)
+        pos = np.minimum(np.searchsorted(rows, ids), len(rows) - 1)
+        keep = rows[pos] == ids
+        epoch = datetime.date(1970, 1, 1)
+        if since is not None:
+            keep &= days[pos] >= (since - epoch).days
+        if until is not None:
+            keep &= days[pos] <= (until - epoch).days
+        return keep
+
+
+def filtered_search(index, exact_index, query, row_filter, topn=10, exclude=None,
+                    subject=None, since=None, until=None):
+    """
+    Search only the rows matching a filter, with whichever of the
+    two indexes scores fewer documents. A narrow filter is answered
+    exactly from its own rows; a broad one scores the IVF index's
+    candidates that match it, and falls back to the rows if the
+    probed buckets hold too few matches.
+
+    Args:
+        index: the served index, IVFIndex or otherwise
+        exact_index (ExactIndex): over the same vectors
+        query (ndarray): 1d query vector
+        row_filter (RowFilter): subjects and dates of the rows
+        topn (int): number of neighbors to return
+        exclude (int): article index to leave out of results
+        subject, since, until: the filter, as for RowFilter.rows()
+
+    Returns:
+        list: (index, similarity) tuples, most similar first
+    """
+    rows = row_filter.rows(subject, since, until)
+    if isinstance(index, IVFIndex) and len(rows) > index.scan_size():
+        # sorted, the lookups in allows() and the reads of the rows go in order
+        ids = np.sort(index.candidates(normalized(query[np.newaxis, :])[0]))
+        ids = ids[row_filter.allows(ids, subject, since, until)]
+        results = exact_index.search(query, topn=topn, exclude=exclude, ids=ids)
+        if len(results) == topn:
+            return results
+    # articles ingested since the model was last updated have no vector yet
+    rows = rows[rows < len(exact_index.vectors)]
+    return exact_index.search(query, topn=topn, exclude=exclude, ids=rows)
+
+
+def assign_to_lists(vectors, centroids, batch_size=50000):
+    """
+    Nearest centroid for every vector, in batches
+    so the score matrix stays small.
+    """
+    assign = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), batch_size):
+        batch = vectors[start:start + batch_size]
+        assign[start:start + batch_size] = np.argmax(np.dot(batch, centroids.T), axis=1)
+    return assign
+
+
+def batch_top_k(groups, score, n_queries, k):
+    """
+    Best k candidates of each query, out of blocks of candidate
+    rows that are each scored for several queries at once.
+
+    Args:
+        groups (iterable): (rows, query numbers) pairs, e.g. from
+            IVFIndex.probe_groups()
+        score (function): score(rows, query numbers) returns the
+            (len(rows), len(query numbers)) matrix of scores
+        n_queries (int): number of queries
+        k (int): candidates to keep per query
+
+    Returns:
+        list: for each query, (ids, scores) arrays of its best
+            candidates, unsorted
+    """
+    ids = [[] for _ in range(n_queries)]
+    scores = [[] for _ in range(n_queries)]
+    for rows, which in groups:
+        if not len(rows) or not len(which):
+            continue
+        block = score(rows, which)
+        if k < len(rows):
+            top = np.argpartition(-block, k - 1, axis=0)[:k]
+        else:
+            top = np.repeat(np.arange(len(rows))[:, np.newaxis], len(which), axis=1)
+        for col, q in enumerate(which):
+            ids[q].append(rows[top[:, col]])
+            scores[q].append(block[top[:, col], col])
+    return [(np.concatenate(i) if i else np.empty(0, dtype=np.int64),
+             np.concatenate(s) if s else np.empty(0, dtype=np.float32))
+            for i, s in zip(ids, scores)]
+
+
+def search_batch(index, queries, topn=10):
+    """
+    Search for every row of queries, with one matrix multiply
+    if the index supports it and one search() per query otherwise.
+
+    Returns:
+        list: for each query, (index, similarity) tuples, most similar first
+    """
+    if hasattr(index, 'search_batch'):
+        return index.search_batch(queries, topn=topn)
+    return [index.search(query, topn=topn) for query in queries]
+
+
+def recall_at_k(index, reference, vectors, query_ids, k=10):
+    """
+    Fraction of the reference index's top k neighbors that
+    the index under test also returns, averaged over queries.
+
+    Args:
+        index: IVFIndex (or anything with search())
+        reference: ExactIndex
+        vectors (ndarray): docvecs to draw queries from
+        query_ids (list): article indices to use as queries
+        k (int): neighbors per query
+
+    Returns:
+        float: mean recall in [0, 1]
+    """
+    hits = 0
+    for i in query_ids:
+        truth = set(idx for idx, _ in reference.search(vectors[i], k, exclude=i))
+        found = set(idx for idx, _ in index.search(vectors[i], k, exclude=i))
+        hits += len(truth & found)
+    return hits / float(k * len(query_ids))
+
+
+def index_path(model_path):
+    """Where the IVF index for a model is stored."""
+    return model_path + '.ivf.npz'
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='build IVF index of docvecs for a model')
+    parser.add_argument('path_to_model', help="Trained Doc2Vec model")
+    parser.add_argument('--n_lists', type=int, default=1024, help="Number of buckets")
+    parser.add_argument('--n_check', type=int, default=200,
+                        help="Documents to use when checking recall against exact search")
+    args = parser.parse_args()
+
+    # imported here so the indexes themselves do not need gensim
+    import serving
+    model, vectors = serving.load(args.path_to_model)
+
+    start = time.time()
+    index = IVFIndex.build(vectors, n_lists=args.n_lists)
+    index.save(index_path(args.path_to_model))
+    print("Built %d buckets over %d docs in %.1fs" % (
+        len(index.centroids), len(vectors), time.time() - start))
+
+    exact = ExactIndex(vectors)
+    query_ids = np.random.RandomState(1).choice(len(vectors), args.n_check, replace=False)
+    for nprobe in (1, 4, 16, 64):
+        index.nprobe = nprobe
+        start = time.time()
+        recall = recall_at_k(index, exact, vectors, query_ids)
+        print("nprobe=%d recall@10=%.3f (%.2f ms/query incl. exact)" % (
+            nprobe, recall, 1000 * (time.time() - start) / len(query_ids)))
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+"""
+Data shared by the tests.
+"""
+
+
+def clustered_vectors(n=2000, dim=32, n_clusters=20, spread=0.3, seed=0):
+    """
+    Unit vectors scattered around n_clusters random centres,
+    like docvecs of articles on a handful of topics.
+    """
+    rng = np.random.RandomState(seed)
+    centres = rng.randn(n_clusters, dim)
+    vectors = centres[rng.randint(n_clusters, size=n)] + spread * rng.randn(n, dim)
+    vectors /= np.linalg.norm(vectors, axis=1)[:, np.newaxis]
+    return vectors.astype(np.float32)
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+"""
+The modules under test are scripts rather than an installed
+package, so make the repository root and the script
+directories importable, as the populate_db scripts do.
+"""
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for path in (ROOT, os.path.join(ROOT, 'scrape'), os.path.join(ROOT, 'populate_db')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
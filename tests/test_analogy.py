@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from analogy import AnalogyIndex
+from tests import clustered_vectors
+
+"""
+Analogies against a brute-force scan of the word vectors.
+"""
+
+
+class Vocab(object):
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+
+
+class FakeModel(object):
+    """The parts of a Doc2Vec model AnalogyIndex reads."""
+    def __init__(self, vectors, counts):
+        self.syn0 = vectors
+        self.syn0norm = None
+        self.index2word = ['w%d' % i for i in range(len(vectors))]
+        self.vocab = dict((word, Vocab(i, count))
+                          for i, (word, count) in enumerate(zip(self.index2word, counts)))
+
+    def init_sims(self):
+        self.syn0norm = self.syn0 / np.linalg.norm(self.syn0, axis=1)[:, np.newaxis]
+
+
+def fake_model(n=500, sorted_by_count=True):
+    counts = np.arange(n, 0, -1) * 10
+    if not sorted_by_count:
+        counts = np.random.RandomState(1).permutation(counts)
+    return FakeModel(clustered_vectors(n=n), counts)
+
+
+def brute_force(model, positive, negative, topn, candidates=None):
+    vectors = model.syn0norm
+    rows = [model.vocab[word].index for word in positive + negative]
+    query = vectors[rows[:len(positive)]].sum(axis=0) - vectors[rows[len(positive):]].sum(axis=0)
+    scores = np.dot(vectors, query / np.linalg.norm(query))
+    if candidates is None:
+        candidates = np.arange(len(vectors))
+    ranked = [i for i in candidates[np.argsort(-scores[candidates], kind='mergesort')]
+              if i not in rows]
+    return [(model.index2word[i], scores[i]) for i in ranked[:topn]]
+
+
+QUERIES = [(['w1', 'w2'], ['w3']), (['w10'], []), ([], ['w42']), (['w7', 'w300'], ['w5', 'w99'])]
+
+
+@pytest.mark.parametrize('sorted_by_count', [True, False])
+def test_matches_brute_force(sorted_by_count):
+    model = fake_model(sorted_by_count=sorted_by_count)
+    index = AnalogyIndex(model)
+    for positive, negative in QUERIES:
+        expected = brute_force(model, positive, negative, 10)
+        results = index.most_similar(positive=positive, negative=negative, topn=10)
+        assert [word for word, _ in results] == [word for word, _ in expected]
+        assert np.allclose([s for _, s in results], [s for _, s in expected], atol=1e-5)
+
+
+@pytest.mark.parametrize('sorted_by_count', [True, False])
+def test_top_n_only_answers_with_frequent_words(sorted_by_count):
+    model = fake_model(sorted_by_count=sorted_by_count)
+    index = AnalogyIndex(model, top_n=100)
+    counts = np.array([model.vocab[word].count for word in model.index2word])
+    frequent = np.argsort(-counts, kind='mergesort')[:100]
+    # query words can be rare
+    rare = model.index2word[int(np.argmin(counts))]
+    for positive, negative in QUERIES + [([rare], [])]:
+        expected = brute_force(model, positive, negative, 10, candidates=frequent)
+        results = index.most_similar(positive=positive, negative=negative, topn=10)
+        assert [word for word, _ in results] == [word for word, _ in expected]
+
+
+def test_batch_matches_single_queries():
+    index = AnalogyIndex(fake_model())
+    batch = index.most_similar_batch(QUERIES, topn=5, block=3)
+    fresh = AnalogyIndex(fake_model())
+    for (positive, negative), results in zip(QUERIES, batch):
+        single = fresh.most_similar(positive=positive, negative=negative, topn=5)
+        assert [word for word, _ in results] == [word for word, _ in single]
+        assert np.allclose([s for _, s in results], [s for _, s in single], atol=1e-5)
+
+
+def test_unknown_and_empty_queries():
+    index = AnalogyIndex(fake_model())
+    results = index.most_similar_batch([(['w1', 'nope'], []), ([], []), (['w1'], [])], topn=3)
+    assert isinstance(results[0], KeyError)
+    assert isinstance(results[1], ValueError)
+    assert len(results[2]) == 3
+    with pytest.raises(KeyError):
+        index.most_similar(positive=['nope'])
+    with pytest.raises(ValueError):
+        index.most_similar()
+
+
+def test_topn_zero_and_beyond_the_vocabulary():
+    index = AnalogyIndex(fake_model(n=50), top_n=5)
+    assert index.most_similar(positive=['w1'], topn=0) == []
+    # the query word is left out of the five candidates
+    results = index.most_similar(positive=['w1'], topn=10)
+    assert sorted(word for word, _ in results) == ['w0', 'w2', 'w3', 'w4']
+
+
+def test_answers_are_cached_whatever_the_word_order():
+    index = AnalogyIndex(fake_model())
+    first = index.most_similar(positive=['w1', 'w2'], negative=['w3'])
+    assert index.most_similar(positive=['w2', 'w1'], negative=['w3']) is first
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+from cache import LRUCache, TTLCache
+
+"""
+The web app's in-process caches.
+"""
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1  # now b is the least recently used
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_lru_put_refreshes_existing_key():
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.put('a', 10)
+    cache.put('c', 3)
+    assert cache.get('a') == 10
+    assert cache.get('b', 'gone') == 'gone'
+
+
+def test_lru_counts_hits_and_misses():
+    cache = LRUCache()
+    cache.put(1, 'one')
+    cache.get(1)
+    cache.get(2)
+    found = cache.get_many([1, 2, 3])
+    assert found == {1: 'one'}
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_lru_get_many_refreshes_found_keys():
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get_many(['a'])
+    cache.put('c', 3)
+    assert 'a' in cache.get_many(['a', 'b'])
+    assert 'b' not in cache.get_many(['a', 'b'])
+
+
+def test_lru_clear():
+    cache = LRUCache()
+    cache.put('a', 1)
+    cache.clear()
+    assert len(cache) == 0 and cache.get('a') is None
+
+
+def test_lru_is_thread_safe():
+    cache = LRUCache(maxsize=100)
+
+    def work(offset):
+        for i in range(2000):
+            cache.put(offset + i % 150, i)
+            cache.get(offset + (i * 7) % 150)
+
+    threads = [threading.Thread(target=work, args=(n * 1000,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(cache) == 100
+    assert cache.hits + cache.misses == 8 * 2000
+
+
+class Clock(object):
+    """Stands in for time.time, moved forward by hand."""
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_entries_expire(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'time', clock)
+    cache = TTLCache(ttl=600)
+    cache.put('all', ['math'])
+    clock.now += 599
+    assert cache.get('all') == ['math']
+    clock.now += 2
+    assert cache.get('all') is None
+    assert cache.get('all', 'expired') == 'expired'
+
+
+def test_ttl_put_restarts_the_clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'time', clock)
+    cache = TTLCache(ttl=10)
+    cache.put('k', 1)
+    clock.now += 8
+    cache.put('k', 2)
+    clock.now += 8
+    assert cache.get('k') == 2
+
+
+def test_ttl_clear_drops_everything():
+    cache = TTLCache(ttl=600)
+    cache.put('all', ['math'])
+    cache.clear()
+    assert cache.get('all') is None
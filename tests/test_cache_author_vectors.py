@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from cache_author_vectors import author_vectors
+from tests import clustered_vectors
+
+"""
+Mean docvec per author.
+"""
+
+
+def expected_vectors(author_ids, article_ids, vectors, min_articles):
+    expected = {}
+    for author in set(author_ids.tolist()):
+        rows = article_ids[(author_ids == author) & (article_ids < len(vectors))]
+        if len(rows) >= min_articles:
+            mean = vectors[rows].mean(axis=0)
+            expected[author] = mean / np.linalg.norm(mean)
+    return expected
+
+
+def test_matches_normalized_means():
+    rng = np.random.RandomState(0)
+    vectors = clustered_vectors(n=500)
+    author_ids = rng.randint(0, 120, 1500)
+    # a few authorships of articles with no vector yet
+    article_ids = np.concatenate([rng.randint(0, 500, 1490), np.arange(500, 510)])
+    for min_articles in [1, 2, 15]:
+        for block_authors in [7, 10000]:
+            ids, author_vecs = author_vectors(author_ids, article_ids, vectors,
+                                              min_articles=min_articles, block_authors=block_authors)
+            expected = expected_vectors(author_ids, article_ids, vectors, min_articles)
+            assert ids.tolist() == sorted(expected)
+            assert np.allclose(author_vecs, [expected[i] for i in ids], atol=1e-5)
+
+
+def test_authors_of_only_unembedded_articles_are_left_out():
+    vectors = clustered_vectors(n=10)
+    ids, _ = author_vectors(np.array([1, 1, 2, 2]), np.array([3, 4, 10, 11]), vectors)
+    assert ids.tolist() == [1]
+
+
+def test_no_author_with_enough_articles():
+    vectors = clustered_vectors(n=10)
+    ids, author_vecs = author_vectors(np.array([1, 2]), np.array([3, 4]), vectors)
+    assert len(ids) == 0 and author_vecs.shape == (0, vectors.shape[1])
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from cache_neighbors import cache_neighbors, merge_top_k
+from tests import clustered_vectors
+
+"""
+The blocked top-k neighbor table against a full similarity matrix.
+"""
+
+
+def test_merge_top_k_keeps_the_best_of_both():
+    best_ids = np.array([[7, 8], [7, 8]])
+    best_scores = np.array([[0.9, 0.1], [0.2, 0.1]])
+    ids = np.array([0, 1, 2])
+    scores = np.array([[0.5, 0.95, 0.0], [0.3, 0.4, 0.25]])
+    merged_ids, merged_scores = merge_top_k(best_ids, best_scores, ids, scores, 2)
+    rows = np.arange(2)[:, np.newaxis]
+    order = np.argsort(-merged_scores, axis=1)
+    assert merged_ids[rows, order].tolist() == [[1, 7], [1, 0]]
+    assert merged_scores[rows, order].tolist() == [[0.95, 0.9], [0.4, 0.3]]
+
+
+def test_merge_top_k_with_fewer_columns_than_k():
+    best_ids = np.full((2, 3), -1)
+    best_scores = np.full((2, 3), -np.inf)
+    merged_ids, merged_scores = merge_top_k(best_ids, best_scores, np.array([4, 5]),
+                                            np.array([[0.1, 0.2], [0.3, -0.1]]), 3)
+    assert sorted(merged_ids[0].tolist()) == [-1, 4, 5]
+    assert sorted(merged_scores[1].tolist()) == [-np.inf, -0.1, 0.3]
+
+
+def test_merge_top_k_over_tiles_matches_a_full_sort():
+    rng = np.random.RandomState(0)
+    scores = rng.rand(20, 100)
+    best_ids = np.full((20, 5), -1)
+    best_scores = np.full((20, 5), -np.inf)
+    for start in range(0, 100, 16):
+        end = min(start + 16, 100)
+        best_ids, best_scores = merge_top_k(best_ids, best_scores, np.arange(start, end),
+                                            scores[:, start:end], 5)
+    expected = np.argsort(-scores, axis=1)[:, :5]
+    assert (np.sort(best_ids, axis=1) == np.sort(expected, axis=1)).all()
+
+
+def test_cache_neighbors_matches_brute_force(tmpdir):
+    vectors = clustered_vectors(n=700)
+    vectors_file = str(tmpdir.join('model.docvecs_norm.npy'))
+    ids_file = str(tmpdir.join('model.neighbors.npy'))
+    scores_file = str(tmpdir.join('model.neighbor_scores.npy'))
+    np.save(vectors_file, vectors)
+    cache_neighbors(vectors_file, ids_file, scores_file, k=10,
+                    block_rows=64, block_cols=100, n_workers=2)
+    neighbors, scores = np.load(ids_file), np.load(scores_file)
+
+    similarity = np.dot(vectors, vectors.T)
+    np.fill_diagonal(similarity, -np.inf)
+    expected = np.argsort(-similarity, axis=1, kind='mergesort')[:, :10]
+    # an article is never its own neighbor, and neighbors come best first
+    assert not (neighbors == np.arange(700)[:, np.newaxis]).any()
+    assert (np.diff(scores.astype(np.float32), axis=1) <= 0).all()
+    rows = np.arange(700)[:, np.newaxis]
+    assert np.allclose(scores, similarity[rows, expected], atol=1e-3)
+    # ties aside, the same neighbors
+    assert (neighbors == expected).mean() > 0.99
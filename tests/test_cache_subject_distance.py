@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('psycopg2')
+
+from cache_subject_distance import get_distance_mat, get_n_closest, get_subject_vectors
+from tests import clustered_vectors
+
+"""
+Subject vectors and the closest subjects of each.
+"""
+
+
+def test_subject_vectors_are_means_of_their_articles():
+    rng = np.random.RandomState(0)
+    docvecs = clustered_vectors(n=1000)
+    # articles in random order, some with no docvec yet
+    indices = rng.permutation(np.arange(1, 1020))
+    subject_ids = rng.choice([3, 7, 8, 20], len(indices))
+    for block_rows in [50, 65536]:
+        vectors = get_subject_vectors(indices, subject_ids, docvecs, block_rows=block_rows)
+        assert vectors.index.tolist() == [3, 7, 8, 20]
+        for subject in [3, 7, 8, 20]:
+            rows = indices[(subject_ids == subject) & (indices < 1000)]
+            assert np.allclose(vectors.loc[subject].values, docvecs[rows].mean(axis=0), atol=1e-5)
+
+
+def test_n_closest_matches_a_full_sort():
+    rng = np.random.RandomState(1)
+    vectors = pd.DataFrame(rng.randn(12, 5), index=np.arange(100, 112))
+    distance_mat = get_distance_mat(vectors)
+    D = distance_mat.values
+    edges = get_n_closest(distance_mat, n=3)
+    assert len(edges) == 12 * 3
+    for i, subject in enumerate(distance_mat.index):
+        mine = [(related, dist) for source, related, dist in edges if source == subject]
+        others = [j for j in np.argsort(D[i], kind='mergesort') if j != i][:3]
+        assert [related for related, _ in mine] == [distance_mat.index[j] for j in others]
+        assert np.allclose([dist for _, dist in mine], D[i, others])
+
+
+def test_n_closest_with_few_subjects():
+    vectors = pd.DataFrame(np.eye(3), index=[1, 2, 3])
+    distance_mat = get_distance_mat(vectors)
+    # every other subject, however many are asked for
+    assert len(get_n_closest(distance_mat, n=10)) == 3 * 2
+    single = get_distance_mat(pd.DataFrame(np.ones((1, 3)), index=[1]))
+    assert get_n_closest(single, n=5) == []
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import pytest
+
+pytest.importorskip('gensim')
+pytest.importorskip('psycopg2')
+
+from corpus_cache import CachedCorpus, build, ensure, is_fresh
+from tokenizer import tokenize
+
+"""
+Round trip of the corpus cache, and rebuilding it when the
+articles table changes.
+"""
+
+
+class FakeCursor(object):
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query):
+        self.rows = iter(sorted(self.table.items()))
+
+    def fetchone(self):
+        # what table_fingerprint's query computes in postgres
+        checksum = 0
+        for index, (title, abstract) in self.table.items():
+            text = '%d|%s|%s' % (index, title or '', abstract or '')
+            first32 = int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
+            checksum += first32 - (1 << 32) if first32 >= 1 << 31 else first32
+        return len(self.table), max(self.table) if self.table else None, checksum
+
+    def fetchmany(self, size):
+        batch = []
+        for index, (title, abstract) in self.rows:
+            batch.append((index, title, abstract))
+            if len(batch) == size:
+                break
+        return batch
+
+
+class FakeConnection(object):
+    """An articles table held as {index: (title, abstract)}."""
+    def __init__(self, table):
+        self.table = table
+
+    def cursor(self, name=None):
+        return FakeCursor(self.table)
+
+
+TABLE = {
+    1: (u'Dark Matter Halos', u'We simulate halos.'),
+    2: (u'Schrödinger Bridges', None),
+    5: (u'Graph Neural Networks', u'Message passing, revisited!'),
+    6: (None, None),
+}
+
+
+def test_round_trip(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    build(FakeConnection(dict(TABLE)), cache_dir, workers=1, batch_size=2)
+    corpus = CachedCorpus(cache_dir)
+    assert len(corpus) == len(TABLE)
+    for _ in range(2):
+        documents = list(corpus)
+        assert [doc.tags for doc in documents] == [[1], [2], [5], [6]]
+        for doc in documents:
+            title, abstract = TABLE[doc.tags[0]]
+            assert doc.words == tokenize(title or '', abstract or '')
+
+
+def test_empty_table(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    build(FakeConnection({}), cache_dir, workers=1)
+    assert list(CachedCorpus(cache_dir)) == []
+
+
+def test_new_or_changed_articles_invalidate_the_cache(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    conn = FakeConnection(dict(TABLE))
+    assert not is_fresh(conn, cache_dir)
+    ensure(conn, cache_dir, workers=1)
+    assert is_fresh(conn, cache_dir)
+
+    # an updated abstract keeps the count and the largest index
+    conn.table[2] = (u'Schrödinger Bridges', u'Now with an abstract.')
+    assert not is_fresh(conn, cache_dir)
+    ensure(conn, cache_dir, workers=1)
+    assert is_fresh(conn, cache_dir)
+    words = dict((doc.tags[0], doc.words) for doc in CachedCorpus(cache_dir))
+    assert words[2] == tokenize(u'Schrödinger Bridges', u'Now with an abstract.')
+
+    conn.table[7] = (u'A new article', u'')
+    assert not is_fresh(conn, cache_dir)
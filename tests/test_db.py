@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+psycopg2 = pytest.importorskip('psycopg2')
+
+import db
+from db import Pool, PoolTimeout
+
+"""
+Checkout and return of pooled connections, on success and on errors.
+"""
+
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query):
+        if self.conn.dead:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.closed = 0
+        self.dead = False
+        self.autocommit = False
+
+    def cursor(self, **kwargs):
+        return FakeCursor(self)
+
+
+class FakeThreadedPool(object):
+    """Stands in for psycopg2's ThreadedConnectionPool, recording putconn calls."""
+    def __init__(self, minconn, maxconn, **kwargs):
+        self.idle = [FakeConnection() for _ in range(minconn)]
+        self.returned = []
+
+    def getconn(self):
+        return self.idle.pop() if self.idle else FakeConnection()
+
+    def putconn(self, conn, close=False):
+        self.returned.append((conn, close))
+        if close:
+            conn.closed = 1
+        else:
+            self.idle.append(conn)
+
+    def closeall(self):
+        pass
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(db, 'ThreadedConnectionPool', FakeThreadedPool)
+    return Pool(minconn=1, maxconn=2, timeout=0.05)
+
+
+def test_connection_is_returned_after_use(pool):
+    with pool.connection() as conn:
+        assert conn.autocommit
+        assert pool.snapshot()['in_use'] == 1
+    assert pool.pool.returned == [(conn, False)]
+    stats = pool.snapshot()
+    assert stats['in_use'] == 0 and stats['checkouts'] == 1 and stats['size'] == 2
+
+
+def test_connection_is_returned_when_the_block_raises(pool):
+    with pytest.raises(ValueError):
+        with pool.connection() as conn:
+            raise ValueError("bad query")
+    # a query error does not break the connection
+    assert pool.pool.returned == [(conn, False)]
+    assert pool.snapshot()['in_use'] == 0
+    # and both slots are free again
+    with pool.connection():
+        with pool.connection():
+            pass
+
+
+@pytest.mark.parametrize('error', [psycopg2.OperationalError, psycopg2.InterfaceError])
+def test_broken_connection_is_closed_not_reused(pool, error):
+    with pytest.raises(error):
+        with pool.connection() as conn:
+            raise error("connection lost")
+    assert pool.pool.returned == [(conn, True)]
+    with pool.connection() as other:
+        assert other is not conn
+
+
+def test_connection_closed_during_use_is_not_reused(pool):
+    with pool.connection() as conn:
+        conn.closed = 2
+    assert pool.pool.returned == [(conn, True)]
+
+
+def test_waits_then_times_out_when_all_are_checked_out(pool):
+    with pool.connection():
+        with pool.connection():
+            with pytest.raises(PoolTimeout):
+                with pool.connection():
+                    pass
+    stats = pool.snapshot()
+    assert stats['timeouts'] == 1 and stats['in_use'] == 0 and stats['checkouts'] == 2
+
+
+def test_idle_connection_that_fails_its_ping_is_replaced(monkeypatch):
+    monkeypatch.setattr(db, 'ThreadedConnectionPool', FakeThreadedPool)
+    pool = Pool(minconn=1, maxconn=2, ping_after=0.)
+    dead = pool.pool.idle[0]
+    dead.dead = True
+    with pool.connection() as conn:
+        assert conn is not dead
+    assert pool.pool.returned[0] == (dead, True)
+    assert pool.snapshot()['reconnects'] == 1
+
+
+def test_cursor_borrows_a_connection(pool):
+    with pool.cursor() as cur:
+        cur.execute("SELECT 1")
+        assert pool.snapshot()['in_use'] == 1
+    assert pool.snapshot()['in_use'] == 0
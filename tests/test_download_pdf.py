@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import pytest
+
+requests = pytest.importorskip('requests')
+import download_pdf
+from download_pdf import DownloadState, TokenBucket, download, download_all, make_session
+
+"""
+The downloader against a local http.server standing in for arXiv.
+"""
+
+PDF = b'%PDF-1.4\n' + b'x' * 100000 + b'\n%%EOF\n'
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Serves PDF at /<name>.pdf, misbehaving on the first request
+    for some names:
+        limited: 429 with Retry-After
+        truncated: a body cut off halfway through
+        missing: always 404
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        name = self.path.strip('/')[:-len('.pdf')]
+        with self.server.lock:
+            self.server.hits[name] = self.server.hits.get(name, 0) + 1
+            first = self.server.hits[name] == 1
+        if name == 'missing':
+            self.reply(404, b'not found', 'text/plain')
+        elif name == 'limited' and first:
+            self.reply(429, b'slow down', 'text/plain', {'Retry-After': '0'})
+        elif name == 'truncated' and first:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Content-Length', str(len(PDF)))
+            self.end_headers()
+            self.wfile.write(PDF[:len(PDF) // 2])
+            self.close_connection = True
+        else:
+            self.reply(200, PDF, 'application/pdf')
+
+    def reply(self, code, body, content_type, headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer(('127.0.0.1', 0), Handler)
+    httpd.hits = {}
+    httpd.lock = threading.Lock()
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def base_url(server):
+    return 'http://127.0.0.1:%d/' % server.server_address[1]
+
+
+def fetch_one(server, out_dir, arxiv_id):
+    session = make_session(1)
+    try:
+        return download(session, TokenBucket(1000, burst=10), base_url(server), str(out_dir),
+                        arxiv_id, max_retries=3, backoff=0.01)
+    finally:
+        session.close()
+
+
+def read(path):
+    with open(str(path), 'rb') as fp:
+        return fp.read()
+
+
+def test_ok(server, tmpdir):
+    assert fetch_one(server, tmpdir, 'ok') == ('ok', 1)
+    assert read(tmpdir.join('ok.pdf')) == PDF
+
+
+def test_missing_is_final(server, tmpdir):
+    assert fetch_one(server, tmpdir, 'missing') == ('missing', 1)
+    assert not tmpdir.join('missing.pdf').exists()
+
+
+def test_429_honours_retry_after(server, tmpdir):
+    assert fetch_one(server, tmpdir, 'limited') == ('ok', 2)
+    assert read(tmpdir.join('limited.pdf')) == PDF
+
+
+def test_truncated_body_is_retried_not_kept(server, tmpdir):
+    assert fetch_one(server, tmpdir, 'truncated') == ('ok', 2)
+    assert read(tmpdir.join('truncated.pdf')) == PDF
+    assert not tmpdir.join('truncated.pdf.part').exists()
+
+
+def test_unexpected_error_is_recorded(server, tmpdir):
+    # the output directory does not exist, so writing the .part file fails
+    status, attempts = fetch_one(server, tmpdir.join('nowhere'), 'ok')
+    assert (status, attempts) == ('error', 1)
+
+
+def test_resume_from_state(server, tmpdir):
+    path = str(tmpdir.join('state.jsonl'))
+    with open(path, 'w') as fp:
+        fp.write(json.dumps({'id': 'done', 'status': 'ok', 'attempts': 1}) + '\n')
+        fp.write(json.dumps({'id': 'failed', 'status': 'error', 'attempts': 5}) + '\n')
+        # a line cut off by a crash
+        fp.write('{"id": "ok", "sta')
+    state = DownloadState(path)
+    try:
+        counts = download_all(['done', 'failed', 'ok', 'missing'], str(tmpdir), state,
+                              workers=2, rate=1000, base_url=base_url(server))
+    finally:
+        state.close()
+    assert counts == {'skipped': 1, 'ok': 2, 'missing': 1}
+    assert 'done' not in server.hits
+    assert tmpdir.join('failed.pdf').exists()
+
+    state = DownloadState(path)
+    try:
+        assert all(state.done(arxiv_id) for arxiv_id in ('done', 'failed', 'ok', 'missing'))
+        assert state.attempts['failed'] == 6
+        counts = download_all(['done', 'failed', 'ok', 'missing'], str(tmpdir), state,
+                              base_url=base_url(server))
+    finally:
+        state.close()
+    assert counts == {'skipped': 4}
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from fulltext import clean, compress, decompress, paragraphs
+
+"""
+Cleaning, chunking and compressing extracted full text.
+"""
+
+
+def test_clean_rejoins_hyphenated_words_and_joins_lines():
+    text = "Neural net-\nworks are\nuniversal   approx-\nimators.\n\n\nSecond\tparagraph.\n"
+    assert clean(text) == "Neural networks are universal approximators.\n\nSecond paragraph."
+
+
+def test_clean_turns_page_breaks_into_paragraph_breaks():
+    assert clean("end of page one\fstart of page two") == "end of page one\n\nstart of page two"
+
+
+def test_clean_keeps_dashes_that_are_not_line_breaks():
+    assert clean("a well-known\nresult - see below") == "a well-known result - see below"
+
+
+def test_clean_drops_blank_paragraphs():
+    assert clean("\n \n\f\n  \nonly one\n\n \n") == "only one"
+    assert clean("") == ""
+
+
+def test_paragraphs_merges_short_ones_into_the_next():
+    text = clean("1 Introduction\n\n" + "word " * 60 + "\n\n" + "short tail")
+    chunks = list(paragraphs(text, min_words=50))
+    assert chunks == ["1 Introduction " + ("word " * 60).strip(), "short tail"]
+
+
+def test_paragraphs_keeps_long_ones_apart():
+    long_paragraph = ' '.join(['word'] * 10)
+    text = '\n\n'.join([long_paragraph] * 3)
+    assert list(paragraphs(text, min_words=10)) == [long_paragraph] * 3
+    assert list(paragraphs(text, min_words=15)) == [long_paragraph + ' ' + long_paragraph,
+                                                   long_paragraph]
+
+
+def test_paragraphs_of_nothing():
+    assert list(paragraphs(clean(""))) == []
+
+
+def test_compress_round_trip():
+    text = clean(u"Schrödinger's équation,\nrevisited.\n\n" + u"∂ψ/∂t = Hψ " * 200)
+    body = compress(text)
+    assert isinstance(body, bytes)
+    assert len(body) < len(text.encode('utf-8')) // 3
+    assert decompress(body) == text
+    # psycopg2 returns bytea columns as memoryviews
+    assert decompress(memoryview(body)) == text
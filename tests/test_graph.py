@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from scipy import sparse
+from graph import GraphTiles, build_layers, knn_graph, louvain, modularity, save
+from similarity import ExactIndex
+from tests import clustered_vectors
+
+"""
+Community detection on the kNN graph, and the tiles served from it.
+"""
+
+
+def neighbor_table(vectors, k=10):
+    index = ExactIndex(vectors)
+    results = [index.search(vectors[i], topn=k, exclude=i) for i in range(len(vectors))]
+    neighbors = np.array([[idx for idx, _ in row] for row in results])
+    scores = np.array([[score for _, score in row] for row in results], dtype=np.float32)
+    return neighbors, scores
+
+
+def two_triangles():
+    """Triangles 0-1-2 and 3-4-5, joined by the edge 2-3."""
+    edges = [(0, 1), (0, 2), (1, 2), (3, 4), (3, 5), (4, 5), (2, 3)]
+    rows, cols = zip(*(edges + [(b, a) for a, b in edges]))
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(6, 6))
+
+
+def test_modularity_of_two_triangles():
+    A = two_triangles()
+    # 2 * (3/7 - (7/14)**2)
+    assert abs(modularity(A, np.array([0, 0, 0, 1, 1, 1])) - 5. / 14) < 1e-9
+    assert abs(modularity(A, np.zeros(6, dtype=int))) < 1e-9
+
+
+def test_knn_graph_is_symmetric_without_self_loops():
+    neighbors = np.array([[1, 0], [2, 1], [0, 1]])
+    scores = np.array([[0.5, 1.0], [0.25, 1.0], [-0.5, 0.75]], dtype=np.float32)
+    A = knn_graph(neighbors, scores)
+    assert (A != A.T).nnz == 0
+    assert A.diagonal().sum() == 0
+    assert A[0, 1] == 0.5
+    # the stronger of the two directions
+    assert A[1, 2] == A[2, 1] == 0.75
+    # negative similarities are not edges
+    assert A[0, 2] == 0
+
+
+def test_louvain_finds_the_triangles():
+    levels = louvain(two_triangles())
+    labels = levels[0]
+    assert len(set(labels[:3])) == 1 and len(set(labels[3:])) == 1
+    assert labels[0] != labels[3]
+
+
+def test_louvain_levels_nest_and_raise_modularity():
+    vectors = clustered_vectors(n=600, n_clusters=6)
+    A = knn_graph(*neighbor_table(vectors))
+    levels = louvain(A)
+    assert levels
+    labels = np.arange(A.shape[0])
+    quality = modularity(A, labels)
+    for level in levels:
+        # each level maps every community of the level below to one above
+        assert len(level) == labels.max() + 1
+        labels = level[labels]
+        new_quality = modularity(A, labels)
+        assert new_quality > quality
+        quality = new_quality
+    assert quality > 0.5
+
+
+def graph_tiles(tmpdir, max_nodes=1000):
+    vectors = clustered_vectors(n=600, n_clusters=6)
+    A = knn_graph(*neighbor_table(vectors))
+    ids = np.arange(1, 601)
+    layers = build_layers(A, louvain(A), vectors, ids, np.arange(600) % 3)
+    path = str(tmpdir.join('model.graph.npz'))
+    save(path, layers, ['cs', 'math', 'physics'])
+    return GraphTiles(path, max_nodes=max_nodes), layers
+
+
+def test_layout_stays_in_the_unit_square(tmpdir):
+    _, layers = graph_tiles(tmpdir)
+    for layer in layers:
+        assert (layer['x'] >= 0).all() and (layer['x'] <= 1).all()
+        assert (layer['y'] >= 0).all() and (layer['y'] <= 1).all()
+
+
+def test_tiles_hold_the_nodes_inside_their_bounds(tmpdir):
+    tiles, layers = graph_tiles(tmpdir)
+    deepest = len(layers) - 1
+    zoom = deepest + 1
+    width = 1. / 2 ** zoom
+    seen = []
+    for tx in range(2 ** zoom):
+        for ty in range(2 ** zoom):
+            tile = tiles.tile(zoom, tx, ty)
+            assert tile['layer'] == deepest and tile['articles']
+            for node in tile['nodes']:
+                assert tx * width <= node['x'] < (tx + 1) * width
+                assert ty * width <= node['y'] < (ty + 1) * width
+            ids = set(node['id'] for node in tile['nodes'])
+            assert all(a in ids and b in ids for a, b, _ in tile['edges'])
+            seen.extend(ids)
+    # points on the far edge of the square fall outside every tile
+    inside = (layers[-1]['x'] < 1) & (layers[-1]['y'] < 1)
+    assert sorted(seen) == sorted(layers[-1]['ids'][inside].tolist())
+
+
+def test_zoom_zero_shows_the_top_communities(tmpdir):
+    tiles, layers = graph_tiles(tmpdir)
+    tile = tiles.tile(0, 0, 0)
+    assert tile['layer'] == 0 and not tile['articles']
+    assert len(tile['nodes']) == len(layers[0]['x'])
+    assert all(node['parent'] == -1 for node in tile['nodes'])
+    assert sum(node['size'] for node in tile['nodes']) == 600
+
+
+def test_full_tile_keeps_the_largest_nodes(tmpdir):
+    tiles, layers = graph_tiles(tmpdir, max_nodes=50)
+    everything = GraphTiles(str(tmpdir.join('model.graph.npz')), max_nodes=10000)
+    # the first zoom that shows articles
+    zoom = len(layers) - 1
+    truncated = 0
+    for tx in range(2 ** zoom):
+        for ty in range(2 ** zoom):
+            tile, full = tiles.tile(zoom, tx, ty), everything.tile(zoom, tx, ty)
+            assert tile['truncated'] == (len(full['nodes']) > 50)
+            truncated += tile['truncated']
+            sizes = sorted((node['size'] for node in full['nodes']), reverse=True)
+            assert sorted((node['size'] for node in tile['nodes']), reverse=True) == sizes[:50]
+    assert truncated
+
+
+def test_full_tile_keeps_the_largest_communities(tmpdir):
+    graph_tiles(tmpdir)
+    path = str(tmpdir.join('model.graph.npz'))
+    full = GraphTiles(path).tile(0, 0, 0)
+    tile = GraphTiles(path, max_nodes=2).tile(0, 0, 0)
+    assert tile['truncated'] and len(tile['nodes']) == 2
+    sizes = sorted((node['size'] for node in full['nodes']), reverse=True)
+    assert [node['size'] for node in tile['nodes']] == sizes[:2]
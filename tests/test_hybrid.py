@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from hybrid import fuse, ranks_of, vector_scores, lexical_candidates
+
+"""
+Rank fusion of full-text and docvec scores.
+"""
+
+
+class RecordingCursor(object):
+    """Answers lexical_candidates' query with fixed rows."""
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, query, params):
+        self.params = params
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_ranks_of_highest_first_ties_in_order():
+    assert list(ranks_of(np.array([0.2, 0.9, 0.2, 0.5]))) == [3, 1, 4, 2]
+
+
+def test_fuse_lexical_only_keeps_lexical_order():
+    ids = np.array([10, 11, 12])
+    results = fuse(ids, np.array([0.1, 0.3, 0.2]))
+    assert [idx for idx, _ in results] == [11, 12, 10]
+    assert abs(results[0][1] - 0.5 / 61) < 1e-12
+
+
+def test_fuse_weight_picks_the_signal():
+    ids = np.array([10, 11, 12])
+    lexical = np.array([3., 2., 1.])
+    vector = np.array([0.1, 0.5, 0.9])
+    assert [idx for idx, _ in fuse(ids, lexical, vector, weight=0.)] == [10, 11, 12]
+    assert [idx for idx, _ in fuse(ids, lexical, vector, weight=1.)] == [12, 11, 10]
+
+
+def test_fuse_rewards_agreement():
+    ids = np.array([10, 11, 12, 13])
+    lexical = np.array([4., 3., 1., 2.])
+    vector = np.array([0.1, 0.8, 0.9, 0.2])
+    # 11 is second on both signals, so it beats 10 and 12, each first
+    # on one signal and last on the other
+    assert fuse(ids, lexical, vector, weight=0.5)[0][0] == 11
+
+
+def test_fuse_topn_and_empty():
+    ids = np.arange(50)
+    assert len(fuse(ids, np.arange(50, dtype=float), topn=5)) == 5
+    assert fuse(np.array([], dtype=np.int64), np.array([])) == []
+
+
+def test_vector_scores_unknown_rows_rank_last():
+    vectors = np.eye(3, dtype=np.float32)
+    scores = vector_scores(vectors, np.array([0., 2., 0.]), np.array([1, 0, 7]))
+    assert list(scores[:2]) == [1., 0.]
+    assert scores[2] == -np.inf
+    assert list(ranks_of(scores)) == [1, 2, 3]
+
+
+def test_lexical_candidates_arrays():
+    cur = RecordingCursor([(5, 0.4), (2, 0.1)])
+    ids, ranks = lexical_candidates(cur, 'Bialek', limit=10)
+    assert cur.params == ('Bialek', 'Bialek', 10)
+    assert ids.dtype == np.int64 and list(ids) == [5, 2]
+    assert np.allclose(ranks, [0.4, 0.1])
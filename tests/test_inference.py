@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import zlib
+import threading
+import numpy as np
+import pytest
+from inference import QueryEncoder, SearchBatcher, stable_hash
+from similarity import ExactIndex
+from tests import clustered_vectors
+
+"""
+Deterministic query inference, and batching of concurrent searches.
+"""
+
+
+class FakeModel(object):
+    """
+    Infers like gensim does as far as seeding goes: the start
+    vector comes from hashfxn, the rest from model.random.
+    """
+    def __init__(self, dim=8):
+        self.dim = dim
+        self.hashfxn = hash
+        self.random = np.random.RandomState()
+        self.calls = 0
+
+    def infer_vector(self, words):
+        self.calls += 1
+        start = np.random.RandomState(self.hashfxn(' '.join(words)) & 0xffffffff).rand(self.dim)
+        return (start + self.random.rand(self.dim)).astype(np.float32)
+
+
+def test_stable_hash_is_crc32():
+    assert stable_hash(u'quantum') == zlib.crc32(b'quantum')
+    assert stable_hash(u'été') == zlib.crc32(u'été'.encode('utf-8'))
+
+
+def test_encoder_is_deterministic_across_models_and_calls():
+    first = QueryEncoder(FakeModel(), cache_size=0)
+    second = QueryEncoder(FakeModel(), cache_size=0)
+    assert first.model.hashfxn is stable_hash
+    vector = first.infer(['dark', 'matter'])
+    # whatever state model.random was left in
+    first.model.random.rand(100)
+    assert np.array_equal(first.infer(['dark', 'matter']), vector)
+    assert np.array_equal(second.infer(['dark', 'matter']), vector)
+    assert not np.array_equal(first.infer(['dark', 'energy']), vector)
+
+
+def test_encoder_caches_vectors():
+    encoder = QueryEncoder(FakeModel())
+    vector = encoder.infer(['dark', 'matter'])
+    assert encoder.infer(('dark', 'matter')) is vector
+    assert encoder.model.calls == 1
+
+
+class TableEncoder(object):
+    """Looks query vectors up instead of inferring them."""
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def infer(self, words):
+        if words == ['fail']:
+            raise ValueError('cannot infer')
+        return self.vectors[int(words[0])]
+
+
+class CountingIndex(ExactIndex):
+    def __init__(self, vectors):
+        super(CountingIndex, self).__init__(vectors)
+        self.batch_sizes = []
+
+    def search_batch(self, queries, topn=10, block_rows=65536):
+        self.batch_sizes.append(len(queries))
+        return super(CountingIndex, self).search_batch(queries, topn=topn, block_rows=block_rows)
+
+
+def concurrently(n, target):
+    """Run target(i) on n threads released at the same moment."""
+    barrier = threading.Barrier(n)
+    results = [None] * n
+
+    def run(i):
+        barrier.wait()
+        try:
+            results[i] = target(i)
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_batcher_answers_concurrent_callers_in_batches():
+    vectors = clustered_vectors()
+    index = CountingIndex(vectors)
+    batcher = SearchBatcher(TableEncoder(vectors), index, max_batch=8, max_wait=0.05)
+    results = concurrently(20, lambda i: batcher.search([str(i * 50)], topn=5 + i % 3))
+    batcher.close()
+    for i, result in enumerate(results):
+        expected = ExactIndex(vectors).search(vectors[i * 50], topn=5 + i % 3)
+        assert [idx for idx, _ in result] == [idx for idx, _ in expected]
+    assert sum(index.batch_sizes) == 20
+    assert max(index.batch_sizes) <= 8
+    assert len(index.batch_sizes) < 20
+
+
+def test_batcher_passes_errors_to_every_caller_of_the_batch():
+    vectors = clustered_vectors()
+    batcher = SearchBatcher(TableEncoder(vectors), ExactIndex(vectors), max_wait=0.05)
+    results = concurrently(4, lambda i: batcher.search(['fail'] if i == 0 else [str(i)]))
+    assert all(isinstance(result, (ValueError, list)) for result in results)
+    assert isinstance(results[0], ValueError)
+    # the batcher keeps serving afterwards
+    assert len(batcher.search(['3'], topn=4)) == 4
+    batcher.close()
+    batcher.thread.join(1)
+    assert not batcher.thread.is_alive()
+
+
+def test_batcher_wait_is_bounded_by_the_first_query():
+    vectors = clustered_vectors()
+    index = CountingIndex(vectors)
+    batcher = SearchBatcher(TableEncoder(vectors), index, max_batch=1000, max_wait=0.01)
+    stop = threading.Event()
+
+    def trickle():
+        # keeps queries arriving faster than max_wait, for longer than it
+        i = 0
+        while not stop.is_set():
+            batcher.queue.put({'words': [str(i % 2000)], 'topn': 1, 'done': threading.Event()})
+            stop.wait(0.001)
+            i += 1
+    thread = threading.Thread(target=trickle)
+    thread.start()
+    try:
+        assert len(batcher.search(['0'], topn=1)) == 1
+    finally:
+        stop.set()
+        thread.join()
+        batcher.close()
+    # about max_wait / 1ms queries, not max_batch of them
+    assert index.batch_sizes[0] < 100
+
+
+@pytest.mark.parametrize('max_batch', [1, 4])
+def test_batcher_respects_max_batch(max_batch):
+    vectors = clustered_vectors()
+    index = CountingIndex(vectors)
+    batcher = SearchBatcher(TableEncoder(vectors), index, max_batch=max_batch, max_wait=0.05)
+    concurrently(8, lambda i: batcher.search([str(i)]))
+    batcher.close()
+    assert max(index.batch_sizes) <= max_batch
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from profiler import SlowRequestProfiler
+
+"""
+The slow request profiler's log.
+"""
+
+
+def busy(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        sum(range(100))
+
+
+def read_log(path):
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+def test_only_slow_requests_are_logged(tmpdir):
+    path = str(tmpdir.join('slow.log'))
+    profiler = SlowRequestProfiler(threshold_ms=50, path=path, interval=0.001)
+    profiler.begin()
+    busy(0.02)
+    profiler.end('GET /fast', 20)
+    profiler.begin()
+    busy(0.1)
+    profiler.end('GET /slow', 100)
+    lines = read_log(path)
+    assert lines[0].startswith('# ') and 'GET /slow took 100.0ms' in lines[0]
+    assert not any('GET /fast' in line for line in lines)
+    stacks = lines[1:]
+    assert stacks and any(':busy:' in line for line in stacks)
+    # collapsed stacks end with their sample count
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in stacks)
+
+
+def test_waiting_on_samples_the_other_thread(tmpdir):
+    path = str(tmpdir.join('slow.log'))
+    profiler = SlowRequestProfiler(threshold_ms=0, path=path, interval=0.001)
+    start, done = threading.Event(), threading.Event()
+
+    def batcher():
+        start.wait()
+        busy(0.1)
+        done.set()
+
+    thread = threading.Thread(target=batcher, name='batcher')
+    thread.daemon = True
+    thread.start()
+    profiler.begin()
+    with profiler.waiting_on(thread):
+        start.set()
+        done.wait()
+    profiler.end('POST /search', 100)
+    stacks = read_log(path)[1:]
+    assert any(';[batcher];' in line and ':busy:' in line for line in stacks)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from quantize import CODECS, Float16Codes, Int8Codes, PQCodes, QuantizedIndex, codes_path
+from similarity import ExactIndex, IVFIndex, recall_at_k
+from tests import clustered_vectors
+
+"""
+Codec round trips, and recall of compressed search with and
+without re-ranking.
+"""
+
+QUERY_IDS = range(0, 2000, 40)
+
+
+def build(name, vectors):
+    return CODECS[name].build(vectors, m=8, sample_size=2000)
+
+
+@pytest.mark.parametrize('name', sorted(CODECS))
+def test_save_load_round_trip(name, tmpdir):
+    vectors = clustered_vectors()
+    codes = build(name, vectors)
+    path = codes_path(str(tmpdir.join('model')), name)
+    codes.save(path)
+    loaded = CODECS[name].load(path)
+    assert np.array_equal(loaded.codes, codes.codes)
+    assert np.allclose(loaded.scores(vectors[0]), codes.scores(vectors[0]))
+
+
+def test_float16_scores_are_close():
+    vectors = clustered_vectors()
+    scores = Float16Codes.build(vectors).scores(vectors[0])
+    assert np.abs(scores - np.dot(vectors, vectors[0])).max() < 1e-2
+
+
+def test_int8_codes_decode_close_to_vectors():
+    vectors = clustered_vectors()
+    codes = Int8Codes.build(vectors)
+    decoded = codes.codes.astype(np.float32) * codes.params['scale']
+    # rounding is off by at most half a step in each dimension
+    assert np.all(np.abs(decoded - vectors) <= codes.params['scale'] / 2 + 1e-6)
+
+
+def test_int8_clips_vectors_outside_the_fitted_range():
+    vectors = clustered_vectors()
+    codes = Int8Codes.build(vectors)
+    assert codes.encode(10 * vectors[:5]).min() == -127
+
+
+def test_pq_needs_m_to_divide_the_vector_size():
+    with pytest.raises(ValueError):
+        PQCodes.build(clustered_vectors(dim=32), m=5)
+
+
+def test_pq_scores_approximate_dot_products():
+    vectors = clustered_vectors()
+    codes = build('pq', vectors)
+    assert codes.codes.shape == (2000, 8) and codes.codes.dtype == np.uint8
+    approx = codes.scores(vectors[0])
+    assert np.corrcoef(approx, np.dot(vectors, vectors[0]))[0, 1] > 0.95
+
+
+def test_extend_grows_codes():
+    vectors = clustered_vectors()
+    codes = build('int8', vectors[:1500])
+    codes.extend(np.arange(1500, 2000), vectors[1500:])
+    assert len(codes.codes) == 2000
+    assert np.array_equal(codes.codes[1500:], codes.encode(vectors[1500:]))
+
+
+@pytest.mark.parametrize('name', sorted(CODECS))
+def test_rerank_recall(name):
+    vectors = clustered_vectors()
+    exact = ExactIndex(vectors)
+    codes = build(name, vectors)
+    approximate = recall_at_k(QuantizedIndex(codes, vectors, rerank=0), exact, vectors, QUERY_IDS)
+    reranked = recall_at_k(QuantizedIndex(codes, vectors, rerank=100), exact, vectors, QUERY_IDS)
+    assert reranked >= approximate
+    assert reranked > 0.95
+
+
+def test_rerank_scores_are_exact():
+    vectors = clustered_vectors()
+    index = QuantizedIndex(build('pq', vectors), vectors, rerank=100)
+    for idx, score in index.search(vectors[7], topn=10, exclude=7):
+        assert idx != 7
+        assert abs(score - float(np.dot(vectors[idx], vectors[7]))) < 1e-5
+
+
+def test_coarse_index_limits_candidates():
+    vectors = clustered_vectors()
+    coarse = IVFIndex.build(vectors, n_lists=16, n_iter=10)
+    coarse.nprobe = 4
+    index = QuantizedIndex(build('int8', vectors), vectors, rerank=100, coarse=coarse)
+    assert recall_at_k(index, ExactIndex(vectors), vectors, QUERY_IDS) > 0.95
+
+
+@pytest.mark.parametrize('name', sorted(CODECS))
+@pytest.mark.parametrize('rerank', [0, 50])
+@pytest.mark.parametrize('coarse', [False, True])
+def test_search_batch_matches_search(name, rerank, coarse):
+    vectors = clustered_vectors()
+    ivf = None
+    if coarse:
+        ivf = IVFIndex.build(vectors, n_lists=16)
+        ivf.nprobe = 3
+    index = QuantizedIndex(build(name, vectors), vectors, rerank=rerank, coarse=ivf)
+    queries = vectors[::97]
+    for query, results in zip(queries, index.search_batch(queries, topn=10, block_rows=300)):
+        single = index.search(query, topn=10)
+        assert [idx for idx, _ in results] == [idx for idx, _ in single]
+        assert np.allclose([s for _, s in results], [s for _, s in single], atol=1e-4)
+
+
+@pytest.mark.parametrize('name', sorted(CODECS))
+def test_missing_rows_are_not_scored(name):
+    vectors = clustered_vectors()
+    codes = build(name, vectors)
+    vectors[1000:] = 0
+    codes.codes[1000:] = 0
+    index = QuantizedIndex(codes, vectors, rerank=0, missing=np.arange(1000, 2000))
+    query = -vectors[0]
+    assert all(idx < 1000 for idx, _ in index.search(query, topn=10))
+    for results in index.search_batch(np.array([query, vectors[0]]), topn=10, block_rows=300):
+        assert all(idx < 1000 for idx, _ in results)
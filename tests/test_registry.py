@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import pytest
+
+pytest.importorskip('gensim')
+
+import registry
+import serving
+from registry import ModelRegistry
+
+"""
+Swapping models in and draining the old ones.
+"""
+
+
+class FakeServed(object):
+    """Stands in for ServedModel, counting warm-ups and closes."""
+    def __init__(self, path, **options):
+        self.path = path
+        self.options = options
+        self.active = 0
+        self.retired = False
+        self.warmed = 0
+        self.closed = 0
+
+    def warm(self):
+        self.warmed += 1
+
+    def close(self):
+        self.closed += 1
+
+
+@pytest.fixture
+def models_dir(tmpdir, monkeypatch):
+    monkeypatch.setattr(registry, 'ServedModel', FakeServed)
+    for version in ['v1', 'v2', 'v3']:
+        os.makedirs(os.path.dirname(serving.model_path(str(tmpdir), version)))
+    serving.publish(str(tmpdir), 'v1')
+    return str(tmpdir)
+
+
+def test_serves_and_warms_the_current_version(models_dir):
+    models = ModelRegistry.from_models_dir(models_dir, nprobe=8)
+    assert models.version == 'v1'
+    assert models.current.path == serving.model_path(models_dir, 'v1')
+    assert models.current.options == {'nprobe': 8}
+    assert models.current.warmed == 1
+
+
+def test_without_current_version(tmpdir, monkeypatch):
+    monkeypatch.setattr(registry, 'ServedModel', FakeServed)
+    with pytest.raises(ValueError):
+        ModelRegistry.from_models_dir(str(tmpdir))
+    models = ModelRegistry(str(tmpdir.join('model')), models_dir=str(tmpdir))
+    with pytest.raises(ValueError):
+        models.reload()
+    # the live model is untouched
+    assert models.current.path == str(tmpdir.join('model'))
+
+
+def test_idle_model_is_closed_on_swap(models_dir):
+    models = ModelRegistry.from_models_dir(models_dir)
+    old = models.current
+    serving.publish(models_dir, 'v2')
+    models.reload()
+    assert models.version == 'v2' and models.current.warmed == 1
+    assert old.retired and old.closed == 1
+
+
+def test_pinned_model_is_closed_once_drained(models_dir):
+    models = ModelRegistry.from_models_dir(models_dir)
+    first = models.acquire()
+    second = models.acquire()
+    models.reload('v2')
+    new = models.acquire()
+    # requests that started on v1 keep it; new ones get v2
+    assert first is second and new is models.current and new is not first
+    assert first.retired and first.closed == 0
+    models.release(first)
+    assert first.closed == 0 and first.active == 1
+    models.release(second)
+    assert first.closed == 1 and first.active == 0
+    models.release(new)
+    assert new.closed == 0
+
+
+def test_reload_records_current_so_the_watcher_leaves_a_pinned_version(models_dir):
+    models = ModelRegistry.from_models_dir(models_dir)
+    serving.publish(models_dir, 'v3')
+    # e.g. rolling back from the admin route while CURRENT says v3
+    models.reload('v2')
+    assert models.version == 'v2'
+    assert models.seen == 'v3'
+    models.reload()
+    assert models.version == 'v3' and models.seen == 'v3'
+
+
+def test_reload_without_models_dir_reloads_the_same_file(tmpdir, monkeypatch):
+    monkeypatch.setattr(registry, 'ServedModel', FakeServed)
+    path = str(tmpdir.join('model'))
+    models = ModelRegistry(path)
+    old = models.current
+    models.reload()
+    assert models.current is not old and models.current.path == path
+    assert old.closed == 1
+
+
+def test_watcher_follows_current_but_not_back_over_a_pin(models_dir):
+    models = ModelRegistry.from_models_dir(models_dir, poll_interval=0.01)
+    models.watch()
+    serving.publish(models_dir, 'v2')
+    deadline = time.time() + 5
+    while models.version != 'v2' and time.time() < deadline:
+        time.sleep(0.01)
+    assert models.version == 'v2'
+    models.reload('v1')
+    time.sleep(0.1)
+    assert models.version == 'v1'
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+import datetime
+import numpy as np
+from similarity import ExactIndex, IVFIndex, RowFilter, filtered_search, recall_at_k
+from tests import clustered_vectors
+
+"""
+Exact search against brute force, and IVF recall against exact search.
+"""
+
+
+def brute_force(vectors, query, topn):
+    scores = np.dot(vectors, query / np.linalg.norm(query))
+    return list(np.argsort(-scores, kind='mergesort')[:topn])
+
+
+def test_exact_matches_brute_force():
+    vectors = clustered_vectors()
+    index = ExactIndex(vectors)
+    for i in (0, 17, 1999):
+        query = vectors[i] * 3.  # need not be normalized
+        assert [idx for idx, _ in index.search(query, topn=10)] == brute_force(vectors, query, 10)
+
+
+def test_exact_scores_are_cosines_best_first():
+    vectors = clustered_vectors()
+    results = ExactIndex(vectors).search(vectors[5], topn=10)
+    scores = [score for _, score in results]
+    assert results[0] == (5, scores[0])
+    assert abs(scores[0] - 1.) < 1e-5
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_exclude_is_never_returned():
+    vectors = clustered_vectors(n=5)
+    index = ExactIndex(vectors)
+    # fewer rows than topn, so every row is a result but the excluded one
+    results = index.search(vectors[2], topn=10, exclude=2)
+    assert sorted(idx for idx, _ in results) == [0, 1, 3, 4]
+    results = index.search(vectors[2], topn=10, exclude=2, ids=np.arange(5))
+    assert sorted(idx for idx, _ in results) == [0, 1, 3, 4]
+
+
+def test_exact_ids_restricts_rows():
+    vectors = clustered_vectors()
+    ids = np.arange(0, 2000, 7)
+    results = ExactIndex(vectors).search(vectors[0], topn=10, ids=ids)
+    assert all(idx % 7 == 0 for idx, _ in results)
+    assert [idx for idx, _ in results] == list(ids[brute_force(vectors[ids], vectors[0], 10)])
+
+
+def test_search_batch_matches_search():
+    vectors = clustered_vectors()
+    index = ExactIndex(vectors)
+    batch = index.search_batch(vectors[:8], topn=10, block_rows=300)
+    for i, results in enumerate(batch):
+        assert [idx for idx, _ in results] == [idx for idx, _ in index.search(vectors[i], topn=10)]
+
+
+def test_ivf_probing_every_bucket_is_exact():
+    vectors = clustered_vectors()
+    ivf = IVFIndex.build(vectors, n_lists=16)
+    ivf.nprobe = 16
+    assert recall_at_k(ivf, ExactIndex(vectors), vectors, range(0, 2000, 40)) == 1.
+
+
+def test_ivf_recall_on_clustered_data():
+    vectors = clustered_vectors()
+    ivf = IVFIndex.build(vectors, n_lists=16)
+    exact = ExactIndex(vectors)
+    query_ids = range(0, 2000, 40)
+    ivf.nprobe = 1
+    low = recall_at_k(ivf, exact, vectors, query_ids)
+    ivf.nprobe = 4
+    high = recall_at_k(ivf, exact, vectors, query_ids)
+    assert high >= low
+    assert high > 0.95
+    assert ivf.scan_size() < len(vectors) / 2
+
+
+def test_ivf_add_buckets_new_rows():
+    vectors = clustered_vectors()
+    ivf = IVFIndex.build(vectors[:1500], n_lists=16)
+    ivf.vectors = vectors
+    ivf.add(np.arange(1500, 2000))
+    assert sorted(ivf.list_ids) == list(range(2000))
+    ivf.nprobe = 16
+    assert recall_at_k(ivf, ExactIndex(vectors), vectors, range(1500, 2000, 25)) == 1.
+
+
+def test_ivf_save_load(tmpdir):
+    vectors = clustered_vectors()
+    ivf = IVFIndex.build(vectors, n_lists=16)
+    path = str(tmpdir.join('model.ivf.npz'))
+    ivf.save(path)
+    loaded = IVFIndex.load(path, vectors, nprobe=4)
+    ivf.nprobe = 4
+    assert loaded.search(vectors[3], topn=10) == ivf.search(vectors[3], topn=10)
+
+
+def test_filtered_search_only_returns_allowed_rows():
+    vectors = clustered_vectors()
+    exact = ExactIndex(vectors)
+    ivf = IVFIndex.build(vectors, n_lists=16)
+    rows = np.arange(1, 2000)
+    row_filter = RowFilter.from_arrays(rows, ['cs' if i % 3 == 1 else 'math' for i in rows],
+                                       rows // 100)
+    results = filtered_search(ivf, exact, vectors[0], row_filter, topn=10, subject='cs')
+    assert len(results) == 10
+    assert all(idx % 3 == 1 for idx, _ in results)
+    results = filtered_search(ivf, exact, vectors[0], row_filter, topn=10,
+                              since=datetime.date(1970, 1, 11))
+    assert all(idx >= 1000 for idx, _ in results)
+    assert filtered_search(ivf, exact, vectors[0], row_filter, subject='biology') == []
+
+
+def test_row_filter_allows_matches_rows():
+    rng = np.random.RandomState(0)
+    rows = rng.permutation(np.arange(1, 500))
+    subjects = [['math', 'physics', 'cs'][i % 3] for i in rows]
+    row_filter = RowFilter.from_arrays(rows, subjects, rng.randint(0, 60, len(rows)))
+    ids = rng.randint(0, 600, 200)
+    for subject in [None, 'math', 'cs', 'biology']:
+        for since, until in [(None, None), (datetime.date(1970, 1, 20), None),
+                             (datetime.date(1970, 1, 10), datetime.date(1970, 2, 1))]:
+            matching = set(row_filter.rows(subject, since, until).tolist())
+            expected = np.array([i in matching for i in ids])
+            assert np.array_equal(row_filter.allows(ids, subject, since, until), expected)
+
+
+def test_row_filter_by_subject_and_date():
+    import datetime
+    epoch = datetime.date(1970, 1, 1)
+    day = lambda *ymd: (datetime.date(*ymd) - epoch).days
+    rows = [1, 2, 3, 4, 5]
+    subjects = ['math', 'physics', 'math', 'math', 'physics']
+    days = [day(2015, 1, 1), day(2015, 6, 1), day(2014, 1, 1), day(2016, 1, 1), day(2013, 1, 1)]
+    row_filter = RowFilter.from_arrays(rows, subjects, days)
+    assert sorted(row_filter.rows()) == rows
+    assert list(row_filter.rows(subject='math')) == [3, 1, 4]
+    assert list(row_filter.rows(subject='math', since=datetime.date(2015, 1, 1))) == [1, 4]
+    assert list(row_filter.rows(until=datetime.date(2014, 12, 31))) == [5, 3]
+    assert len(row_filter.rows(subject='biology')) == 0
+
+
+def test_ivf_add_rebuckets_rows_already_indexed():
+    vectors = clustered_vectors()
+    ivf = IVFIndex.build(vectors, n_lists=16)
+    # an updated article, re-inferred to a vector in another cluster
+    vectors[5] = vectors[1500]
+    ivf.add(np.array([5]))
+    assert sorted(ivf.list_ids) == list(range(2000))
+    ivf.nprobe = 1
+    assert 5 in [idx for idx, _ in ivf.search(vectors[1500], topn=10)]
+
+
+def test_ivf_search_batch_matches_search():
+    vectors = clustered_vectors()
+    ivf = IVFIndex.build(vectors, n_lists=16)
+    ivf.nprobe = 3
+    queries = vectors[::97] + 0.1
+    for query, results in zip(queries, ivf.search_batch(queries, topn=10)):
+        single = ivf.search(query, topn=10)
+        assert [idx for idx, _ in results] == [idx for idx, _ in single]
+        assert np.allclose([s for _, s in results], [s for _, s in single], atol=1e-5)
+
+
+def test_exact_never_returns_missing_rows():
+    vectors = clustered_vectors(n=6)
+    vectors[[1, 4]] = 0
+    index = ExactIndex(vectors, missing=np.array([1, 4]))
+    # a query opposite every vector scores the zero rows highest
+    query = -vectors[[0, 2, 3, 5]].sum(axis=0)
+    assert sorted(idx for idx, _ in index.search(query, topn=10)) == [0, 2, 3, 5]
+    batch = index.search_batch(query[np.newaxis, :], topn=10, block_rows=4)
+    assert sorted(idx for idx, _ in batch[0]) == [0, 2, 3, 5]
+
+
+def test_row_filter_from_db_leaves_out_missing_rows():
+    class Cursor(object):
+        def __init__(self, rows):
+            self.rows = rows
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def execute(self, query):
+            pass
+
+        def __iter__(self):
+            return iter(self.rows)
+
+    class Connection(object):
+        def cursor(self, name=None):
+            return Cursor([(1, 'cs.LG', datetime.date(2016, 1, 1)),
+                           (2, 'cs.LG', datetime.date(2016, 1, 2)),
+                           (3, 'math.CO', datetime.date(2016, 1, 3))])
+
+    row_filter = RowFilter.from_db(Connection(), missing=np.array([2]))
+    assert sorted(row_filter.rows().tolist()) == [1, 3]
+    assert row_filter.rows('cs.LG').tolist() == [1]
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import time
+import pytest
+from timing import StageTimer, Histogram, Metrics, format_labels
+
+"""
+Per-request stage timings and the /metrics histograms.
+"""
+
+
+class Clock(object):
+    """Stands in for time.time, moved forward by hand."""
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'time', clock)
+    return clock
+
+
+def test_stages_in_order_and_accumulate(clock):
+    timer = StageTimer()
+    with timer.stage('lexical'):
+        clock.now += 0.003
+    with timer.stage('rerank'):
+        clock.now += 0.001
+    with timer.stage('lexical'):
+        clock.now += 0.002
+    assert list(timer.timings) == ['lexical', 'rerank']
+    assert timer.timings['lexical'] == pytest.approx(5.)
+    assert timer.timings['rerank'] == pytest.approx(1.)
+    assert timer.total() == pytest.approx(6.)
+
+
+def test_nested_stage_time_counts_only_toward_the_inner_one(clock):
+    timer = StageTimer()
+    with timer.stage('hydrate'):
+        clock.now += 0.001
+        with timer.stage('db'):
+            clock.now += 0.004
+        clock.now += 0.002
+    assert timer.timings['hydrate'] == pytest.approx(3.)
+    assert timer.timings['db'] == pytest.approx(4.)
+    assert timer.total() == pytest.approx(7.)
+
+
+def test_stage_is_charged_when_it_raises(clock):
+    timer = StageTimer()
+    with pytest.raises(KeyError):
+        with timer.stage('infer'):
+            clock.now += 0.002
+            raise KeyError('word')
+    assert timer.timings['infer'] == pytest.approx(2.)
+    assert timer.running == []
+
+
+def test_header_and_summary(clock):
+    timer = StageTimer()
+    with timer.stage('tokenize'):
+        clock.now += 0.0001
+    with timer.stage('search'):
+        clock.now += 0.0125
+    assert timer.header() == 'tokenize;dur=0.1, search;dur=12.5'
+    assert timer.summary() == 'tokenize 0.1ms, search 12.5ms (total 12.6ms)'
+
+
+def test_histogram_cumulative_buckets():
+    histogram = Histogram(buckets=(.01, .1, 1.))
+    for value in (.005, .01, .05, 2.):
+        histogram.observe(value)
+    assert histogram.cumulative() == [('0.01', 2), ('0.1', 3), ('1.0', 3), ('+Inf', 4)]
+    assert histogram.count == 4
+    assert histogram.sum == pytest.approx(2.065)
+
+
+def test_format_labels_escapes_quotes_and_backslashes():
+    assert format_labels((('endpoint', 'a"b\\c'), ('le', '0.1'))) == \
+        'endpoint="a\\"b\\\\c",le="0.1"'
+
+
+def test_metrics_render_prometheus_text(clock):
+    metrics = Metrics(buckets=(.01, 1.))
+    timer = StageTimer()
+    with timer.stage('db'):
+        clock.now += 0.005
+    metrics.observe_timer('search', timer, seconds=0.02)
+    metrics.observe_timer('browse', timer)
+    lines = metrics.render(gauges=[('cache_entries', (('cache', 'articles'),), 3),
+                                   ('index_vectors', (), 10)]).splitlines()
+    # each metric's samples follow its one TYPE line
+    assert lines[0] == '# TYPE arxiv_request_seconds histogram'
+    assert 'arxiv_request_seconds_bucket{endpoint="search",le="0.01"} 0' in lines
+    assert 'arxiv_request_seconds_bucket{endpoint="search",le="+Inf"} 1' in lines
+    assert 'arxiv_request_seconds_bucket{endpoint="browse",le="0.01"} 1' in lines
+    assert 'arxiv_stage_seconds_count{endpoint="search",stage="db"} 1' in lines
+    assert '# TYPE arxiv_cache_entries gauge' in lines
+    assert 'arxiv_cache_entries{cache="articles"} 3.0' in lines
+    assert 'arxiv_index_vectors 10.0' in lines
+    types = [line.split()[2] for line in lines if line.startswith('# TYPE')]
+    assert len(types) == len(set(types))
+    for name in types:
+        samples = [i for i, line in enumerate(lines) if line.startswith(name + '{')
+                   or line.startswith(name + '_') or line.startswith(name + ' ')]
+        assert samples == list(range(samples[0], samples[-1] + 1))
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from tokenizer import tokenize_text, tokenize, QueryTokenizer, benchmark
+
+"""
+The tokenizer shared by training, inference and search.
+"""
+
+
+def test_tokenize_text_lowercases_and_splits_punctuation():
+    assert tokenize_text("Networks, Graphs and Dynamics!") == \
+        ['networks', ',', 'graphs', 'and', 'dynamics', '!']
+
+
+def test_tokenize_text_keeps_apostrophes_and_drops_other_symbols():
+    assert tokenize_text("Dirac's (1928) equation: a+b") == \
+        ["dirac's", '1928', 'equation', 'a', 'b']
+
+
+def test_tokenize_text_handles_unicode_words():
+    assert tokenize_text("Schrödinger Équation") == ['schrödinger', 'équation']
+
+
+def test_tokenize_joins_title_and_abstract():
+    assert tokenize("Deep Learning", "  We study\nnets.\n") == \
+        ['deep', 'learning', '.', 'we', 'study', 'nets', '.']
+
+
+def test_query_tokenizer_drops_unknown_words():
+    tokenizer = QueryTokenizer(vocab={'quantum': 0, 'gravity': 1})
+    assert tokenizer("Quantum loop Gravity?") == ['quantum', 'gravity']
+    assert tokenizer("loop") == []
+
+
+def test_query_tokenizer_caches_per_query():
+    tokenizer = QueryTokenizer(vocab={'quantum': 0})
+    first = tokenizer("quantum")
+    first.append('mutated')
+    # callers get a fresh list, so they cannot change the cached tokens
+    assert tokenizer("quantum") == ['quantum']
+    assert (tokenizer.cache.hits, tokenizer.cache.misses) == (1, 1)
+
+
+def test_benchmark_counts_tokens_and_tolerates_missing_fields():
+    n_tokens, seconds = benchmark([("A title", "An abstract."), (None, "Just this"), ("T", None)])
+    assert n_tokens == len(tokenize("A title", "An abstract.")) + \
+        len(tokenize("", "Just this")) + len(tokenize("T", ""))
+    assert seconds >= 0
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import datetime
+from xml_to_postgres import copy_escape, copy_rows, parse_file, COLUMNS
+
+"""
+COPY text-format escaping, and parsing of OAI XML files.
+"""
+
+RECORD = """<oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/"
+    xmlns:dc="http://purl.org/dc/elements/1.1/">
+ <dc:title>Dimensionality and dynamics in the behavior of C. elegans</dc:title>
+ <dc:creator>Stephens, Greg J</dc:creator>
+ <dc:creator>Bialek, William</dc:creator>
+ <dc:subject>Quantitative Biology - Other Quantitative Biology</dc:subject>
+ <dc:description>  A major challenge in analyzing animal behavior is to discover some
+underlying simplicity in complex motor actions.
+</dc:description>
+ <dc:description>Comment: 9 pages, 6 figures</dc:description>
+ <dc:date>{date}</dc:date>
+ <dc:date>2007-05-16</dc:date>
+ <dc:identifier>{identifier}</dc:identifier>
+ <dc:identifier>http://arxiv.org/abs/0705.1548</dc:identifier>
+</oai_dc:dc>
+"""
+
+
+class RecordingCursor(object):
+    """Keeps what copy_rows() sends instead of sending it to a database."""
+    def copy_expert(self, sql, fp):
+        self.sql = sql
+        self.data = fp.read()
+
+
+def write_record(tmpdir, name='0705.1548.xml', date='2007-05-11', identifier='doi:10.1371/x'):
+    path = tmpdir.join(name)
+    path.write(RECORD.format(date=date, identifier=identifier))
+    return str(path)
+
+
+def test_copy_escape_null_and_plain_values():
+    assert copy_escape(None) == '\\N'
+    assert copy_escape('plain text') == 'plain text'
+    assert copy_escape(datetime.date(2007, 5, 16)) == '2007-05-16'
+    assert copy_escape(3) == '3'
+
+
+def test_copy_escape_special_characters():
+    assert copy_escape('a\tb') == 'a\\tb'
+    assert copy_escape('line\nbreak\r') == 'line\\nbreak\\r'
+    assert copy_escape('C:\\path') == 'C:\\\\path'
+    # a literal backslash-N must not read back as NULL
+    assert copy_escape('\\N') == '\\\\N'
+
+
+def test_copy_escape_bytes_as_bytea_hex():
+    assert copy_escape(b'\x00\xffa') == '\\\\x00ff61'
+
+
+def test_copy_rows_one_line_per_row():
+    cur = RecordingCursor()
+    copy_rows(cur, [('a\tb', None), ('c', 'd\ne')], 'staging', ('x', 'y'))
+    assert cur.sql == 'COPY staging (x, y) FROM STDIN'
+    assert cur.data == 'a\\tb\t\\N\nc\td\\ne\n'
+
+
+def test_parse_file(tmpdir):
+    row = parse_file(write_record(tmpdir))
+    fields = dict(zip(COLUMNS, row))
+    assert fields['title'] == 'Dimensionality and dynamics in the behavior of C. elegans'
+    assert fields['authors'] == 'Stephens, Greg J|Bialek, William'
+    assert fields['subject'] == 'Quantitative Biology - Other Quantitative Biology'
+    assert fields['abstract'].strip().startswith('A major challenge')
+    assert fields['last_submitted'] == datetime.date(2007, 5, 16)
+    assert fields['arxiv_id'] == 'http://arxiv.org/abs/0705.1548'
+
+
+def test_parse_file_skips_bad_files(tmpdir):
+    assert parse_file(str(tmpdir.join('notes.txt'))) is None
+    broken = tmpdir.join('broken.xml')
+    broken.write('<oai_dc:dc')
+    assert parse_file(str(broken)) is None
+    # ValueError from the date, AttributeError from an empty identifier
+    assert parse_file(write_record(tmpdir, date='May 2007')) is None
+    assert parse_file(write_record(tmpdir, identifier='')) is None
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+"""
+Wall-clock timing of the stages of a request, and histograms
+of those timings across requests.
+
+Example:
+    timer = StageTimer()
+    with timer.stage('lexical'):
+        ...
+    with timer.stage('rerank'):
+        ...
+    response.headers['Server-Timing'] = timer.header()
+    metrics.observe_timer('search', timer)
+
+Browsers show the Server-Timing header in their developer
+tools' network panel, next to the request it belongs to.
+Metrics.render() writes the histograms in Prometheus' text
+format, for app.py's /metrics.
+"""
+
+# seconds; from a cached lookup to a pathological query
+BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+
+class StageTimer(object):
+    """
+    Milliseconds spent in each named stage, in the order the
+    stages ran. A stage entered twice accumulates. Time spent
+    in a stage nested inside another counts only toward the
+    inner one, so the stages add up to the total.
+    """
+    def __init__(self):
+        self.timings = OrderedDict()
+        self.running = []
+
+    @contextmanager
+    def stage(self, name):
+        now = time.time()
+        if self.running:
+            self._charge(now)
+        self.timings.setdefault(name, 0.)
+        self.running.append([name, now])
+        try:
+            yield
+        finally:
+            self._charge(time.time())
+            self.running.pop()
+            if self.running:
+                self.running[-1][1] = time.time()
+
+    def _charge(self, now):
+        """Add the time since the innermost stage (re)started to it."""
+        name, start = self.running[-1]
+        self.timings[name] += 1000 * (now - start)
+        self.running[-1][1] = now
+
+    def total(self):
+        return sum(self.timings.values())
+
+    def header(self):
+        """
+        Returns:
+            str: value for a Server-Timing response header
+        """
+        return ', '.join('%s;dur=%.1f' % (name, ms) for name, ms in self.timings.items())
+
+    def summary(self):
+        """
+        Returns:
+            str: e.g. 'lexical 3.1ms, rerank 0.4ms (total 3.5ms)'
+        """
+        stages = ', '.join('%s %.1fms' % (name, ms) for name, ms in self.timings.items())
+        return '%s (total %.1fms)' % (stages, self.total())
+
+
+class Histogram(object):
+    """Counts of observations at or below each bucket's upper bound."""
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        Returns:
+            list: (upper bound, observations at or below it) pairs,
+                ending with ('+Inf', count) as Prometheus expects
+        """
+        total = 0
+        pairs = []
+        for bound, n in zip(self.buckets, self.counts):
+            total += n
+            pairs.append((repr(bound), total))
+        pairs.append(('+Inf', self.count))
+        return pairs
+
+
+def format_labels(labels):
+    return ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for key, value in labels)
+
+
+class Metrics(object):
+    """
+    Histograms of request and stage durations, by endpoint.
+    Safe to share between the threads serving requests.
+    """
+    def __init__(self, prefix='arxiv', buckets=BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.histograms = OrderedDict()
+        self.lock = threading.Lock()
+
+    def observe(self, name, labels, seconds):
+        """
+        Args:
+            name (str): metric name, without prefix
+            labels (tuple): (key, value) pairs
+            seconds (float): duration to record
+        """
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def observe_timer(self, endpoint, timer, seconds=None):
+        """
+        Record every stage of a finished request, and its total:
+        seconds if given, e.g. including time outside any stage,
+        otherwise the sum of the stages.
+        """
+        for stage, ms in timer.timings.items():
+            self.observe('stage_seconds', (('endpoint', endpoint), ('stage', stage)), ms / 1000.)
+        if seconds is None:
+            seconds = timer.total() / 1000.
+        self.observe('request_seconds', (('endpoint', endpoint),), seconds)
+
+    def render(self, gauges=()):
+        """
+        Args:
+            gauges (list): (name, labels, value) of point-in-time
+                values to include, e.g. cache sizes
+
+        Returns:
+            str: every histogram and gauge in Prometheus' text format
+        """
+        lines = []
+        with self.lock:
+            histograms = [(key, list(h.cumulative()), h.sum, h.count)
+                          for key, h in self.histograms.items()]
+        # Prometheus wants the samples of one metric together
+        histograms.sort(key=lambda h: h[0][0])
+        typed = set()
+        for (name, labels), buckets, total, count in histograms:
+            full = '%s_%s' % (self.prefix, name)
+            if full not in typed:
+                lines.append('# TYPE %s histogram' % full)
+                typed.add(full)
+            for bound, n in buckets:
+                lines.append('%s_bucket{%s} %d' % (full, format_labels(labels + (('le', bound),)), n))
+            lines.append('%s_sum{%s} %r' % (full, format_labels(labels), total))
+            lines.append('%s_count{%s} %d' % (full, format_labels(labels), count))
+        for name, labels, value in sorted(gauges, key=lambda gauge: gauge[0]):
+            full = '%s_%s' % (self.prefix, name)
+            if full not in typed:
+                lines.append('# TYPE %s gauge' % full)
+                typed.add(full)
+            if labels:
+                lines.append('%s{%s} %r' % (full, format_labels(labels), float(value)))
+            else:
+                lines.append('%s %r' % (full, float(value)))
+        return '\n'.join(lines) + '\n'
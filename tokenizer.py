@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import re
+import time
+from cache import LRUCache
+import argparse
+
+"""
+The one tokenizer for the whole project. Training (train.py,
+corpus_cache.py), incremental inference (update_model.py) and
+search queries (app.py) all go through it, so a query is
+embedded from the same kind of tokens the model was trained on:
+"Networks," becomes ["networks", ","], not ["Networks,"].
+
+Text is lowercased once and split with a single precompiled
+regular expression, rather than lowercasing token by token.
+
+Benchmark tokens/s on the corpus:
+    $ python tokenizer.py arxiv --limit 100000
+"""
+
+TOKEN_RE = re.compile(r"[\w']+|[.,!?;]")
+
+
+def tokenize_text(text):
+    """
+    Args:
+        text (str)
+
+    Returns:
+        list: lowercased words, plus the punctuation Word2Vec
+            finds useful as context
+    """
+    return TOKEN_RE.findall(text.lower())
+
+
+def tokenize(title, abstract):
+    """
+    Turn an article into the word list the model trains on:
+    title and abstract, lowercased, keeping some punctuation
+    since Word2Vec considers it useful context.
+
+    Args:
+        title (str)
+        abstract (str)
+
+    Returns:
+        list: tokens
+    """
+    return tokenize_text(title + '. ' + abstract.replace('\n', ' ').strip())
+
+
+class QueryTokenizer(object):
+    """
+    Tokenizes search queries and drops words the model has no
+    vector for. infer_vector would skip them anyway, but filtering
+    first means queries that differ only in unknown words or
+    punctuation share a cache entry, and a query with no known
+    words can be answered without inferring anything.
+    Results are cached per query string.
+    """
+    def __init__(self, vocab, cache_size=10000):
+        """
+        Args:
+            vocab (dict): the model's vocabulary, e.g. model.vocab
+            cache_size (int): query strings to remember
+        """
+        self.vocab = vocab
+        self.cache = LRUCache(maxsize=cache_size)
+
+    def __call__(self, text):
+        """
+        Args:
+            text (str): query as typed
+
+        Returns:
+            list: tokens the model knows, in query order
+        """
+        words = self.cache.get(text)
+        if words is None:
+            vocab = self.vocab
+            words = tuple(word for word in tokenize_text(text) if word in vocab)
+            self.cache.put(text, words)
+        return list(words)
+
+
+def benchmark(rows):
+    """
+    Args:
+        rows (list): (title, abstract) tuples, already in memory
+            so only tokenizing is timed
+
+    Returns:
+        tuple: (tokens, seconds)
+    """
+    start = time.time()
+    n_tokens = 0
+    for title, abstract in rows:
+        n_tokens += len(tokenize(title or '', abstract or ''))
+    return n_tokens, time.time() - start
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='measure tokenizer throughput on the corpus')
+    parser.add_argument('dbname', help="Name of postgres database")
+    parser.add_argument('--limit', type=int, default=100000, help="Articles to tokenize")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs to take the best of")
+    args = parser.parse_args()
+
+    # imported here so training and serving can tokenize without a database driver
+    import psycopg2
+    with psycopg2.connect(dbname=args.dbname) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT title, abstract FROM articles LIMIT %s", (args.limit,))
+            rows = cur.fetchall()
+
+    n_tokens, seconds = min((benchmark(rows) for _ in range(args.repeat)), key=lambda r: r[1])
+    print("%d articles, %d tokens in %.2fs: %.0f tokens/s, %.0f articles/s" % (
+        len(rows), n_tokens, seconds, n_tokens / seconds, len(rows) / seconds))
@@ -3,7 +3,9 @@ import multiprocessing
 import psycopg2
 from psycopg2.extras import DictCursor
 from gensim.models.doc2vec import Doc2Vec, TaggedDocument
-import re
+import corpus_cache
+from tokenizer import tokenize, tokenize_text
+import fulltext
 import argparse
 
 
@@ -13,31 +15,53 @@ class DocIterator(object):
     lets us train without holding entire corpus in memory.
     It needs to be an object so gensim can make multiple passes over data.
     Here, we stream from a postgres database.
+    corpus_cache.CachedCorpus does the same from a pre-tokenized
+    file, and is what training uses unless --no_cache is given.
+
+    With fulltext, articles whose PDF text is in the fulltext
+    table (see populate_db/pdf_to_text.py) train on it after
+    their title and abstract. With paragraphs, the text instead
+    becomes one document per paragraph, all tagged with the
+    article's index; gensim 0.12 truncates documents at 10000
+    words, which whole papers often exceed.
+    Rows come from a server-side cursor, itersize at a time.
     """
-    def __init__(self, conn):
+    def __init__(self, conn, fulltext=False, paragraphs=False, itersize=2000):
         self.conn = conn
+        self.fulltext = fulltext
+        self.paragraphs = paragraphs
+        self.itersize = itersize
 
     def __iter__(self):
-        with conn.cursor(cursor_factory=DictCursor) as cur:
+        with self.conn.cursor('doc_iterator', cursor_factory=DictCursor) as cur:
+            cur.itersize = self.itersize
             # TODO: save names of table and database
             # to a central location. For now, db=arxive and table=articles
-            cur.execute("SELECT * FROM articles;")
+            if self.fulltext:
+                cur.execute("""SELECT a.index, a.title, a.abstract, f.body
+                            FROM articles a
+                            LEFT JOIN fulltext f ON f.article_id = a.index AND f.status = 'ok'
+                            ORDER BY a.index""")
+            else:
+                cur.execute("SELECT index, title, abstract FROM articles ORDER BY index")
             for article in cur:
-                abstract = article['abstract'].replace('\n', ' ').strip()
                 # train on body, composed of title and abstract
-                body = article['title'] + '. '
-                body += abstract
-                # We want to keep some punctuation, as Word2Vec
-                # considers them useful context
-                words = re.findall(r"[\w']+|[.,!?;]", body)
-                # lowercase. perhaps lemmatize too?
-                words = [word.lower() for word in words]
+                words = tokenize(article['title'], article['abstract'])
                 # document tag. Unique integer 'index' is good.
                 # can also add topic tag of form
                 # 'topic_{subject_id}' to list
                 #tags = [article['index'], article['subject']]
                 tags = [article['index']]
 
+                if self.fulltext and article['body'] is not None:
+                    text = fulltext.decompress(article['body'])
+                    if self.paragraphs:
+                        yield TaggedDocument(words, tags)
+                        for chunk in fulltext.paragraphs(text):
+                            yield TaggedDocument(tokenize_text(chunk), tags)
+                        continue
+                    words += tokenize_text(text)
+
                 yield TaggedDocument(words, tags)
 
 
@@ -46,11 +70,23 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='trains model based on corpus in psql')
     parser.add_argument('dbname', help="Name of postgres database")
     parser.add_argument('path_to_model', help="Filepath and name for model")
+    parser.add_argument('--cache_dir', default='corpus_cache',
+                        help="Pre-tokenized corpus, rebuilt if the articles table changed")
+    parser.add_argument('--no_cache', action='store_true',
+                        help="Stream and tokenize from postgres on every pass instead")
+    parser.add_argument('--fulltext', action='store_true',
+                        help="Also train on PDF text from the fulltext table; implies --no_cache")
+    parser.add_argument('--paragraphs', action='store_true',
+                        help="With --fulltext, one document per paragraph instead of per article")
     args = parser.parse_args()
 
     n_cpus = multiprocessing.cpu_count()
     with psycopg2.connect(dbname=args.dbname) as conn:
-        doc_iterator = DocIterator(conn)
+        if args.no_cache or args.fulltext:
+            doc_iterator = DocIterator(conn, fulltext=args.fulltext, paragraphs=args.paragraphs)
+        else:
+            corpus_cache.ensure(conn, args.cache_dir)
+            doc_iterator = corpus_cache.CachedCorpus(args.cache_dir)
         model = Doc2Vec(
             documents=doc_iterator,
             workers=n_cpus,
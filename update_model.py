@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+import time
+import multiprocessing
+import numpy as np
+import psycopg2
+import serving
+from tokenizer import tokenize
+from inference import stable_hash
+from similarity import IVFIndex, RowFilter, normalized, index_path
+from quantize import CODECS, codes_path
+import argparse
+
+"""
+Embed newly ingested articles without retraining.
+
+train.py retrains Doc2Vec over the whole corpus, which takes hours.
+Between full retrains, this script gives new articles a vector
+with infer_vector, using the live model with its weights frozen,
+and publishes the result as a new version under the models directory:
+
+    $ python update_model.py arxiv models/ new_indices.txt --updated_indices updated_indices.txt
+
+where both files are written by xml_to_postgres.py. Articles in
+updated_indices.txt already have a vector, built from their old
+title and abstract, and are re-inferred from the new ones.
+
+The new version shares the inference model with its parent
+(files are hard-linked where possible), gets a docvec matrix
+with the new rows filled in, and has the IVF index and any
+compressed codes extended in place. Articles past the end of the
+matrix that neither file lists are embedded too. Rows no article
+has, e.g. indices of rolled-back inserts, are listed in
+model.missing_rows.npy so that search never returns them. The neighbor table is carried
+over as is: new articles are looked up live, and updated ones keep
+their old neighbors, until populate_db/cache_neighbors.py is re-run.
+
+Inferred vectors are not as good as trained ones. To gauge by how
+much, a sample of articles that were part of the last full training
+is re-inferred and compared with their trained vectors. The
+report also shows how much of the corpus is inferred, to help
+decide when a full retrain is due.
+"""
+
+# the model worker processes infer with, loaded once per process
+worker_model = None
+worker_seed = None
+
+
+def init_worker(model_path, seed=1):
+    """
+    Load the model and seed it the way inference.QueryEncoder does,
+    so an article gets the same vector from every worker and every run.
+    """
+    global worker_model, worker_seed
+    worker_model, _ = serving.load(model_path)
+    worker_model.hashfxn = stable_hash
+    worker_seed = seed
+
+
+def infer_batch(rows):
+    """
+    Worker: infer vectors for a batch of (index, title, abstract) rows.
+
+    Returns:
+        tuple: (indices, vectors) with vectors unit-normalized
+    """
+    ids = [row[0] for row in rows]
+    vectors = []
+    for _, title, abstract in rows:
+        worker_model.random = np.random.RandomState(worker_seed)
+        vectors.append(worker_model.infer_vector(tokenize(title or '', abstract or '')))
+    return ids, normalized(np.array(vectors))
+
+
+def infer_articles(pool, conn, indices, batch_size=500):
+    """
+    Args:
+        pool (Pool): process pool started with init_worker
+        conn (connection): open psycopg2 connection
+        indices (list): article indices to embed
+        batch_size (int): articles per worker task
+
+    Returns:
+        tuple: (indices, vectors) as arrays, in matching order
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT index, title, abstract FROM articles WHERE index = ANY(%s)",
+                    (list(indices),))
+        rows = cur.fetchall()
+    batches = [rows[start:start + batch_size] for start in range(0, len(rows), batch_size)]
+    ids = []
+    vectors = []
+    for batch_ids, batch_vectors in pool.imap(infer_batch, batches):
+        ids.extend(batch_ids)
+        vectors.append(batch_vectors)
+        print("inferred %d of %d articles" % (len(ids), len(rows)))
+    if not vectors:
+        return np.array([], dtype=np.int64), None
+    return np.array(ids, dtype=np.int64), np.vstack(vectors)
+
+
+def drift(pool, conn, docvecs, trained_rows, n_sample=500, seed=0):
+    """
+    Compare re-inferred vectors of trained articles with their trained vectors.
+
+    Args:
+        docvecs (ndarray): unit-normalized docvecs of the live version
+        trained_rows (int): rows [0, trained_rows) come from full training
+
+    Returns:
+        ndarray: cosine similarity of each sampled article's
+            inferred vector to its trained one
+    """
+    rng = np.random.RandomState(seed)
+    sample = rng.choice(trained_rows, min(n_sample, trained_rows), replace=False)
+    ids, vectors = infer_articles(pool, conn, sample)
+    if vectors is None:
+        return np.array([])
+    return (np.asarray(docvecs[ids]) * vectors).sum(axis=1)
+
+
+def next_version(version):
+    """'v3' -> 'v4'"""
+    return 'v%d' % (int(version.lstrip('v')) + 1)
+
+
+def link_or_copy(src, dst):
+    """Hard-link src to dst so versions share disk and page cache; copy if linking fails."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def unlisted_indices(conn, first, missing, listed):
+    """
+    Articles at or past row `first`, or in one of the `missing`
+    rows, that are not in `listed`, e.g. from an earlier ingest
+    whose new_indices.txt was overwritten before update_model.py ran.
+
+    Returns:
+        list: their indices
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT index FROM articles WHERE index >= %s OR index = ANY(%s)",
+                    (first, missing.tolist()))
+        listed = set(listed)
+        return [index for index, in cur.fetchall() if index not in listed]
+
+
+def missing_rows(old_missing, n_old, n_rows, ids):
+    """
+    Rows of the new docvec matrix that have no vector: those
+    missing from the old one and those it grew by, less the
+    rows just inferred. They stay all zeros in the matrix.
+
+    Returns:
+        ndarray: sorted row numbers
+    """
+    missing = np.union1d(old_missing, np.arange(n_old, n_rows))
+    return np.setdiff1d(missing, ids).astype(np.int64)
+
+
+def read_metadata(version_dir, docvecs):
+    """
+    Returns:
+        dict: parent version, number of rows from full training
+            and number of articles inferred since
+    """
+    path = os.path.join(version_dir, 'version.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    # a version exported straight from train.py
+    return {'parent': None, 'trained_rows': len(docvecs), 'inferred': 0}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='embed new articles with the frozen live model')
+    parser.add_argument('dbname', help="Name of postgres database")
+    parser.add_argument('models_dir', help="Models directory with a CURRENT version")
+    parser.add_argument('new_indices', help="File of article indices, one per line")
+    parser.add_argument('--updated_indices', default=None,
+                        help="File of indices of articles whose text changed, to re-infer")
+    parser.add_argument('--workers', type=int, help="Inference processes, defaults to all cores")
+    parser.add_argument('--n_drift', type=int, default=500,
+                        help="Trained articles to re-infer when measuring drift")
+    args = parser.parse_args()
+
+    version = serving.current_version(args.models_dir)
+    if version is None:
+        raise SystemExit("No CURRENT version in %s; export one with serving.py --version" %
+                         args.models_dir)
+    old_path = serving.model_path(args.models_dir, version)
+    old_dir = os.path.dirname(old_path)
+    docvecs = np.load(serving.docvecs_file(old_path), mmap_mode='r')
+    metadata = read_metadata(old_dir, docvecs)
+
+    # rows an earlier update had no article for
+    old_missing = np.array([], dtype=np.int64)
+    if os.path.exists(serving.missing_rows_path(old_path)):
+        old_missing = np.load(serving.missing_rows_path(old_path))
+
+    with open(args.new_indices) as f:
+        indices = [int(line) for line in f if line.strip()]
+    # rows already in the matrix have a trained or inferred vector, unless missing
+    missing_set = set(old_missing.tolist())
+    skipped = [i for i in indices if i < len(docvecs) and i not in missing_set]
+    indices = [i for i in indices if i >= len(docvecs) or i in missing_set]
+    updated = []
+    if args.updated_indices:
+        with open(args.updated_indices) as f:
+            updated = [int(line) for line in f if line.strip()]
+        updated = [i for i in updated if i < len(docvecs) and i not in missing_set]
+    with psycopg2.connect(dbname=args.dbname) as conn:
+        unlisted = unlisted_indices(conn, len(docvecs), old_missing, indices)
+    print("%d new articles, %d unlisted, %d already embedded, %d updated" % (
+        len(indices), len(unlisted), len(skipped), len(updated)))
+    indices += unlisted + updated
+    if not indices:
+        raise SystemExit("Nothing to do")
+
+    start = time.time()
+    pool = multiprocessing.Pool(args.workers or multiprocessing.cpu_count(),
+                                initializer=init_worker, initargs=(old_path,))
+    with psycopg2.connect(dbname=args.dbname) as conn:
+        ids, vectors = infer_articles(pool, conn, indices)
+        print("Inferred %d vectors in %.1fs" % (len(ids), time.time() - start))
+        if not len(ids):
+            # e.g. the new indices were deleted since they were listed
+            pool.close()
+            pool.join()
+            raise SystemExit("None of the new articles are in %s; not publishing a new version" %
+                             args.dbname)
+        sims = drift(pool, conn, docvecs, metadata['trained_rows'], n_sample=args.n_drift)
+    pool.close()
+    pool.join()
+
+    new_version = next_version(version)
+    new_dir = os.path.join(args.models_dir, new_version)
+    new_path = serving.model_path(args.models_dir, new_version)
+    os.makedirs(new_dir)
+    rewritten = set([serving.docvecs_file(old_path), index_path(old_path),
+                     serving.row_filter_path(old_path), serving.missing_rows_path(old_path)] +
+                    [codes_path(old_path, name) for name in CODECS])
+    for fname in os.listdir(old_dir):
+        src = os.path.join(old_dir, fname)
+        if fname.startswith('model') and src not in rewritten:
+            link_or_copy(src, os.path.join(new_dir, fname))
+
+    # docvec matrix, grown to cover the new indices, copied in chunks
+    n_rows = max(len(docvecs), int(ids.max()) + 1)
+    new_docvecs = np.lib.format.open_memmap(serving.docvecs_file(new_path), mode='w+',
+                                            dtype=np.float32, shape=(n_rows, docvecs.shape[1]))
+    for chunk in range(0, len(docvecs), 65536):
+        new_docvecs[chunk:chunk + 65536] = docvecs[chunk:chunk + 65536]
+    new_docvecs[ids] = vectors
+    new_docvecs.flush()
+    # index gaps with no article, e.g. rolled-back inserts, stay zero rows;
+    # they are left out of the IVF index and RowFilter, and skipped by
+    # ExactIndex and QuantizedIndex
+    missing = missing_rows(old_missing, len(docvecs), n_rows, ids)
+    if len(missing):
+        np.save(serving.missing_rows_path(new_path), missing)
+
+    if os.path.exists(index_path(old_path)):
+        ivf = IVFIndex.load(index_path(old_path), new_docvecs)
+        ivf.add(ids)
+        ivf.save(index_path(new_path))
+    for name, codec in CODECS.items():
+        if os.path.exists(codes_path(old_path, name)):
+            codes = codec.load(codes_path(old_path, name))
+            codes.extend(ids, vectors)
+            codes.save(codes_path(new_path, name))
+
+    if os.path.exists(serving.row_filter_path(old_path)):
+        # the new articles need their subject and date to be filterable
+        with psycopg2.connect(dbname=args.dbname) as conn:
+            RowFilter.from_db(conn, missing=missing).save(serving.row_filter_path(new_path))
+
+    # re-inferred trained rows become inferred; other updated rows already were
+    n_inferred = int((ids >= len(docvecs)).sum() + len(np.intersect1d(ids, old_missing)) +
+                     (ids < metadata['trained_rows']).sum())
+    metadata = {'parent': version, 'trained_rows': metadata['trained_rows'],
+                'inferred': metadata['inferred'] + n_inferred}
+    with open(os.path.join(new_dir, 'version.json'), 'w') as f:
+        json.dump(metadata, f)
+    serving.publish(args.models_dir, new_version)
+    print("Published %s at %s" % (new_version, new_path))
+
+    if len(sims):
+        print("Drift: inferred vs trained cosine over %d articles: "
+              "mean %.3f, p10 %.3f, median %.3f" % (
+                  len(sims), sims.mean(), np.percentile(sims, 10), np.median(sims)))
+    print("%d of %d articles (%.1f%%) have inferred vectors; "
+          "retrain with train.py when this share or the drift grows too large" % (
+              metadata['inferred'], metadata['trained_rows'] + metadata['inferred'],
+              100. * metadata['inferred'] / (metadata['trained_rows'] + metadata['inferred'])))
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import os
+import shlex
+from app import create_app, parse_args
+
+"""
+WSGI entry point, for serving app.py with gunicorn or another
+WSGI server instead of flask's development server.
+
+app.py's command line arguments are read from ARXIV_APP_ARGS:
+    $ ARXIV_APP_ARGS="models --codec int8 --pool_size 20" \\
+        gunicorn --workers 4 --threads 8 wsgi:application
+
+Each worker loads its own model and opens its own database
+pool. Do not use gunicorn's --preload: the model registry,
+subjects listener and profiler run background threads, which
+do not survive the fork into workers.
+"""
+
+if not os.environ.get('ARXIV_APP_ARGS'):
+    raise RuntimeError("Set ARXIV_APP_ARGS to app.py's arguments, e.g. ARXIV_APP_ARGS=models")
+
+application = create_app(parse_args(shlex.split(os.environ['ARXIV_APP_ARGS'])))